@@ -1,9 +1,17 @@
+import configparser
+import os
+import pickle
+import time
 from collections import OrderedDict
-from enum import unique, Enum, IntFlag
+from enum import unique, IntFlag
 
 from Blueprints.CraftPackageObject import CraftPackageObject, BlueprintException
 from Blueprints.CraftVersion import CraftVersion
 from CraftCore import CraftCore
+from CraftStandardDirs import CraftStandardDirs
+from Utils import CraftHash
+from Utils.CraftCache import CraftCache
+from VersionInfo import VersionInfo
 
 
 @unique
@@ -17,93 +25,290 @@ class DependencyType(IntFlag):
     All         = ~0
 
 
+class DependencyGraph(object):
+    """
+    The direct dependencies, versions and ignore states of the blueprints, stored in
+    etc/blueprints/dependencyGraph.pickle so that unchanged blueprints don't need to be imported.
+
+    A node is only used as long as the digests of its blueprint, its version.ini and the info.ini of its category
+    and the options passed for the package, like --target, match, the whole graph is discarded if the compiler, the settings, the BlueprintSettings or the set of
+    blueprints changed.
+    """
+    _VERSION = 2
+
+    def __init__(self):
+        self.key = DependencyGraph._globalKey()
+        # path -> {"files": {file: (mtime, size, digest)}, "options": {str: str}, "version": str, "ignored": bool,
+        #          "edges": {int(DependencyType): [path]}}
+        self.nodes = {}
+        self.created = time.time()
+        self.dirty = False
+        self._validated = set()
+        graphFile = DependencyGraph._graphFile()
+        if os.path.isfile(graphFile):
+            try:
+                with open(graphFile, "rb") as f:
+                    data = pickle.load(f)
+                # like the CraftCache the graph expires, blueprints might get their versions from the network
+                if (data.get("version", None) == DependencyGraph._VERSION and data["key"] == self.key
+                        and time.time() - data["created"] < CraftCache._cacheLifetime):
+                    self.nodes = data["nodes"]
+                    self.created = data["created"]
+                else:
+                    CraftCore.log.debug("Discarding the dependency graph")
+            except Exception as e:
+                CraftCore.log.warning(f"Dependency graph corrupted: {e}")
+
+    @staticmethod
+    def _graphFile() -> str:
+        return os.path.join(CraftStandardDirs.etcBlueprintDir(), "dependencyGraph.pickle")
+
+    @staticmethod
+    def _globalKey() -> tuple:
+        """The key of everything beside the blueprints themselves that affects the graph"""
+        from options import UserOptions
+        # BlueprintSettings.ini is rewritten on every run and gains empty sections, so we use the options in effect
+        userOptions = UserOptions.instance().settings
+        options = sorted((section, sorted(userOptions.items(section, raw=True)))
+                         for section in userOptions.sections() if userOptions.items(section, raw=True))
+        settingsFile = CraftCore.settings.iniPath
+        blueprints = sorted((p.path, p.source or "") for p in CraftPackageObject.root().allChildren())
+        return (tuple(CraftCore.compiler.signature),
+                CraftHash.digestFile(settingsFile) if os.path.isfile(settingsFile) else None,
+                CraftCore.settings.get("Compile", "BuildType", ""),
+                CraftCore.settings.get("General", "Options", ""),
+                CraftHash.digestString(repr(options)),
+                CraftHash.digestString(repr(blueprints)))
+
+    @staticmethod
+    def _files(package) -> [str]:
+        files = [package.source]
+        if package.categoryInfo:
+            files.append(os.path.join(package.categoryInfo.localPath, "info.ini"))
+        # the version.ini is usually found in a directory above the blueprint
+        files += VersionInfo(package=package).files()
+        return files
+
+    @staticmethod
+    def _options(package) -> dict:
+        """The options passed on the command line, like the version of --target"""
+        from options import UserOptions
+        return dict(UserOptions.instance().packageOptions.get(package.path, {}))
+
+    @staticmethod
+    def _fileState(path : str, digest : str=None) -> tuple:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, digest or CraftHash.digestFile(path)
+
+    def _isValid(self, node : dict) -> bool:
+        for path, state in node["files"].items():
+            current = DependencyGraph._fileState(path, digest=state[2] if state else None)
+            if current == state:
+                continue
+            if not state or not current:
+                return False
+            # the file was touched, compare the content
+            current = DependencyGraph._fileState(path)
+            if current[2] != state[2]:
+                return False
+            node["files"][path] = current
+            self.dirty = True
+        return True
+
+    def node(self, package) -> dict:
+        """Returns the node of package, a stale node is replaced by an empty one"""
+        if not package.path or package.isCategory():
+            return None
+        if package.path not in self._validated:
+            self._validated.add(package.path)
+            node = self.nodes.get(package.path, None)
+            files = DependencyGraph._files(package)
+            options = DependencyGraph._options(package)
+            if not node or node["files"].keys() != set(files) or node["options"] != options or not self._isValid(node):
+                CraftCore.log.debug(f"Adding {package} to the dependency graph")
+                self.nodes[package.path] = {"files": {f: DependencyGraph._fileState(f) for f in files}, "options": options,
+                                            "version": None, "ignored": None, "edges": {}}
+                self.dirty = True
+            elif package._version is None:
+                package._version = node["version"]
+        return self.nodes[package.path]
+
+    def save(self) -> None:
+        if not self.dirty:
+            return
+        graphFile = DependencyGraph._graphFile()
+        try:
+            os.makedirs(os.path.dirname(graphFile), exist_ok=True)
+            tmpFile = f"{graphFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump({"version": DependencyGraph._VERSION, "key": self.key, "created": self.created, "nodes": self.nodes}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFile, graphFile)
+            self.dirty = False
+        except Exception as e:
+            CraftCore.log.warning(f"Failed to save the dependency graph {graphFile}: {e}")
+
+
 class CraftDependencyPackage(CraftPackageObject):
+    # the direct dependencies by (path, depenendencyType)
     _packageCache = dict()
+    # the memoized results of getDependencies by (path, depenendencyType, ignoredPackages)
+    _closureCache = dict()
+    # whether a package is ignored by path
+    _ignoredCache = dict()
+    # the persisted graph, loaded on first use
+    _graph = None
 
-    @unique
-    class State(Enum):
-        Unvisited = 0
-        Visiting = 1
-        Visited = 2
-
-    def __init__(self, path):
-        CraftPackageObject.__init__(self, path)
-        self._depenendencyType = None
-        self.dependencies = [] # tuple (name, required version)
-        self.state = CraftDependencyPackage.State.Unvisited
-
-
-    @property
-    def depenendencyType(self):
-        return self._depenendencyType
-
-    @depenendencyType.setter
-    def depenendencyType(self, depenendencyType):
-        if self._depenendencyType != depenendencyType:
-            self._depenendencyType = depenendencyType
-            self.dependencies = []
-            self.__resolveDependencies()
-
-    def __resolveDependencies(self):
-        CraftCore.log.debug(f"resolving package {self}")
-        if not self.isCategory():
-            subinfo = self.subinfo
-            if self.depenendencyType & DependencyType.Runtime:
-                self.dependencies.extend(self.__readDependenciesForChildren(subinfo.runtimeDependencies.items()))
-            if self.depenendencyType & DependencyType.Buildtime:
-                self.dependencies.extend(self.__readDependenciesForChildren(subinfo.buildDependencies.items()))
-            if self.depenendencyType & DependencyType.Packaging:
-                self.dependencies.extend(self.__readDependenciesForChildren(subinfo.packagingDependencies.items()))
-        else:
-            self.dependencies.extend(self.__readDependenciesForChildren([(x, None) for x in self.children.values()]))
+    @staticmethod
+    def clearCache():
+        CraftDependencyPackage._packageCache = dict()
+        CraftDependencyPackage._closureCache = dict()
+        CraftDependencyPackage._ignoredCache = dict()
+        CraftDependencyPackage._graph = None
+
+    @staticmethod
+    def graph() -> DependencyGraph:
+        if not CraftDependencyPackage._graph:
+            CraftDependencyPackage._graph = DependencyGraph()
+        return CraftDependencyPackage._graph
+
+    @staticmethod
+    def __directDependencies(package, depenendencyType) -> [CraftPackageObject]:
+        key = (package.path, depenendencyType)
+        if package.path and key in CraftDependencyPackage._packageCache:
+            return CraftDependencyPackage._packageCache[key]
+        node = CraftDependencyPackage.graph().node(package)
+        dependencies = None
+        if node and int(depenendencyType) in node["edges"]:
+            dependencies = [CraftPackageObject.get(path) for path in node["edges"][int(depenendencyType)]]
+            if not all(dependencies):
+                dependencies = None
+        if dependencies is None:
+            CraftCore.log.debug(f"resolving package {package}")
+            if package.isCategory():
+                dependencies = list(package.children.values())
+            else:
+                subinfo = package.subinfo
+                dependencies = []
+                if depenendencyType & DependencyType.Runtime:
+                    dependencies.extend(CraftDependencyPackage.__readDependencies(package, subinfo.runtimeDependencies.items()))
+                if depenendencyType & DependencyType.Buildtime:
+                    dependencies.extend(CraftDependencyPackage.__readDependencies(package, subinfo.buildDependencies.items()))
+                if depenendencyType & DependencyType.Packaging:
+                    dependencies.extend(CraftDependencyPackage.__readDependencies(package, subinfo.packagingDependencies.items()))
+            if node:
+                node["edges"][int(depenendencyType)] = [p.path for p in dependencies]
+                node["version"] = package.version
+                CraftDependencyPackage.graph().dirty = True
+        if package.path:
+            CraftDependencyPackage._packageCache[key] = dependencies
+        return dependencies
 
-    def __readDependenciesForChildren(self, deps : [(str, str)]) -> []:
+    @staticmethod
+    def __readDependencies(package, deps : [(str, str)]) -> [CraftPackageObject]:
         children = []
-        if deps:
-            for packaheName, requiredVersion in deps:
-                if (packaheName, self.depenendencyType) not in CraftDependencyPackage._packageCache:
-                    package = CraftPackageObject.get(packaheName)
-                    if not package:
-                        raise BlueprintException(f"Failed to resolve {packaheName} as a dependency of {self}", self)
-                    if requiredVersion and requiredVersion != None and CraftVersion(package.version) < CraftVersion(requiredVersion):
-                        raise BlueprintException(f"{self} requries {package} version {requiredVersion!r} but {package.version!r} is installed", self)
-
-                    p = CraftDependencyPackage(package)
-                    CraftCore.log.debug(f"adding package {packaheName}")
-                    CraftDependencyPackage._packageCache[(packaheName, self.depenendencyType)] = p
-                    p.depenendencyType = self.depenendencyType
-                else:
-                    p = CraftDependencyPackage._packageCache[(packaheName, self.depenendencyType)]
-                children.append(p)
+        for packaheName, requiredVersion in deps:
+            dependency = CraftPackageObject.get(packaheName)
+            if not dependency:
+                raise BlueprintException(f"Failed to resolve {packaheName} as a dependency of {package}", package)
+            if requiredVersion and requiredVersion != None and CraftVersion(dependency.version) < CraftVersion(requiredVersion):
+                raise BlueprintException(f"{package} requries {dependency} version {requiredVersion!r} but {dependency.version!r} is installed", package)
+            children.append(dependency)
         return children
 
-    def __getDependencies(self, depenendencyType, ignoredPackages):
-        """ returns all dependencies """
-        if self.isIgnored():
-            return []
-        self.depenendencyType = depenendencyType
-
-        depList = []
+    @staticmethod
+    def __isIgnored(package) -> bool:
+        if package.path not in CraftDependencyPackage._ignoredCache:
+            node = CraftDependencyPackage.graph().node(package)
+            if node and node["ignored"] is not None:
+                ignored = node["ignored"]
+            else:
+                if not package.isCategory():
+                    # the blueprint might deactivate itself in registerOptions
+                    package.subinfo
+                ignored = bool(package.isIgnored())
+                if node:
+                    node["ignored"] = ignored
+                    CraftDependencyPackage.graph().dirty = True
+            CraftDependencyPackage._ignoredCache[package.path] = ignored
+        return CraftDependencyPackage._ignoredCache[package.path]
 
-        self.state = CraftDependencyPackage.State.Visiting
-        for p in self.dependencies:
-            if p.state != CraftDependencyPackage.State.Unvisited:
+    @staticmethod
+    def __dependencyStates(package, depenendencyType, ignoredPackages):
+        """ yields the (package, depenendencyType) states the dependencies of package are resolved with """
+        packaging = depenendencyType & DependencyType.Packaging
+        withoutPackaging = depenendencyType & ~DependencyType.Packaging
+        for p in CraftDependencyPackage.__directDependencies(package, depenendencyType):
+            if p.path in ignoredPackages or CraftDependencyPackage.__isIgnored(p):
                 continue
-            if not p.isIgnored() \
-                    and (not ignoredPackages or p.path not in ignoredPackages):
-                depList.extend(p.__getDependencies(depenendencyType & ~DependencyType.Packaging, ignoredPackages))
-                if depenendencyType & DependencyType.Packaging:
-                    depList.extend(p.__getDependencies(depenendencyType, ignoredPackages))
+            yield p, withoutPackaging
+            if packaging:
+                # the packaging dependencies of our dependencies
+                yield p, depenendencyType
+
+    @staticmethod
+    def __resolve(package, depenendencyType, ignoredPackages) -> ({str : CraftPackageObject}, [(str, DependencyType, CraftPackageObject)], bool):
+        """
+        Resolves the dependencies of package in a single depth first search over (package, depenendencyType) states.
+
+        Returns the packages in the order they need to be installed, the visited states in post order and whether
+        the search was cut short by a dependency cycle.
+        The results of earlier searches are reused, each of them already contains all states reachable from its root.
+        """
+        depList = OrderedDict()
+        states = []
+        visited = set()
+        complete = True
 
-        if self.state != CraftDependencyPackage.State.Visited:
-            self.state = CraftDependencyPackage.State.Visited
-            if not self.isCategory():
-                depList.append(self)
-        return list(OrderedDict.fromkeys(depList))
+        def finish(path, t, p):
+            visited.add((path, t))
+            states.append((path, t, p))
+            if not p.isCategory() and path not in depList:
+                depList[path] = p
+
+        root = (package.path, depenendencyType)
+        stack = [(root, package, CraftDependencyPackage.__dependencyStates(package, depenendencyType, ignoredPackages))]
+        visiting = {root}
+        while stack:
+            state, p, dependencies = stack[-1]
+            for dep, t in dependencies:
+                key = (dep.path, t)
+                if key in visited:
+                    continue
+                if key in visiting:
+                    CraftCore.log.debug(f"Dependency cycle between {p} and {dep}")
+                    complete = False
+                    continue
+                cached = CraftDependencyPackage._closureCache.get((dep.path, t, ignoredPackages), None)
+                if cached:
+                    for cachedState in cached[1]:
+                        if cachedState[:2] not in visited:
+                            finish(*cachedState)
+                    continue
+                visiting.add(key)
+                stack.append((key, dep, CraftDependencyPackage.__dependencyStates(dep, t, ignoredPackages)))
+                break
+            else:
+                stack.pop()
+                visiting.remove(state)
+                finish(state[0], state[1], p)
+        return depList, states, complete
 
     def getDependencies(self, depType=DependencyType.All, ignoredPackages=None):
-        self.depenendencyType = depType
-        for p in CraftDependencyPackage._packageCache.values():
-            #reset visited state
-            p.state = CraftDependencyPackage.State.Unvisited
-        return self.__getDependencies(depType, ignoredPackages)
+        """ returns all dependencies, the result is memoized for the rest of the run """
+        if CraftDependencyPackage.__isIgnored(self):
+            return []
+        ignoredPackages = frozenset(ignoredPackages or [])
+        key = (self.path, depType, ignoredPackages)
+        if key in CraftDependencyPackage._closureCache:
+            depList = CraftDependencyPackage._closureCache[key][0]
+        else:
+            depList, states, complete = CraftDependencyPackage.__resolve(self, depType, ignoredPackages)
+            # results that were cut short by a cycle depend on where the search started
+            if complete and self.path:
+                CraftDependencyPackage._closureCache[key] = (depList, states)
+            CraftDependencyPackage.graph().save()
+        return [p if isinstance(p, CraftDependencyPackage) else CraftDependencyPackage(p) for p in depList.values()]
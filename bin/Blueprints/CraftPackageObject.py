@@ -24,18 +24,27 @@
 
 import copy
 import configparser
-import importlib
+import hashlib
+import importlib.machinery
+import importlib.util
+import marshal
 import os
+import pickle
 import re
+import sys
 
 import utils
 from CraftCore import CraftCore
 from CraftStandardDirs import CraftStandardDirs
 from CraftOS.osutils import OsUtils
+from Utils import CraftTimer
 
 
 class CategoryPackageObject(object):
-    def __init__(self, localPath : str):
+    def __init__(self, localPath : str, info : dict=None):
+        """
+        info is the content of the General section of the info.ini in localPath, see readInfo
+        """
         self.localPath = localPath
         self.description = ""
         self.webpage = ""
@@ -46,13 +55,11 @@ class CategoryPackageObject(object):
         self.pathOverride = None
         self.valid = False
 
-        ini = os.path.join(self.localPath, "info.ini")
-        if os.path.exists(ini):
+        if info is not None:
             self.valid = True
-            info = configparser.ConfigParser()
-            info.read(ini)
-            general = info["General"]
-            self.displayName = general.get("displayName", "")
+            # the keys of a ConfigParser are lower case
+            general = {key.lower(): value for key, value in info.items()}
+            self.displayName = general.get("displayname", "")
             self.description = general.get("description", "")
             self.tags = general.get("tags", "")
             self.webpage = general.get("webpage", "")
@@ -69,7 +76,17 @@ class CategoryPackageObject(object):
                 self.compiler = CraftCore.compiler.Compiler.NoCompiler
                 for c in compiler:
                     self.compiler |=  CraftCore.compiler.Compiler.fromString(c)
-            self.pathOverride = general.get("pathOverride", None)
+            self.pathOverride = general.get("pathoverride", None)
+
+    @staticmethod
+    def readInfo(localPath : str) -> dict:
+        """Returns the General section of the info.ini in localPath or None"""
+        ini = os.path.join(localPath, "info.ini")
+        if not os.path.exists(ini):
+            return None
+        info = configparser.ConfigParser()
+        info.read(ini)
+        return dict(info["General"])
 
     @property
     def isActive(self) -> bool:
@@ -89,6 +106,7 @@ class CraftPackageObject(object):
     _recipes = {}#all recipes, for lookup by package name
     IgnoredDirectories = {"__pycache__"}
     Ignores = re.compile("a^")
+    _INDEX_VERSION = 1
 
     @staticmethod
     def _isDirIgnored(d):
@@ -110,6 +128,8 @@ class CraftPackageObject(object):
         self.categoryInfo = None
         self._version = None
         self._instance = None
+        self._module = None
+        self._subinfo = None
         self.__path = None
         self.__blueprintRoot = None
 
@@ -163,7 +183,49 @@ class CraftPackageObject(object):
         return package
 
     @staticmethod
-    def _expandChildren(path, parent, blueprintRoot):
+    def _scanDirectory(path : str, cached : dict=None) -> dict:
+        """
+        Returns a serialisable description of the blueprint directory path.
+        Directories with the same modification time as in cached are not listed again,
+        so only changed sub trees are scanned.
+        """
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if cached and cached["mtime"] == mtime:
+            node = dict(cached)
+            if node["infoMtime"] is not None:
+                infoMtime = os.stat(os.path.join(path, "info.ini")).st_mtime_ns
+                if infoMtime != node["infoMtime"]:
+                    node["info"] = CategoryPackageObject.readInfo(path)
+                    node["infoMtime"] = infoMtime
+            node["dirs"] = {}
+            for f, child in cached["dirs"].items():
+                child = CraftPackageObject._scanDirectory(os.path.join(path, f), child)
+                if child:
+                    node["dirs"][f] = child
+            return node
+
+        CraftCore.log.debug(f"Scanning blueprint directory {path}")
+        cachedDirs = cached["dirs"] if cached else {}
+        node = {"mtime": mtime, "info": None, "infoMtime": None, "pyFiles": [], "dirs": {}}
+        for f in os.listdir(path):
+            fPath = os.path.join(path, f)
+            if os.path.isdir(fPath):
+                if not CraftPackageObject._isDirIgnored(f):
+                    child = CraftPackageObject._scanDirectory(fPath, cachedDirs.get(f, None))
+                    if child:
+                        node["dirs"][f] = child
+            elif f.endswith(".py"):
+                node["pyFiles"].append(f)
+            elif f == "info.ini":
+                node["info"] = CategoryPackageObject.readInfo(path)
+                node["infoMtime"] = os.stat(fPath).st_mtime_ns
+        return node
+
+    @staticmethod
+    def _expandChildren(path, parent, blueprintRoot, node, rootInfo):
         if path:
             path = utils.normalisePath(path)
             name = path.rsplit("/", 1)[-1]
@@ -180,38 +242,37 @@ class CraftPackageObject(object):
         package.__blueprintRoot = blueprintRoot
 
         if not package.categoryInfo:
-            package.categoryInfo = CategoryPackageObject(path)
+            package.categoryInfo = CategoryPackageObject(path, node["info"])
             if not package.categoryInfo.valid and package.parent:
                 if package.parent.__blueprintRoot == package.__blueprintRoot:
                     # we actually need a copy
                     package.categoryInfo = copy.copy(package.parent.categoryInfo)
                     if not package.categoryInfo.valid:
-                        package.categoryInfo = CategoryPackageObject(blueprintRoot)
+                        package.categoryInfo = CategoryPackageObject(blueprintRoot, rootInfo)
 
-        for f in os.listdir(path):
+        for f, childNode in node["dirs"].items():
             fPath = os.path.abspath(os.path.join(path, f))
-            if os.path.isdir(fPath):
-                if not CraftPackageObject._isDirIgnored(f):
-                    child = CraftPackageObject._expandChildren(fPath, package, blueprintRoot)
-                    if child:
-                        if f in package.children:
-                            existingNode = package.children[f]
-                            if not existingNode.isCategory():
-                                CraftCore.log.warning(
-                                    f"Blueprint clash detected: Ignoring {child.source} in favour of {existingNode.source}")
-                                continue
-                            else:
-                                #merge with existing node
-                                existingNode.children.update(child.children)
-                        else:
-                            package.children[f] = child
-            elif f.endswith(".py"):
-                if package.source:
-                    raise BlueprintException(f"Multiple py files in one directory: {package.source} and {f}", package)
-                if f[:-3] != package.name:
-                    raise BlueprintException(f"Recipes must match the name of the directory: {fPath}", package)
-                package.source = fPath
-                CraftPackageObject._allLeaves[package.path] = package
+            child = CraftPackageObject._expandChildren(fPath, package, blueprintRoot, childNode, rootInfo)
+            if child:
+                if f in package.children:
+                    existingNode = package.children[f]
+                    if not existingNode.isCategory():
+                        CraftCore.log.warning(
+                            f"Blueprint clash detected: Ignoring {child.source} in favour of {existingNode.source}")
+                        continue
+                    else:
+                        #merge with existing node
+                        existingNode.children.update(child.children)
+                else:
+                    package.children[f] = child
+        for f in node["pyFiles"]:
+            fPath = os.path.abspath(os.path.join(path, f))
+            if package.source:
+                raise BlueprintException(f"Multiple py files in one directory: {package.source} and {f}", package)
+            if f[:-3] != package.name:
+                raise BlueprintException(f"Recipes must match the name of the directory: {fPath}", package)
+            package.source = fPath
+            CraftPackageObject._allLeaves[package.path] = package
         if package.children and package.source:
             raise BlueprintException(f"{package} has has children but also a recipe {package.source}!", package)
 
@@ -226,6 +287,97 @@ class CraftPackageObject(object):
                 return None
         return package
 
+    @staticmethod
+    def _gitHead(path : str) -> str:
+        """Returns the commit checked out in the git repository path or None"""
+        gitDir = os.path.join(path, ".git")
+        if not os.path.isdir(gitDir):
+            return None
+        try:
+            with open(os.path.join(gitDir, "HEAD"), "rt", encoding="UTF-8") as f:
+                head = f.read().strip()
+            if not head.startswith("ref: "):
+                return head
+            ref = head[5:]
+            refFile = os.path.join(gitDir, ref)
+            if os.path.isfile(refFile):
+                with open(refFile, "rt", encoding="UTF-8") as f:
+                    return f.read().strip()
+            packedRefs = os.path.join(gitDir, "packed-refs")
+            if os.path.isfile(packedRefs):
+                with open(packedRefs, "rt", encoding="UTF-8") as f:
+                    for line in f:
+                        if line.rstrip().endswith(f" {ref}"):
+                            return line.split(" ", 1)[0]
+        except OSError as e:
+            CraftCore.log.debug(f"Failed to read the git HEAD of {path}: {e}")
+        # the symbolic ref can't be resolved, e.g. on an unborn branch
+        return None
+
+    @staticmethod
+    def _indexFile() -> str:
+        return os.path.join(CraftStandardDirs.etcBlueprintDir(), "blueprintIndex.pickle")
+
+    @staticmethod
+    def _loadIndex() -> dict:
+        indexFile = CraftPackageObject._indexFile()
+        if os.path.isfile(indexFile):
+            try:
+                with open(indexFile, "rb") as f:
+                    index = pickle.load(f)
+                if index.get("version", None) == CraftPackageObject._INDEX_VERSION:
+                    return index["roots"]
+            except Exception as e:
+                CraftCore.log.warning(f"Blueprint index corrupted: {e}")
+        return {}
+
+    @staticmethod
+    def _saveIndex(roots : dict) -> None:
+        indexFile = CraftPackageObject._indexFile()
+        try:
+            os.makedirs(os.path.dirname(indexFile), exist_ok=True)
+            tmpFile = f"{indexFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "wb") as f:
+                pickle.dump({"version": CraftPackageObject._INDEX_VERSION, "roots": roots}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpFile, indexFile)
+        except Exception as e:
+            CraftCore.log.warning(f"Failed to save the blueprint index {indexFile}: {e}")
+
+    @staticmethod
+    def _bytecodeFile(source : str) -> str:
+        name = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        return os.path.join(CraftStandardDirs.etcBlueprintDir(), "bytecode", f"{name}.{sys.implementation.cache_tag}.pyc")
+
+    @staticmethod
+    def _compileBlueprint(source : str):
+        """
+        Returns the code of a blueprint, the bytecode is cached in etc/blueprints/bytecode
+        together with the digest of the source and the magic number of the interpreter.
+        """
+        with open(source, "rb") as f:
+            data = f.read()
+        header = importlib.util.MAGIC_NUMBER + hashlib.sha256(data).digest()
+        bytecodeFile = CraftPackageObject._bytecodeFile(source)
+        if os.path.isfile(bytecodeFile):
+            try:
+                with open(bytecodeFile, "rb") as f:
+                    cached = f.read()
+                if cached.startswith(header):
+                    return marshal.loads(cached[len(header):])
+            except Exception as e:
+                CraftCore.log.debug(f"Failed to load the bytecode of {source}: {e}")
+        code = compile(data, source, "exec", dont_inherit=True)
+        try:
+            os.makedirs(os.path.dirname(bytecodeFile), exist_ok=True)
+            tmpFile = f"{bytecodeFile}.{os.getpid()}.tmp"
+            with open(tmpFile, "wb") as f:
+                f.write(header)
+                f.write(marshal.dumps(code))
+            os.replace(tmpFile, bytecodeFile)
+        except Exception as e:
+            CraftCore.log.debug(f"Failed to cache the bytecode of {source}: {e}")
+        return code
+
     @staticmethod
     def rootDirectories():
         # this function should return all currently set blueprint directories
@@ -276,48 +428,85 @@ class CraftPackageObject(object):
     @staticmethod
     def root():
         if not CraftPackageObject.__rootPackage:
-            if ("Blueprints", "Ignores") in CraftCore.settings:
-                CraftPackageObject.Ignores = re.compile("|".join([f"^{entry}$" for entry in CraftCore.settings.get("Blueprints", "Ignores").split(";")]))
-
-            CraftPackageObject.__rootPackage = root = CraftPackageObject()
-            root.name = "/"
-            for blueprintRoot in CraftPackageObject.rootDirectories():
-                if not os.path.isdir(blueprintRoot):
-                    CraftCore.log.warning(f"{blueprintRoot} does not exist")
-                    continue
-                blueprintRoot = utils.normalisePath(os.path.abspath(blueprintRoot))
-                # create a dummy package to load its children
-                child = CraftPackageObject._expandChildren(None, root, blueprintRoot)
-                root.children.update(child.children)
-            CraftPackageObject.__regiserNodes(root)
+            with CraftTimer.Tracer.span("Load blueprints", "blueprints"):
+                if ("Blueprints", "Ignores") in CraftCore.settings:
+                    CraftPackageObject.Ignores = re.compile("|".join([f"^{entry}$" for entry in CraftCore.settings.get("Blueprints", "Ignores").split(";")]))
+
+                CraftPackageObject.__rootPackage = root = CraftPackageObject()
+                root.name = "/"
+                index = CraftPackageObject._loadIndex()
+                newIndex = {}
+                for blueprintRoot in CraftPackageObject.rootDirectories():
+                    if not os.path.isdir(blueprintRoot):
+                        CraftCore.log.warning(f"{blueprintRoot} does not exist")
+                        continue
+                    blueprintRoot = utils.normalisePath(os.path.abspath(blueprintRoot))
+                    head = CraftPackageObject._gitHead(blueprintRoot)
+                    cached = index.get(blueprintRoot, None)
+                    if cached and cached["head"] != head:
+                        CraftCore.log.debug(f"{blueprintRoot} changed from {cached['head']} to {head}")
+                        cached = None
+                    node = CraftPackageObject._scanDirectory(blueprintRoot, cached["node"] if cached else None)
+                    newIndex[blueprintRoot] = {"head": head, "node": node}
+                    # create a dummy package to load its children
+                    child = CraftPackageObject._expandChildren(None, root, blueprintRoot, node, node["info"])
+                    root.children.update(child.children)
+                if newIndex != index:
+                    CraftPackageObject._saveIndex(newIndex)
+                CraftPackageObject.__regiserNodes(root)
         return CraftPackageObject.__rootPackage
 
     @property
-    def instance(self):
-        if not self._instance:
+    def module(self):
+        """the imported blueprint, importing it doesn't create the package"""
+        if not self._module:
             CraftCore.log.debug(f"module to import: {self.source} {self.path}")
             modulename = os.path.splitext(os.path.basename(self.source))[0].replace('.', '_')
-            loader = importlib.machinery.SourceFileLoader(modulename, self.source)
+            loader = _BlueprintLoader(modulename, self.source)
+            mod = importlib.util.module_from_spec(importlib.util.spec_from_file_location(modulename, self.source, loader=loader))
+            sys.modules[modulename] = mod
             try:
-                mod = loader.load_module()
+                loader.exec_module(mod)
             except Exception as e:
+                del sys.modules[modulename]
                 raise BlueprintException(f"Failed to load file {self.source}", self, e)
-            if not mod is None:
-                mod.CRAFT_CURRENT_MODULE = self
-                pack = mod.Package()
-                self._instance = pack
-            else:
-                raise BlueprintException("Failed to find package", self)
+            mod.CRAFT_CURRENT_MODULE = self
+            self._module = mod
+        return self._module
+
+    @property
+    def instance(self):
+        if not self._instance:
+            mod = self.module
+            # blueprints with the same file name share the module name
+            sys.modules[mod.__name__] = mod
+            self._instance = mod.Package()
         return self._instance
 
+    def adoptSubinfo(self, parent):
+        """Called by CraftBase, reuses the subinfo that was already created for the metadata"""
+        subinfo = self._subinfo
+        if not subinfo:
+            return self.module.subinfo(parent)
+        self._subinfo = None
+        subinfo.parent = parent
+        return subinfo
+
     @property
     def isInstalled(self) -> bool:
         return len(CraftCore.installdb.getInstalledPackages(self)) == 1
 
     @property
     def subinfo(self):
-        return self.instance.subinfo
-
+        """
+        The metadata of the package, the targets, dependencies, options and so on.
+        Unlike instance this doesn't create the package with its build system, source and packager.
+        """
+        if self._instance:
+            return self._instance.subinfo
+        if not self._subinfo:
+            self._subinfo = self.module.subinfo(_MetadataParent(self))
+        return self._subinfo
     def isCategory(self):
         return not self.source
 
@@ -345,7 +534,11 @@ class CraftPackageObject(object):
         if self.isCategory():
             return None
         if not self._version:
-            self._version = self.instance.version
+            if self._instance or getattr(self.module.Package, "version", None) is not _craftBaseVersion():
+                # the package might override the version, e.g. with the version of a system installation
+                self._version = self.instance.version
+            else:
+                self._version = self.subinfo.packageVersion
         return self._version
 
     def __eq__(self, other):
@@ -370,6 +563,29 @@ class CraftPackageObject(object):
         return recipes
 
 
+class _BlueprintLoader(importlib.machinery.SourceFileLoader):
+    """Loads the bytecode of blueprints from etc/blueprints/bytecode instead of __pycache__"""
+    def get_code(self, fullname):
+        return CraftPackageObject._compileBlueprint(self.path)
+
+
+class _MetadataParent(object):
+    """
+    The parent of a subinfo that was created without its package,
+    anything beside package is forwarded to the package which is created on demand.
+    """
+    def __init__(self, package : CraftPackageObject):
+        self.package = package
+
+    def __getattr__(self, name):
+        return getattr(self.package.instance, name)
+
+
+def _craftBaseVersion():
+    from CraftBase import CraftBase
+    return CraftBase.version
+
+
 class BlueprintException(Exception):
     def __init__(self, message, package, exception=None):
         Exception.__init__(self, message)
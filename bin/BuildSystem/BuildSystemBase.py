@@ -235,23 +235,23 @@ class BuildSystemBase(CraftBase):
 
         # Install pdb files on MSVC if they are not found next to the dll
         if CraftCore.compiler.isMSVC and (self.buildType() == "RelWithDebInfo" or self.buildType() == "Debug") and  CraftCore.cache.findApplication("peparser"):
-            files = utils.filterDirectoryContent(self.installDir(), lambda x, root: utils.isBinary(x.path),
-                                                 lambda x, root: True)
+            files = [f for f in utils.filterDirectoryContent(self.installDir(), lambda x, root: utils.isBinary(x.path),
+                                                             lambda x, root: True)
+                     if not os.path.exists(f"{os.path.splitext(f)[0]}.pdb")]
 
             regexp = re.compile('{.*} (.*)')
             exclude = re.compile(r'icudt[0-9]*.dll')
-            for f in files:
-                if not os.path.exists(f"{os.path.splitext(f)[0]}.pdb"):
-                    peparserOutput = CraftCore.cache.getCommandOutput("peparser", f"--pdb {f}")[1].strip()
-                    pdbs = regexp.findall(peparserOutput)
+            outputs = CraftCore.cache.getCommandOutputs([("peparser", f"--pdb {f}", None, [f]) for f in files])
+            for f, (_, peparserOutput) in zip(files, outputs):
+                pdbs = regexp.findall(peparserOutput.strip())
 
-                    if not exclude.match(os.path.basename(f)):
-                        assert len(pdbs) > 0, f"No pdb file available: {f}"
+                if not exclude.match(os.path.basename(f)):
+                    assert len(pdbs) > 0, f"No pdb file available: {f}"
 
-                    for pdb in pdbs:
-                        pdbDestination = os.path.join(os.path.dirname(f), os.path.basename(pdb))
+                for pdb in pdbs:
+                    pdbDestination = os.path.join(os.path.dirname(f), os.path.basename(pdb))
 
-                        CraftCore.log.info(f"Install pdb: {pdbDestination} for {os.path.basename(f)}")
-                        utils.copyFile(pdb, pdbDestination, linkOnly=False)
+                    CraftCore.log.info(f"Install pdb: {pdbDestination} for {os.path.basename(f)}")
+                    utils.copyFile(pdb, pdbDestination, linkOnly=False)
 
         return True
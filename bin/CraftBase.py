@@ -55,7 +55,7 @@ class CraftBase(object):
         mod = sys.modules[self.__module__]
         # ugly workaround we need to replace the constructor
         self.package = mod.CRAFT_CURRENT_MODULE  # type: CraftPackageObject
-        self.subinfo = mod.subinfo(self)
+        self.subinfo = self.package.adoptSubinfo(self)
 
         self.buildSystemType = None
 
@@ -154,15 +154,7 @@ class CraftBase(object):
 
     @property
     def version(self):
-        ver = self.subinfo.buildTarget
-        if CraftCore.settings.getboolean("BlueprintVersions", "EnableDailyUpdates", True)\
-                and self.subinfo.options.dailyUpdate and self.subinfo.hasSvnTarget():
-            ver += "-" + str(datetime.date.today()).replace("-", ".")
-        elif self.subinfo.options.dynamic.patchLevel:
-            ver += f"-{self.subinfo.options.dynamic.patchLevel}"
-        elif self.subinfo.buildTarget in self.subinfo.patchLevel:
-            ver += f"-{self.subinfo.patchLevel[self.subinfo.buildTarget]}"
-        return ver
+        return self.subinfo.packageVersion
 
     @property
     def rootdir(self):
@@ -22,12 +22,15 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
+import concurrent.futures
+import subprocess
 import tempfile
 
 import CraftBase
 from Blueprints.CraftDependencyPackage import CraftDependencyPackage, DependencyType
 from Blueprints.CraftVersion import CraftVersion
 from Blueprints.CraftPackageObject import CraftPackageObject
+from Utils.ArchiveStore import ArchiveStore
 from Utils.CraftTitleUpdater import CraftTitleUpdater
 from Utils import CraftTimer
 from options import *
@@ -77,6 +80,156 @@ def handlePackage(package, buildAction, directTargets):
                 return False
         return True
 
+def _directDependencies(package : CraftPackageObject) -> [CraftPackageObject]:
+    if package.isCategory():
+        return list(package.children.values())
+    subinfo = package.subinfo
+    names = list(subinfo.runtimeDependencies.keys()) + list(subinfo.buildDependencies.keys()) + list(subinfo.packagingDependencies.keys())
+    return [p for p in (CraftPackageObject.get(name) for name in names) if p]
+
+
+def _buildRequirements(packages : [CraftPackageObject]) -> {}:
+    """
+    Returns a dict mapping each package to the packages of the ordered build list it depends on.
+    Only packages that are located before the package in the build list are considered,
+    so the result is a dag even if the blueprints contain cycles.
+    """
+    position = {p.path: i for i, p in enumerate(packages)}
+    dependencies = {}
+    # Tarjan's algorithm, the packages of a cycle share one closure
+    index = {}
+    lowlink = {}
+    stack = []
+    closures = {}
+
+    def strongConnect(package):
+        index[package.path] = lowlink[package.path] = len(index)
+        stack.append(package.path)
+        dependencies[package.path] = _directDependencies(package)
+        for dep in dependencies[package.path]:
+            if dep.path not in index:
+                strongConnect(dep)
+                lowlink[package.path] = min(lowlink[package.path], lowlink[dep.path])
+            elif dep.path not in closures:
+                # dep is still on the stack, it belongs to the same component
+                lowlink[package.path] = min(lowlink[package.path], index[dep.path])
+        if lowlink[package.path] == index[package.path]:
+            component = set(stack[stack.index(package.path):])
+            del stack[len(stack) - len(component):]
+            # the components reached from this one are already complete
+            closure = set()
+            for member in component:
+                for dep in dependencies[member]:
+                    if dep.path in position:
+                        closure.add(dep.path)
+                    if dep.path not in component:
+                        closure |= closures[dep.path]
+            for member in component:
+                closures[member] = closure
+
+    for p in packages:
+        if p.path not in index:
+            strongConnect(p)
+
+    requirements = {}
+    for p in packages:
+        requirements[p.path] = {dep for dep in closures[p.path] if position[dep] < position[p.path]}
+    return requirements
+
+
+def _handlePackageInSubprocess(package, buildAction, args, directTargets) -> bool:
+    """Runs the actions for a single package in a separate craft process, the output is written to a log file"""
+    logFile = os.path.join(CraftCore.standardDirs.craftRoot(), "build", package.path, f"craft-{buildAction}.log")
+    utils.createDir(os.path.dirname(logFile))
+
+    # the scheduler already ordered the dependencies, the child must not build any of them,
+    # this keeps packages of a dependency cycle in the same order as a sequential build
+    command = [sys.executable, os.path.join(CraftCore.standardDirs.craftBin(), "craft.py"), "--ignoreInstalled",
+               "--ignore-dependencies", "--buildtype", CraftCore.settings.get("Compile", "BuildType")]
+    if buildAction != "all":
+        command += [f"--{buildAction}"]
+    if args.target and package in directTargets:
+        command += ["--target", args.target]
+    createCache = CraftCore.settings.getboolean("Packager", "CreateCache", False)
+    if createCache and CraftCore.settings.getboolean("Packager", "CacheDirectTargetsOnly", False):
+        createCache = package in directTargets
+    settings = {("General", "WorkOffline"): CraftCore.settings.getboolean("General", "WorkOffline", False),
+                ("Packager", "UseCache"): CraftCore.settings.getboolean("Packager", "UseCache", False),
+                ("Packager", "CreateCache"): createCache,
+                ("ContinuousIntegration", "Enabled"): CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False),
+                # don't recurse
+                ("General", "ConcurrentPackages"): 1}
+    traceFile = None
+    if CraftTimer.Tracer.enabled():
+        # the child writes its own trace, it is merged into ours when it is done
+        traceFile = f"{logFile}.trace.json"
+        settings[("CraftDebug", "TraceFile")] = traceFile
+        settings[("CraftDebug", "TraceSummary")] = 0
+    # our settings come last, they override the ones the user passed
+    for option in args.options:
+        command += ["--options", option]
+    for (section, key), value in settings.items():
+        command += ["--options", f"[{section}]{key}={value}"]
+    command += [package.path]
+
+    env = dict(os.environ)
+    env["CRAFT_NOTITLEUPDATE"] = "1"
+    CraftCore.log.info(f"Handling package: {package}, action: {buildAction}, log: {logFile}")
+    CraftCore.log.debug(f"executing command: {command!r}")
+    with open(logFile, "wt", encoding="UTF-8") as log:
+        result = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, env=env)
+    if traceFile:
+        CraftTimer.Tracer.merge(traceFile)
+    if result.returncode != 0:
+        CraftCore.log.error(f"Action: {buildAction} for {package} FAILED, see {logFile}")
+        return False
+    CraftCore.log.info(f"Action: {buildAction} for {package} succeeded")
+    return True
+
+
+def _runParallel(packages : [CraftPackageObject], buildAction : str, args, directTargets, jobs : int) -> bool:
+    """
+    Build packages on a pool of at most jobs workers,
+    a package is started as soon as all of its dependencies in packages are merged.
+    """
+    requirements = _buildRequirements(packages)
+    pending = list(packages)
+    done = set()
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        running = {}
+        while pending or running:
+            if not failed:
+                for p in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if requirements[p.path] <= done:
+                        pending.remove(p)
+                        running[pool.submit(_handlePackageInSubprocess, p, buildAction, args, directTargets)] = p
+            if not running:
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                p = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    CraftCore.log.error(f"Failed to run {buildAction} for {p}", exc_info=e)
+                    success = False
+                if success:
+                    done.add(p.path)
+                    # update the progress title
+                    packages.remove(p)
+                else:
+                    failed.append(p)
+    for p in failed:
+        CraftCore.log.error(f"fatal error: package {p} {buildAction} failed")
+    if not failed and pending:
+        CraftCore.log.error(f"fatal error: failed to schedule {[p.path for p in pending]}")
+        return False
+    return not failed
+
+
 def resolvePackage(packageNames : [str], version : str=None) -> [CraftPackageObject]:
     package = CraftPackageObject(None)
     def resolveChildren(child):
@@ -105,9 +258,9 @@ def setOption(packageNames : [str], option : str) -> bool:
         package = CraftPackageObject.get(name)
         if not package:
             raise BlueprintNotFoundException(name)
-        # create instance to make sure options are registered
+        # create the subinfo to make sure options are registered
         if not package.isCategory():
-            package.instance
+            package.subinfo
         if not package:
             raise BlueprintNotFoundException(name)
         options = UserOptions.get(package)
@@ -224,7 +377,7 @@ def run(package : [CraftPackageObject], action : str, args) -> bool:
 
     if action == "get":
         return invoke(args.get, directTargets)
-    elif args.resolve_deps or action in ["all", "install-deps"]:
+    elif not args.ignoreDependencies and (args.resolve_deps or action in ["all", "install-deps"]):
         # work on the dependencies
         depPackage = CraftDependencyPackage(package)
         if args.resolve_deps:
@@ -237,7 +390,8 @@ def run(package : [CraftPackageObject], action : str, args) -> bool:
             depType = DependencyType.Both
         else:
             depType = DependencyType.All
-        depList = depPackage.getDependencies(depType=depType)
+        with CraftTimer.Tracer.span(f"Resolve dependencies of {package}", "dependencies"):
+            depList = depPackage.getDependencies(depType=depType)
 
         packages = []
         if not args.resolve_deps:
@@ -256,6 +410,10 @@ def run(package : [CraftPackageObject], action : str, args) -> bool:
                 packages.remove(x)
 
         CraftTitleUpdater.usePackageProgressTitle(packages)
+        jobs = int(CraftCore.settings.get("General", "ConcurrentPackages", "1"))
+        if jobs > 1 and not args.probe and len(packages) > 1:
+            if not _runParallel(packages, "all" if action == "install-deps" else action, args, directTargets, jobs):
+                return False
         while packages:
             info = packages[0]
             # in case we only want to see which packages are still to be build, simply return the package name
@@ -318,6 +476,14 @@ def cleanBuildFiles(cleanArchives, cleanImages, cleanInstalledImages, cleanBuild
             for dir in glob.glob(builddirGlob):
                 cleanDir(dir)
 
+def evictArchiveStore(size : str) -> bool:
+    try:
+        maxSize = ArchiveStore.parseSize(size)
+    except ValueError as e:
+        CraftCore.log.error(e)
+        return False
+    return CraftCore.archiveStore.evict(maxSize)
+
 def updateInstalled(args) -> bool:
     package = CraftPackageObject(None)
     for packageName, _ in CraftCore.installdb.getDistinctInstalled():
@@ -137,7 +137,7 @@ class CraftCompiler(object):
         return "64" if self.isX64() else "32"
 
     def _getGCCTarget(self):
-        _, result = CraftCore.cache.getCommandOutput("gcc", "-dumpmachine")
+        _, result = CraftCore.cache.getCommandOutput("gcc", "-dumpmachine", persistent=True)
         if result:
             result = result.strip()
             CraftCore.log.debug(f"GCC Target Processor: {result}")
@@ -244,7 +244,7 @@ class CraftCompiler(object):
         return str(CraftCore.compiler)
 
     def getGCCLikeVersion(self, compilerExecutable):
-        _, result = CraftCore.cache.getCommandOutput(compilerExecutable, "--version")
+        _, result = CraftCore.cache.getCommandOutput(compilerExecutable, "--version", persistent=True)
         if result:
             result = re.findall("\d+\.\d+\.?\d*", result)[0]
             CraftCore.log.debug("{0} Version: {1}".format(compilerExecutable, result))
@@ -10,6 +10,7 @@ if False:
     from .CraftConfig import CraftConfig
     from .Utils.CraftCache import CraftCache
     from .InstallDB import InstallDB
+    from .Utils.ArchiveStore import ArchiveStore
 
 
 # TODO: a more optimal solution would be to initialize all singletons in a
@@ -57,6 +58,8 @@ class CraftCore(object):
     cache = AutoImport("cache", "Utils.CraftCache", "CraftCache", "_loadInstance")  # type: CraftCache
     compiler = AutoImport("compiler", "CraftCompiler")  # type: CraftCompiler
     installdb = AutoImport("installdb", "InstallDB")  # type: InstallDB
+    archiveStore = AutoImport("archiveStore", "Utils.ArchiveStore", "ArchiveStore")  # type: ArchiveStore
+    manifestIndex = AutoImport("manifestIndex", "Utils.CraftManifest", "ManifestIndex", "_loadInstance")  # type: ManifestIndex
 
     # information about the current internal state of Craft
     state = State()
@@ -4,6 +4,7 @@ from CraftConfig import *
 from CraftCore import CraftCore
 from CraftOS.osutils import OsUtils
 from CraftStandardDirs import CraftStandardDirs
+from Utils import CraftTimer
 
 
 class InstallPackage(object):
@@ -46,6 +47,7 @@ class InstallPackage(object):
         """ appends files to the list of files to be installed """
         self.fileDict.update(fileDict)
 
+    @CraftTimer.Tracer.traced("installdb")
     def getFilesWithHashes(self):
         """ get the list of files (filename, fileHash tuples) for the given package """
         cmd = '''SELECT filename, fileHash FROM fileList WHERE packageId=?;'''
@@ -53,6 +55,7 @@ class InstallPackage(object):
         self.cursor.execute(cmd, (self.packageId,))
         return self.cursor.fetchall()
 
+    @CraftTimer.Tracer.traced("installdb")
     def getFiles(self):
         """ get the list of files for the given package """
         cmd = '''SELECT filename FROM fileList WHERE packageId=?;'''
@@ -69,16 +72,19 @@ class InstallPackage(object):
         """ revert all changes made to the database, use with care """
         self.cursor.connection.rollback()
 
+    @CraftTimer.Tracer.traced("installdb")
     def uninstall(self):
         """ really uninstall that package """
-        cmd = '''DELETE FROM fileList WHERE packageId=?;'''
-        InstallDB.log("executing sqlcmd '%s' with parameter %s" % (cmd, str(self.packageId)))
-        self.cursor.execute(cmd, (self.packageId,))
-        cmd = '''DELETE FROM packageList WHERE packageId=?;'''
-        InstallDB.log("executing sqlcmd '%s' with parameter %s" % (cmd, str(self.packageId)))
-        self.cursor.execute(cmd, (self.packageId,))
-        self.cursor.connection.commit()
-
+        # the connection context commits both deletes at once or rolls them back on error
+        with self.cursor.connection:
+            cmd = '''DELETE FROM fileList WHERE packageId=?;'''
+            InstallDB.log("executing sqlcmd '%s' with parameter %s" % (cmd, str(self.packageId)))
+            self.cursor.execute(cmd, (self.packageId,))
+            cmd = '''DELETE FROM packageList WHERE packageId=?;'''
+            InstallDB.log("executing sqlcmd '%s' with parameter %s" % (cmd, str(self.packageId)))
+            self.cursor.execute(cmd, (self.packageId,))
+
+    @CraftTimer.Tracer.traced("installdb")
     def install(self):
         """ marking the package & package file list installed """
         fileNumber = len(self.fileDict)
@@ -88,13 +94,12 @@ class InstallPackage(object):
         dataList = list(zip([None] * fileNumber, [self.packageId] * fileNumber, list(self.fileDict.keys()),
                             list(self.fileDict.values())))
 
-        cmd = '''INSERT INTO fileList VALUES (?, ?, ?, ?)'''
-        InstallDB.log("executing sqlcmd '%s' %s times" % (cmd, len(self.fileDict)))
-        self.cursor.executemany(cmd, dataList)
-
-        # at last, commit all the changes so that they are committed only after everything is written to the
-        # database
-        self.cursor.connection.commit()
+        # the package entry created by addInstalled and the file list are committed in one transaction,
+        # so that they are committed only after everything is written to the database
+        with self.cursor.connection:
+            cmd = '''INSERT INTO fileList VALUES (?, ?, ?, ?)'''
+            InstallDB.log("executing sqlcmd '%s' %s times" % (cmd, len(self.fileDict)))
+            self.cursor.executemany(cmd, dataList)
 
     def getRevision(self):
         self.cursor.execute("SELECT revision FROM packageList WHERE packageId == ?", (self.packageId,))
@@ -110,7 +115,8 @@ class InstallPackage(object):
 
 
     def setCacheVersion(self, cacheVersion):
-        self.cursor.execute("UPDATE packageList SET cacheVersion = ? WHERE packageId == ?", (cacheVersion, self.packageId))
+        with self.cursor.connection:
+            self.cursor.execute("UPDATE packageList SET cacheVersion = ? WHERE packageId == ?", (cacheVersion, self.packageId))
 
 
 class InstallDB(object):
@@ -118,7 +124,7 @@ class InstallDB(object):
         checking its installation status.
         In case the database doesn't exist if the constructor is called, a new database is constructed
     """
-    SCHEMA_VERSION = 1
+    SCHEMA_VERSION = 3
 
     def __init__(self, filename=None):
         if filename == None:
@@ -135,11 +141,7 @@ class InstallDB(object):
     def getLastId(self):
         """ returns the last id from a table, which is essentially the  """
         cmd = '''SELECT max(packageId) FROM packageList;'''
-
-        cursor = self.connection.cursor()
-        cursor.execute(cmd)
-        lastId = cursor.fetchall()[0]
-        return lastId[0]
+        return self.connection.execute(cmd).fetchone()[0]
 
     def __constructWhereStmt(self, _dict):
         params = []
@@ -157,26 +159,25 @@ class InstallDB(object):
 
         return stmt, params
 
+    @CraftTimer.Tracer.traced("installdb")
     def isInstalled(self,  package, version=None):
         """ returns whether a package is installed. If version is empty, all versions will be checked. """
-        cmd = '''SELECT * FROM packageList'''
+        cmd = '''SELECT 1 FROM packageList'''
         stmt, params = self.__constructWhereStmt(
             {'prefix': None, 'packagePath': package, 'version': version})
         cmd += stmt
-        cmd += ''';'''
+        cmd += ''' LIMIT 1;'''
         InstallDB.log("executing sqlcmd '%s' with parameters: %s" % (cmd, tuple(params)))
 
-        cursor = self.connection.cursor()
-        cursor.execute(cmd, tuple(params))
-        installedPackage  = cursor.fetchall()
+        installedPackage = self.connection.execute(cmd, tuple(params)).fetchone()
         if installedPackage:
             InstallDB.log(f"""The package {package} has been installed with
                             version '{version}'.""")
         else:
             InstallDB.log(f"""Couldn't find a trace that the package {package} has been installed with version '{version}'""")
-        cursor.close()
         return bool(installedPackage)
 
+    @CraftTimer.Tracer.traced("installdb")
     def getDistinctInstalled(self, package=None):
         """ returns a list of the installed packages, which can be restricted by adding
             package.
@@ -186,13 +187,9 @@ class InstallDB(object):
         cmd += stmt
         cmd += ''';'''
         InstallDB.log("executing sqlcmd '%s' with parameters: %s" % (cmd, tuple(params)))
+        return self.connection.execute(cmd, tuple(params)).fetchall()
 
-        cursor = self.connection.cursor()
-        cursor.execute(cmd, tuple(params))
-        values = cursor.fetchall()
-        cursor.close()
-        return values
-
+    @CraftTimer.Tracer.traced("installdb")
     def getPackageIds(self, package):
         """ returns a list of the ids of the packages, which can be restricted by adding
             package.
@@ -202,24 +199,25 @@ class InstallDB(object):
         cmd += stmt
         cmd += ''';'''
         InstallDB.log("executing sqlcmd '%s' with parameters: %s" % (cmd, tuple(params)))
+        return [row[0] for row in self.connection.execute(cmd, tuple(params))]
 
-        cursor = self.connection.cursor()
-        cursor.execute(cmd, tuple(params))
-        values = []
-        for row in cursor:
-            values.append(row[0])
-        return values
-
+    @CraftTimer.Tracer.traced("installdb")
     def getPackagesForFileSearch(self, filename):
-        """ returns a list of tuple(InstallPackage(), filename) for packages providing a given file """
-
-        cursor = self.connection.cursor()
-        cmd = '''SELECT packageId, fileName FROM fileList WHERE filename LIKE ?;'''
+        """ returns a list of tuple(packagePath, version, filename) for packages providing a given file """
+        if self.hasFileSearchIndex:
+            # the trigram index is used for LIKE queries with at least 3 characters
+            cmd = '''SELECT packageList.packagePath, packageList.version, fileSearch.filename FROM fileSearch
+                       JOIN fileList ON fileList.fileId = fileSearch.rowid
+                       JOIN packageList ON packageList.packageId = fileList.packageId
+                       WHERE fileSearch.filename LIKE ?;'''
+        else:
+            cmd = '''SELECT packageList.packagePath, packageList.version, fileList.filename FROM fileList
+                       JOIN packageList ON packageList.packageId = fileList.packageId
+                       WHERE fileList.filename LIKE ?;'''
         InstallDB.log("executing sqlcmd '%s' with parameter %s" % (cmd, str(filename)))
-        cursor.execute(cmd, ("%" + filename + "%",))
-        rows = cursor.fetchall()
-        return [(InstallPackage(cursor, row[0]), row[1]) for row in rows]
+        return self.connection.execute(cmd, ("%" + filename + "%",)).fetchall()
 
+    @CraftTimer.Tracer.traced("installdb")
     def addInstalled(self, package, version, ignoreInstalled=False, revision="", cacheVersion=None):
         """ adds an installed package """
         cursor = self.connection.cursor()
@@ -229,7 +227,19 @@ class InstallDB(object):
         cmd = '''INSERT INTO packageList (packageId, packagePath, version, revision, cacheVersion) VALUES (?, ?, ?, ?, ?)'''
         InstallDB.log(f"executing sqlcmd {cmd!r} with parameters: {params}")
         cursor.execute(cmd, params)
-        return InstallPackage(cursor, self.getLastId())
+        return InstallPackage(cursor, cursor.lastrowid)
+
+    @CraftTimer.Tracer.traced("installdb")
+    def uninstallPackages(self, packages : [InstallPackage]):
+        """ uninstalls the packages in a single transaction, see InstallPackage.uninstall """
+        packageIds = [(package.packageId,) for package in packages]
+        with self.connection:
+            cmd = '''DELETE FROM fileList WHERE packageId=?;'''
+            InstallDB.log("executing sqlcmd '%s' with parameters %s" % (cmd, packageIds))
+            self.connection.executemany(cmd, packageIds)
+            cmd = '''DELETE FROM packageList WHERE packageId=?;'''
+            InstallDB.log("executing sqlcmd '%s' with parameters %s" % (cmd, packageIds))
+            self.connection.executemany(cmd, packageIds)
 
     def getInstalledPackages(self, package):
         """ return an installed package """
@@ -241,34 +251,102 @@ class InstallDB(object):
         return out
 
 
+    @CraftTimer.Tracer.traced("installdb")
     def _prepareDatabase(self):
         """ prepare a new database and add the required table layout """
         if not os.path.exists(self.dbfilename):
             if not os.path.exists(CraftStandardDirs.etcBlueprintDir()):
                 os.makedirs(CraftStandardDirs.etcBlueprintDir())
             self.connection = sqlite3.connect(self.dbfilename)
-            cursor = self.connection.cursor()
-
-            # first, create the required tables
-            cursor.execute('''CREATE TABLE packageList (packageId INTEGER PRIMARY KEY AUTOINCREMENT,
-                               prefix TEXT, packagePath TEXT, version TEXT, revision TEXT, cacheVersion TEXT)''')
-            cursor.execute('''CREATE TABLE fileList (fileId INTEGER PRIMARY KEY AUTOINCREMENT,
-                               packageId INTEGER, filename TEXT, fileHash TEXT)''')
-            cursor.execute(f'''PRAGMA user_version={InstallDB.SCHEMA_VERSION};''')
-            self.connection.commit()
+            self.__setJournalMode()
+            with self.connection:
+                # first, create the required tables
+                self.connection.execute('''CREATE TABLE packageList (packageId INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   prefix TEXT, packagePath TEXT, version TEXT, revision TEXT, cacheVersion TEXT)''')
+                self.connection.execute('''CREATE TABLE fileList (fileId INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   packageId INTEGER, filename TEXT, fileHash TEXT)''')
+                self.__createIndices()
+                self.__createFileSearchIndex()
+                self.connection.execute(f'''PRAGMA user_version={InstallDB.SCHEMA_VERSION};''')
         else:
             self.connection = sqlite3.connect(self.dbfilename)
+            self.__setJournalMode()
             self.__migrateDatabase()
-
+        self.hasFileSearchIndex = self.__checkFileSearchIndex()
+
+    def __setJournalMode(self):
+        # readers don't block the writer, so concurrent craft processes can query the database while a package is installed
+        self.connection.execute('''PRAGMA journal_mode=WAL;''')
+        self.connection.execute('''PRAGMA synchronous=NORMAL;''')
+
+    def __createIndices(self):
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS packageListPackagePath ON packageList (packagePath, prefix);''')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS fileListPackageId ON fileList (packageId);''')
+        self.connection.execute('''CREATE INDEX IF NOT EXISTS fileListFilename ON fileList (filename);''')
+
+    def __createFileSearchIndex(self):
+        """ creates a trigram index of the file names used by getPackagesForFileSearch """
+        # a failure must not abort the surrounding migration
+        self.connection.execute('''SAVEPOINT fileSearch;''')
+        try:
+            # the index is an external content table of fileList, the triggers keep it up to date
+            self.connection.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS fileSearch USING fts5(filename, content='fileList',
+                                       content_rowid='fileId', tokenize='trigram');''')
+            self.__createFileSearchTriggers()
+        except sqlite3.OperationalError as e:
+            # fts5 or its trigram tokenizer (sqlite 3.34) is not available
+            CraftCore.log.debug(f"Failed to create the file search index, falling back to a full scan: {e}")
+            self.connection.execute('''ROLLBACK TO fileSearch;''')
+        self.connection.execute('''RELEASE fileSearch;''')
+
+    def __createFileSearchTriggers(self):
+        self.connection.execute('''CREATE TRIGGER IF NOT EXISTS fileSearchInsert AFTER INSERT ON fileList BEGIN
+                                   INSERT INTO fileSearch (rowid, filename) VALUES (new.fileId, new.filename);
+                                   END;''')
+        self.connection.execute('''CREATE TRIGGER IF NOT EXISTS fileSearchDelete AFTER DELETE ON fileList BEGIN
+                                   INSERT INTO fileSearch (fileSearch, rowid, filename) VALUES ('delete', old.fileId, old.filename);
+                                   END;''')
+        self.connection.execute('''CREATE TRIGGER IF NOT EXISTS fileSearchUpdate AFTER UPDATE OF filename ON fileList BEGIN
+                                   INSERT INTO fileSearch (fileSearch, rowid, filename) VALUES ('delete', old.fileId, old.filename);
+                                   INSERT INTO fileSearch (rowid, filename) VALUES (new.fileId, new.filename);
+                                   END;''')
+        self.connection.execute('''INSERT INTO fileSearch (fileSearch) VALUES ('rebuild');''')
+
+    def __checkFileSearchIndex(self):
+        """ returns whether the file search index can be used by this sqlite """
+        if not self.connection.execute('''SELECT 1 FROM sqlite_master WHERE type='table' AND name='fileSearch';''').fetchone():
+            return False
+        triggers = {"fileSearchInsert", "fileSearchDelete", "fileSearchUpdate"}
+        existing = {row[0] for row in self.connection.execute('''SELECT name FROM sqlite_master WHERE type='trigger';''')}
+        try:
+            self.connection.execute('''SELECT rowid FROM fileSearch LIMIT 0;''')
+        except sqlite3.OperationalError as e:
+            # the database was created by a sqlite with fts5, without it the triggers would fail every change of fileList
+            CraftCore.log.debug(f"The file search index is not available, falling back to a full scan: {e}")
+            with self.connection:
+                for trigger in triggers & existing:
+                    self.connection.execute(f'''DROP TRIGGER {trigger};''')
+            return False
+        if not triggers.issubset(existing):
+            # the triggers were dropped by a sqlite without fts5, the index is outdated
+            with self.connection:
+                self.__createFileSearchTriggers()
+        return True
 
     def __migrateDatabase(self):
-        cursor = self.connection.cursor()
-        cursor.execute('''PRAGMA user_version;''')
-        version = cursor.fetchall()[0][0]
-        # TODO: drop prefix from packageList (will break compat)
-        if version < 1:
-            cursor.execute('''ALTER TABLE packageList ADD COLUMN cacheVersion TEXT;''')
-        cursor.execute(f'''PRAGMA user_version={InstallDB.SCHEMA_VERSION};''')
+        version = self.connection.execute('''PRAGMA user_version;''').fetchone()[0]
+        if version == InstallDB.SCHEMA_VERSION:
+            return
+        CraftCore.log.debug(f"Migrating {self.dbfilename} from schema version {version} to {InstallDB.SCHEMA_VERSION}")
+        with self.connection:
+            # TODO: drop prefix from packageList (will break compat)
+            if version < 1:
+                self.connection.execute('''ALTER TABLE packageList ADD COLUMN cacheVersion TEXT;''')
+            if version < 2:
+                self.__createIndices()
+            if version < 3:
+                self.__createFileSearchIndex()
+            self.connection.execute(f'''PRAGMA user_version={InstallDB.SCHEMA_VERSION};''')
 
 
 def printInstalled():
@@ -286,6 +364,5 @@ def printInstalled():
 
 def printPackagesForFileSearch(filename):
     packages = CraftCore.installdb.getPackagesForFileSearch(filename)
-    for pId, filename in packages:
-        path , version = pId.getPackageInfo()
+    for path, version, filename in packages:
         CraftCore.debug.printOut(f"{path}: {filename}")
@@ -5,10 +5,14 @@ from CraftBase import *
 from CraftCompiler import *
 from InstallDB import *
 from Blueprints.CraftPackageObject import *
-from Utils import CraftHash, GetFiles, CraftChoicePrompt
+from Utils import CraftArchive, CraftHash, GetFiles, CraftChoicePrompt
 from Utils.CraftManifest import CraftManifest
+from Utils.ArchiveStore import ArchiveStore
 
+import concurrent.futures
 import json
+import multiprocessing
+import stat
 
 class PackageBase(CraftBase):
     """
@@ -30,6 +34,8 @@ class PackageBase(CraftBase):
     def __init__(self):
         CraftCore.log.debug("PackageBase.__init__ called")
         CraftBase.__init__(self)
+        # whether qmerge may move the files out of the image dir
+        self._qmergeMoveImage = False
 
     def qmerge(self):
         """mergeing the imagedirectory into the filesystem"""
@@ -39,14 +45,16 @@ class PackageBase(CraftBase):
             self.unmerge()
 
         copiedFiles = []  # will be populated by the next call
-        if not utils.copyDir(self.imageDir(), CraftCore.standardDirs.craftRoot(), copiedFiles=copiedFiles):
+        digests = {}  # the digests of the copied files are computed while they are copied
+        if not utils.copyDir(self.imageDir(), CraftCore.standardDirs.craftRoot(), copiedFiles=copiedFiles,
+                             moveFiles=self._qmergeMoveImage, digests=digests):
             return False
 
         # add package to installed database -> is this not the task of the manifest files ?
 
         revision = self.sourceRevision()
         package = CraftCore.installdb.addInstalled(self.package, self.version, revision=revision)
-        fileList = self.getFileListFromDirectory(CraftCore.standardDirs.craftRoot(), copiedFiles)
+        fileList = self.getFileListFromDirectory(CraftCore.standardDirs.craftRoot(), copiedFiles, digests)
         package.addFiles(fileList)
         package.install()
 
@@ -60,10 +68,11 @@ class PackageBase(CraftBase):
         """unmergeing the files from the filesystem"""
         CraftCore.log.debug("Packagebase unmerge called")
         packageList = CraftCore.installdb.getInstalledPackages(self.package)
+        fileList = []
         for package in packageList:
-            fileList = package.getFilesWithHashes()
-            self.unmergeFileList(CraftCore.standardDirs.craftRoot(), fileList)
-            package.uninstall()
+            fileList.extend(package.getFilesWithHashes())
+        self.unmergeFileList(CraftCore.standardDirs.craftRoot(), fileList)
+        CraftCore.installdb.uninstallPackages(packageList)
         return True
 
     def cleanBuild(self) -> bool:
@@ -75,8 +84,9 @@ class PackageBase(CraftBase):
             CraftCore.log.debug("cleaning build dir: %s" % self.buildDir())
         return True
 
-    def strip(self, fileName):
-        """strip debugging informations from shared libraries and executables - mingw only!!! """
+    def strip(self, fileName, **kw):
+        """strip debugging informations from shared libraries and executables - mingw only!!!
+        kw are passed to utils.system"""
         if self.subinfo.options.package.disableStriping or CraftCore.compiler.isMSVC() or not CraftCore.compiler.isGCCLike():
             CraftCore.log.warning(f"Skipping stripping of {fileName} -- either disabled or unsupported with this compiler")
             return True
@@ -91,7 +101,7 @@ class PackageBase(CraftBase):
             CraftCore.log.warning("Please pass an absolute file path to strip")
             basepath = os.path.join(self.installDir())
             filepath = os.path.join(basepath, "bin", fileName)
-        return utils.system(["strip", "-s", filepath])
+        return utils.system(["strip", "-s", filepath], **kw)
 
     def createImportLibs(self, pkgName):
         """create the import libraries for the other compiler(if ANSI-C libs)"""
@@ -136,25 +146,14 @@ class PackageBase(CraftBase):
 
         for url in [self.cacheLocation()] + self.cacheRepositoryUrls():
             CraftCore.log.debug(f"Trying to restore {self} from cache: {url}.")
-            if url == self.cacheLocation():
-                fileUrl = f"{url}/manifest.json"
-                if os.path.exists(fileUrl):
-                    with open(fileUrl, "rt", encoding="UTF-8") as f:
-                        manifest = CraftManifest.fromJson(json.load(f))
-                else:
-                    continue
-            else:
-                manifest = CraftManifest.fromJson(CraftCore.cache.cacheJsonFromUrl(f"{url}/manifest.json"))
-            fileEntry = manifest.get(str(self)).files
-            files = []
-            for f in fileEntry:
-                if f.version == self.version:
-                    files.append(f)
-            latest = None
-            if not files:
+            # only the entry of this package is read from the index, the manifest is only parsed when it changed
+            entry = CraftCore.manifestIndex.entry(f"{url}/manifest.json", str(self))
+            if not entry:
+                continue
+            latest = entry.latestFor(self.version, CraftArchive.supportedFormats())
+            if not latest:
                 CraftCore.log.debug(f"Could not find {self}={self.version} in {url}")
                 continue
-            latest = files[0]
 
             if url != self.cacheLocation():
                 downloadFolder = self.cacheLocation(os.path.join(CraftCore.standardDirs.downloadDir(), "cache"))
@@ -164,17 +163,25 @@ class PackageBase(CraftBase):
             localArchivePath, localArchiveName = os.path.split(localArchiveAbsPath)
 
 
+            # files we download are verified while they are fetched, the store only contains verified files
+            verified = False
             if url != self.cacheLocation():
                 if not os.path.exists(localArchiveAbsPath):
-                    os.makedirs(localArchivePath, exist_ok=True)
-                    fUrl = f"{url}/{latest.fileName}"
-                    if not GetFiles.getFile(fUrl, localArchivePath, localArchiveName):
-                        CraftCore.log.warning(f"Failed to fetch {fUrl}")
-                        return False
+                    verified = ArchiveStore.enabled() and CraftCore.archiveStore.link(latest.checksum, localArchiveAbsPath)
+                    if not verified:
+                        os.makedirs(localArchivePath, exist_ok=True)
+                        fUrl = f"{url}/{latest.fileName}"
+                        if not GetFiles.getFile(fUrl, localArchivePath, localArchiveName,
+                                                digest=latest.checksum, digestAlgorithm=CraftHash.HashAlgorithm.SHA256):
+                            CraftCore.log.warning(f"Failed to fetch {fUrl}")
+                            return False
+                        verified = GetFiles.verifiesDigest(fUrl)
             elif not os.path.isfile(localArchiveAbsPath):
-                continue
+                if not (ArchiveStore.enabled() and CraftCore.archiveStore.link(latest.checksum, localArchiveAbsPath)):
+                    continue
+                verified = True
 
-            if not CraftHash.checkFilesDigests(localArchivePath, [localArchiveName],
+            if not verified and not CraftHash.checkFilesDigests(localArchivePath, [localArchiveName],
                                                digests=latest.checksum,
                                                digestAlgorithm=CraftHash.HashAlgorithm.SHA256):
                 CraftCore.log.warning(f"Hash did not match, {localArchiveName} might be corrupted")
@@ -183,55 +190,93 @@ class PackageBase(CraftBase):
                                                      default="Yes"):
                     return utils.deleteFile(localArchiveAbsPath) and self.fetchBinary(downloadRetriesLeft=downloadRetriesLeft-1)
                 return False
+            if ArchiveStore.enabled():
+                CraftCore.archiveStore.add(localArchiveAbsPath, latest.checksum)
             self.subinfo.buildPrefix = latest.buildPrefix
             if not (self.cleanImage()
                     and utils.unpackFile(localArchivePath, localArchiveName, self.imageDir())
                     and self.internalPostInstall()
-                    and self.postInstall()
-                    and self.qmerge()
-                    and self.internalPostQmerge()
-                    and self.postQmerge()):
+                    and self.postInstall()):
                 return False
-            return True
+            # the image is only used to install the cache, so its files can be moved into the craft root
+            self._qmergeMoveImage = True
+            try:
+                if not self.qmerge():
+                    return False
+            finally:
+                self._qmergeMoveImage = False
+            return (self.internalPostQmerge()
+                    and self.postQmerge()
+                    and self.cleanImage())
         return False
 
     @staticmethod
-    def getFileListFromDirectory(imagedir, filePaths):
-        """ create a file list containing hashes """
+    def getFileListFromDirectory(imagedir, filePaths, digests=None):
+        """ create a file list containing hashes, digests can contain the already known SHA256 digests of filePaths """
         ret = []
 
         algorithm = CraftHash.HashAlgorithm.SHA256
+        digests = dict(digests or {})
+        # the digests of the copied files are known, the moved files are hashed
+        CraftHash.cacheDigests(digests, algorithm)
+        missing = [filePath for filePath in filePaths if not digests.get(filePath, None)]
+        digests.update(zip(missing, CraftHash.digestFiles(missing, algorithm)))
         for filePath in filePaths:
             relativeFilePath = os.path.relpath(filePath, imagedir)
-            digest = algorithm.stringPrefix() + CraftHash.digestFile(filePath, algorithm)
-            ret.append((relativeFilePath, digest))
+            ret.append((relativeFilePath, algorithm.stringPrefix() + digests[filePath]))
         return ret
 
     @staticmethod
     def unmergeFileList(rootdir, fileList):
         """ delete files in the fileList if has matches """
+        toRemove = []
+        toVerify = {}
         for filename, filehash in fileList:
             fullPath = os.path.join(rootdir, os.path.normcase(filename))
-            if os.path.isfile(fullPath) or os.path.islink(fullPath):
-                if filehash:
-                    algorithm = CraftHash.HashAlgorithm.getAlgorithmFromPrefix(filehash)
-                    currentHash = algorithm.stringPrefix() + CraftHash.digestFile(fullPath, algorithm)
-                if not filehash or currentHash == filehash:
-                    OsUtils.rm(fullPath, True)
+            try:
+                mode = os.lstat(fullPath).st_mode
+            except OSError:
+                CraftCore.log.warning("file %s does not exist" % fullPath)
+                continue
+            if stat.S_ISDIR(mode):
+                continue
+            if filehash and (stat.S_ISREG(mode) or stat.S_ISLNK(mode)):
+                toVerify.setdefault(CraftHash.HashAlgorithm.getAlgorithmFromPrefix(filehash), []).append((fullPath, filehash))
+            else:
+                toRemove.append(fullPath)
+
+        # the digests of unchanged files are usually cached, the others are hashed concurrently
+        for algorithm, entries in toVerify.items():
+            currentHashes = CraftHash.digestFiles([fullPath for fullPath, _ in entries], algorithm)
+            for (fullPath, filehash), currentHash in zip(entries, currentHashes):
+                if algorithm.stringPrefix() + currentHash == filehash:
+                    toRemove.append(fullPath)
                 else:
                     CraftCore.log.warning(
                         f"We can't remove {fullPath} as its hash has changed,"
                         f" that usually implies that the file was modified or replaced")
-            elif not os.path.isdir(fullPath) and os.path.lexists(fullPath):
-                CraftCore.log.debug(f"Remove a dead symlink {fullPath}")
+
+        if len(toRemove) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+                list(pool.map(lambda fullPath: OsUtils.rm(fullPath, True), toRemove))
+        else:
+            for fullPath in toRemove:
                 OsUtils.rm(fullPath, True)
-            elif not os.path.isdir(fullPath):
-                CraftCore.log.warning("file %s does not exist" % fullPath)
 
+        # remove the directories that became empty, the deepest first so that their parents can be removed too
+        rootdir = os.path.normpath(rootdir)
+        containingDirs = set()
+        for fullPath in toRemove:
             containingDir = os.path.dirname(fullPath)
-            if os.path.exists(containingDir) and not os.listdir(containingDir):
-                CraftCore.log.debug(f"Delete empty dir {containingDir}")
-                utils.rmtree(containingDir)
+            while containingDir not in containingDirs and len(containingDir) > len(rootdir) and containingDir.startswith(rootdir):
+                containingDirs.add(containingDir)
+                containingDir = os.path.dirname(containingDir)
+        for containingDir in sorted(containingDirs, key=lambda d: d.count(os.path.sep), reverse=True):
+            try:
+                os.rmdir(containingDir)
+                CraftCore.log.debug(f"Deleted empty dir {containingDir}")
+            except OSError:
+                pass
 
 
     def runAction(self, command):
@@ -24,8 +24,11 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 
-import types
+import concurrent.futures
 import glob
+import io
+import multiprocessing
+import types
 
 from Packager.PackagerBase import *
 from Blueprints.CraftDependencyPackage import DependencyType, CraftDependencyPackage
@@ -198,7 +201,7 @@ class CollectionPackagerBase(PackagerBase):
         if utils.isBinary(filename):
             if not CraftCore.cache.findApplication("dependencies"):
                 raise BlueprintException("Deploying a QtSdk depends on dev-util/dependencies", CraftPackageObject.get("dev-util/dependencies"))
-            _, imports = CraftCore.cache.getCommandOutput("dependencies", f"-imports {filename}")
+            _, imports = CraftCore.cache.getCommandOutput("dependencies", f"-imports {filename}", inputFiles=[filename])
             rt = CollectionPackagerBase.reMsvcDebugRt.findall(imports)
             out = False
             if self.buildType() == "Debug":
@@ -210,26 +213,72 @@ class CollectionPackagerBase(PackagerBase):
             return out
         return True
 
+    @staticmethod
+    def _jobs() -> int:
+        return max(1, int(CraftCore.settings.get("Packager", "Jobs", str(multiprocessing.cpu_count()))))
+
+    def _copyFile(self, entry, entryTarget, strip) -> (bool, bool, bool, str):
+        """ copy and optionally strip a single file, returns whether it was copied, whether it is a binary,
+            whether it was stripped and the output of strip
+        """
+        if not self._filterQtBuildType(entry):
+            return True, False, True, ""
+        if not utils.copyFile(entry, entryTarget, linkOnly=False):
+            return False, False, False, ""
+        if not utils.isBinary(entryTarget):
+            return True, False, True, ""
+        if not strip:
+            return True, True, True, ""
+        # the output is captured, so the output of the concurrent strip processes isn't interleaved
+        output = io.StringIO()
+        return True, True, self.strip(entryTarget, stdout=output), output.getvalue()
+
     def copyFiles(self, srcDir, destDir, dontStrip) -> bool:
         """
             Copy the binaries for the Package from srcDir to the imageDir
             directory
+
+            The files are copied and stripped by [Packager]Jobs threads, the binaries are signed afterwards
+            in as few signtool calls as possible.
         """
         CraftCore.log.debug("Copying %s -> %s" % (srcDir, destDir))
 
         doSign = CraftCore.compiler.isWindows and CraftCore.settings.getboolean("CodeSigning", "Enabled", False)
-
-        for entry in utils.filterDirectoryContent(srcDir, self.whitelisted, self.blacklisted):
-            if not self._filterQtBuildType(entry):
-                continue
-            entry_target = os.path.join(destDir, os.path.relpath(entry, srcDir))
-            if not utils.copyFile(entry, entry_target, linkOnly=False):
-                return False
-            if utils.isBinary(entry_target):
-                if CraftCore.compiler.isGCCLike() and not dontStrip:
-                    self.strip(entry_target)
-                if doSign:
-                    utils.sign([entry_target])
+        strip = CraftCore.compiler.isGCCLike() and not dontStrip
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=CollectionPackagerBase._jobs()) as pool:
+            jobs = []
+            for entry in utils.filterDirectoryContent(srcDir, self.whitelisted, self.blacklisted):
+                entryTarget = os.path.join(destDir, os.path.relpath(entry, srcDir))
+                jobs.append((entryTarget, pool.submit(self._copyFile, entry, entryTarget, strip)))
+
+            failedCopies = []
+            failedStrips = []
+            binaries = []
+            # collect the results in the order of the directory content to keep the output deterministic
+            for entryTarget, job in jobs:
+                try:
+                    copied, isBinary, stripped, output = job.result()
+                except Exception as e:
+                    CraftCore.log.debug(f"Failed to copy {entryTarget}", exc_info=e)
+                    copied, isBinary, stripped, output = False, False, False, ""
+                if output:
+                    CraftCore.log.info(output.rstrip())
+                if not copied:
+                    failedCopies.append(entryTarget)
+                elif isBinary:
+                    binaries.append(entryTarget)
+                    if not stripped:
+                        failedStrips.append(entryTarget)
+
+        if failedStrips:
+            CraftCore.log.warning("Failed to strip:\n" + "\n".join(failedStrips))
+        if failedCopies:
+            CraftCore.log.error(f"Failed to copy {len(failedCopies)} files from {srcDir}:\n" + "\n".join(failedCopies))
+            return False
+        if doSign and binaries:
+            # like before the batching, a failed signing doesn't fail the packaging
+            utils.sign(binaries)
         return True
 
     def internalCreatePackage(self, seperateSymbolFiles=False) -> bool:
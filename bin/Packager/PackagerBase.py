@@ -9,6 +9,7 @@ import json
 from CraftBase import *
 
 from Utils import CraftHash
+from Utils.ArchiveStore import ArchiveStore
 from Utils.CraftManifest import *
 
 from CraftDebug import deprecated
@@ -45,7 +46,10 @@ class PackagerBase(CraftBase):
 
         manifest = CraftManifest.load(manifestLocation, urls=manifestUrls)
         entry = manifest.get(str(self))
-        entry.addFile(name, CraftHash.digestFile(archiveFile, CraftHash.HashAlgorithm.SHA256), version=self.version)
+        digest = CraftHash.digestFile(archiveFile, CraftHash.HashAlgorithm.SHA256)
+        entry.addFile(name, digest, version=self.version)
+        if CraftCore.settings.getboolean("Packager", "CreateCache") and ArchiveStore.enabled():
+            CraftCore.archiveStore.add(archiveFile, digest)
 
         manifest.dump(manifestLocation)
 
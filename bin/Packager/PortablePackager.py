@@ -22,17 +22,18 @@ Packager for portal 7zip archives
 
         srcDir = self.defines.get("srcdir", self.archiveDir())
 
-        if not self._compress(self.setupName, srcDir, self.packageDestinationDir()):
-            return False
-        CraftHash.createDigestFiles(self.setupName)
-
+        archives = [(self.setupName, srcDir)]
         if packageSymbols:
             dbgDir = f"{srcDir}-dbg"
             if os.path.exists(dbgDir):
                 dbgName = "{0}-dbg{1}".format(*os.path.splitext(self.setupName))
-                if not self._compress(dbgName, dbgDir, self.packageDestinationDir()):
-                    return False
-                CraftHash.createDigestFiles(dbgName)
+                archives.append((dbgName, dbgDir))
+
+        # the binaries and the debug symbols are compressed at the same time
+        if not self._compressAll(archives, self.packageDestinationDir()):
+            return False
+        for archiveName, _ in archives:
+            CraftHash.createDigestFiles(archiveName)
         return True
 
     def createPackage(self):
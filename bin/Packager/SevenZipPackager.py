@@ -30,7 +30,9 @@
 # This packager is in an experimental state - the implementation
 # and features may change in further versions
 
+import concurrent.futures
 import json
+import multiprocessing
 import subprocess
 
 from Packager.PackagerBase import *
@@ -44,22 +46,44 @@ class SevenZipPackager(PackagerBase):
     def __init__(self):
         PackagerBase.__init__(self)
 
+    def compressionProfile(self) -> str:
+        """ the compression profile of the package: fast, default or best """
+        return (self.subinfo.options.dynamic.compressionProfile
+                or self.subinfo.options.package.compressionProfile
+                or CraftCore.settings.get("Packager", "CompressionProfile", "default"))
+
     def _compress(self, archiveName, sourceDir, destDir, createDigests=True) -> bool:
-        archive = os.path.join(destDir, archiveName)
-        if not utils.compress(archive, sourceDir):
+        return self._compressAll([(archiveName, sourceDir)], destDir, createDigests=createDigests)
+
+    def _compressAll(self, archives : [(str, str)], destDir, createDigests=True) -> bool:
+        """
+        Creates the archives, a list of (archiveName, sourceDir), at the same time.
+        The manifest is updated afterwards in the order of archives.
+        """
+        profile = self.compressionProfile()
+        for archiveName, _ in archives:
+            utils.createDir(os.path.dirname(os.path.join(destDir, archiveName)))
+        # the compressors are multi threaded, share the cores instead of running each on all of them
+        threads = max(1, multiprocessing.cpu_count() // len(archives))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(archives)) as pool:
+            results = list(pool.map(lambda archive: utils.compress(os.path.join(destDir, archive[0]), archive[1], profile=profile, threads=threads),
+                                    archives))
+        if not all(results):
             return False
 
         if createDigests:
-            if not CraftCore.settings.getboolean("Packager", "CreateCache"):
-                self._generateManifest(destDir, archiveName)
-                CraftHash.createDigestFiles(archive)
-            else:
-                if CraftCore.settings.getboolean("ContinuousIntegration", "UpdateRepository", False):
-                    manifestUrls = [self.cacheRepositoryUrls()[0]]
+            for archiveName, _ in archives:
+                archive = os.path.join(destDir, archiveName)
+                if not CraftCore.settings.getboolean("Packager", "CreateCache"):
+                    self._generateManifest(destDir, archiveName)
+                    CraftHash.createDigestFiles(archive)
                 else:
-                    manifestUrls = None
-                self._generateManifest(destDir, archiveName, manifestLocation=self.cacheLocation(),
-                                    manifestUrls=manifestUrls)
+                    if CraftCore.settings.getboolean("ContinuousIntegration", "UpdateRepository", False):
+                        manifestUrls = [self.cacheRepositoryUrls()[0]]
+                    else:
+                        manifestUrls = None
+                    self._generateManifest(destDir, archiveName, manifestLocation=self.cacheLocation(),
+                                        manifestUrls=manifestUrls)
         return True
 
     def createPackage(self):
@@ -73,15 +97,19 @@ class SevenZipPackager(PackagerBase):
             dstpath = self.packageDestinationDir()
 
 
-        extention = CraftCore.settings.get("Packager", "7ZipArchiveType", "7z")
-        if extention == "7z" and CraftCore.compiler.isUnix:
-            if self.package.path == "dev-utils/7zip" or not CraftCore.cache.findApplication("7za"):
-                extention = "tar.xz"
-            else:
-                extention = "tar.7z"
+        extentions = [CraftCore.settings.get("Packager", "7ZipArchiveType", "7z")]
+        if cacheMode:
+            # the cache might provide each archive in several formats, the clients pick the fastest they support
+            extentions = CraftCore.settings.getList("Packager", "CacheArchiveTypes", extentions[0])
+        for i, extention in enumerate(extentions):
+            if extention == "7z" and CraftCore.compiler.isUnix:
+                if self.package.path == "dev-utils/7zip" or not CraftCore.cache.findApplication("7za"):
+                    extentions[i] = "tar.xz"
+                else:
+                    extentions[i] = "tar.7z"
 
-        if not self._compress(self.binaryArchiveName(fileType=extention, includePackagePath=cacheMode, includeTimeStamp=cacheMode), self.imageDir(), dstpath):
-            return False
+        # all formats of an archive share the name, including the time stamp
+        archives = [(self.binaryArchiveName(fileType=None, includePackagePath=cacheMode, includeTimeStamp=cacheMode), self.imageDir())]
         if not self.subinfo.options.package.packSources and CraftCore.settings.getboolean("Packager", "PackageSrc", "True"):
-            return self._compress(self.binaryArchiveName("-src", fileType=extention, includePackagePath=cacheMode, includeTimeStamp=cacheMode), self.sourceDir(), dstpath)
-        return True
+            archives.append((self.binaryArchiveName("-src", fileType=None, includePackagePath=cacheMode, includeTimeStamp=cacheMode), self.sourceDir()))
+        return self._compressAll([(f"{archiveName}.{extention}", sourceDir) for archiveName, sourceDir in archives for extention in extentions], dstpath)
@@ -105,21 +105,26 @@ class ArchiveSource(SourceBase):
             if self.subinfo.target():
                 # compat for scripts that provide multiple files
                 files = zip(self.subinfo.target(), self.subinfo.archiveName()) if isinstance(self.subinfo.target(), list) else [(self.subinfo.target(), self.subinfo.archiveName()[0])]
-                for url, fileName in files:
-                    if not GetFiles.getFile(url, self.__downloadDir, fileName):
-                        CraftCore.log.debug("failed to download files")
-                        return False
+                digests, algorithm = self.subinfo.targetDigest() if self.subinfo.hasTargetDigests() else ([], None)
+                downloads = []
+                for i, (url, fileName) in enumerate(files):
+                    # verify the files while they are downloaded
+                    digest = digests[i] if i < len(digests) else None
+                    downloads.append(GetFiles.Download(url, self.__downloadDir, fileName, digest, algorithm))
 
                 if self.subinfo.hasTargetDigestUrls():
                     if isinstance(self.subinfo.targetDigestUrl(), tuple):
                         url, alg = self.subinfo.targetDigestUrl()
-                        return GetFiles.getFile(url[0], self.__downloadDir, self.subinfo.archiveName()[0] + CraftHash.HashAlgorithm.fileEndings().get(alg))
+                        downloads.append(GetFiles.Download(url[0], self.__downloadDir, self.subinfo.archiveName()[0] + CraftHash.HashAlgorithm.fileEndings().get(alg)))
                     else:
                         for url in self.subinfo.targetDigestUrl():
-                            if not GetFiles.getFile(url, self.__downloadDir):
-                                return False
+                            downloads.append(GetFiles.Download(url, self.__downloadDir))
                 else:
                   CraftCore.log.debug("no digestUrls present")
+
+                if not GetFiles.getFiles(downloads):
+                    CraftCore.log.debug("failed to download files")
+                    return False
             if downloadRetriesLeft and not self.__checkFilesPresent(filenames):
                 return ArchiveSource.fetch(self, downloadRetriesLeft=downloadRetriesLeft - 1)
         return True
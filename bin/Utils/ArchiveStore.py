@@ -0,0 +1,170 @@
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+from CraftCore import CraftCore
+from CraftStandardDirs import CraftStandardDirs
+from Utils import CraftHash
+import utils
+
+
+class ArchiveStore(object):
+    """
+    A content addressed store for the binary cache archives.
+
+    Every archive is stored once as objects/<digest[:2]>/<digest>, the paths used by
+    CraftBase.cacheLocation are hard links to those objects.
+    The index keeps track of the links of each object and when it was used last,
+    so unused objects can be evicted.
+    """
+    SCHEMA_VERSION = 1
+
+    def __init__(self, root : str=None, downloadCacheDir : str=None):
+        if not root:
+            root = CraftCore.settings.get("Packager", "ArchiveStoreDir", os.path.join(CraftStandardDirs.downloadDir(), "store"))
+        self.root = root
+        # the downloaded cache archives, the only links evict may delete, they can be fetched again
+        self.downloadCacheDir = os.path.abspath(downloadCacheDir or os.path.join(CraftStandardDirs.downloadDir(), "cache"))
+        os.makedirs(self.root, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(self.root, "store.db"), timeout=60)
+        self.connection.execute('''PRAGMA journal_mode=WAL;''')
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS objects (digest TEXT PRIMARY KEY, size INTEGER, lastUsed REAL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS links (path TEXT PRIMARY KEY, digest TEXT)''')
+            self.connection.execute('''CREATE INDEX IF NOT EXISTS linksDigest ON links (digest);''')
+            self.connection.execute(f'''PRAGMA user_version={ArchiveStore.SCHEMA_VERSION};''')
+
+    @staticmethod
+    def enabled() -> bool:
+        return CraftCore.settings.getboolean("Packager", "UseArchiveStore", True)
+
+    def objectPath(self, digest : str) -> str:
+        digest = digest.lower()
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def contains(self, digest : str) -> bool:
+        return os.path.isfile(self.objectPath(digest))
+
+    def _isValid(self, digest : str) -> bool:
+        """Whether the object still has its digest, a corrupted object is removed"""
+        objectPath = self.objectPath(digest)
+        # the digest is cached for the stat of the object, so this only reads objects that were modified
+        if CraftHash.digestFile(objectPath, CraftHash.HashAlgorithm.SHA256) == digest:
+            return True
+        CraftCore.log.warning(f"The archive store object {objectPath} is corrupted, removing it")
+        with self.connection:
+            self.connection.execute('''DELETE FROM links WHERE digest = ?''', (digest,))
+            self.connection.execute('''DELETE FROM objects WHERE digest = ?''', (digest,))
+        utils.deleteFile(objectPath)
+        return False
+
+    @staticmethod
+    def _link(src : str, dest : str) -> bool:
+        """Replaces dest with a hard link to src, falls back to a copy"""
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f"{dest}.{os.getpid()}.tmp"
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            CraftCore.log.debug(f"Failed to create hardlink {dest} for {src}: {e}")
+            shutil.copy2(src, tmp)
+        os.replace(tmp, dest)
+        return True
+
+    def _addLink(self, path : str, digest : str, size : int) -> None:
+        with self.connection:
+            self.connection.execute('''INSERT OR REPLACE INTO objects (digest, size, lastUsed) VALUES (?, ?, ?)''',
+                                    (digest, size, time.time()))
+            self.connection.execute('''INSERT OR REPLACE INTO links (path, digest) VALUES (?, ?)''',
+                                    (os.path.abspath(path), digest))
+
+    def add(self, path : str, digest : str) -> bool:
+        """
+        Adds the verified file path with the sha256 digest to the store.
+        If the store already contains the content, path is replaced by a link to it.
+        """
+        digest = digest.lower()
+        objectPath = self.objectPath(digest)
+        try:
+            if not os.path.isfile(objectPath) or (not os.path.samefile(path, objectPath) and not self._isValid(digest)):
+                self._link(path, objectPath)
+            elif not os.path.samefile(path, objectPath):
+                self._link(objectPath, path)
+            self._addLink(path, digest, os.path.getsize(objectPath))
+        except OSError as e:
+            CraftCore.log.warning(f"Failed to add {path} to the archive store: {e}")
+            return False
+        return True
+
+    def link(self, digest : str, path : str) -> bool:
+        """Creates path from the verified object with digest, returns False if the store doesn't contain it"""
+        digest = digest.lower()
+        objectPath = self.objectPath(digest)
+        if not os.path.isfile(objectPath) or not self._isValid(digest):
+            return False
+        try:
+            self._link(objectPath, path)
+            self._addLink(path, digest, os.path.getsize(objectPath))
+        except OSError as e:
+            CraftCore.log.warning(f"Failed to restore {path} from the archive store: {e}")
+            return False
+        CraftCore.log.debug(f"Restored {path} from the archive store")
+        return True
+
+    def _pruneLinks(self) -> None:
+        """Removes links that were deleted or replaced"""
+        stale = []
+        for path, digest in self.connection.execute('''SELECT path, digest FROM links'''):
+            objectPath = self.objectPath(digest)
+            if not os.path.isfile(path) or not os.path.isfile(objectPath) or not os.path.samefile(path, objectPath):
+                stale.append((path,))
+        with self.connection:
+            self.connection.executemany('''DELETE FROM links WHERE path = ?''', stale)
+
+    def size(self) -> int:
+        return self.connection.execute('''SELECT COALESCE(SUM(size), 0) FROM objects''').fetchone()[0]
+
+    def _isDownloaded(self, path : str) -> bool:
+        return path.startswith(self.downloadCacheDir + os.path.sep)
+
+    def evict(self, maxSize : int) -> bool:
+        """
+        Removes the objects without links and then the least recently used ones until the store is smaller than maxSize.
+        Objects that are still linked from outside of the download cache, like the archives created by the packager, are kept.
+        """
+        self._pruneLinks()
+        size = self.size()
+        CraftCore.log.info(f"The archive store in {self.root} uses {size / 1024 ** 2:.1f} MiB")
+        if size <= maxSize:
+            return True
+        objects = self.connection.execute('''SELECT objects.digest, objects.size, COUNT(links.path) AS refCount FROM objects
+                                             LEFT JOIN links ON links.digest = objects.digest
+                                             GROUP BY objects.digest
+                                             ORDER BY refCount > 0, objects.lastUsed''').fetchall()
+        for digest, objectSize, refCount in objects:
+            if size <= maxSize:
+                break
+            links = [path for path, in self.connection.execute('''SELECT path FROM links WHERE digest = ?''', (digest,))]
+            if not all(self._isDownloaded(path) for path in links):
+                CraftCore.log.debug(f"Keeping {digest}, it is used by {links}")
+                continue
+            CraftCore.log.info(f"Evicting {digest} ({objectSize / 1024 ** 2:.1f} MiB, {refCount} links)")
+            with self.connection:
+                for path in links:
+                    utils.deleteFile(path)
+                self.connection.execute('''DELETE FROM links WHERE digest = ?''', (digest,))
+                self.connection.execute('''DELETE FROM objects WHERE digest = ?''', (digest,))
+            utils.deleteFile(self.objectPath(digest))
+            size -= objectSize
+        CraftCore.log.info(f"The archive store in {self.root} now uses {size / 1024 ** 2:.1f} MiB")
+        return True
+
+    @staticmethod
+    def parseSize(size : str) -> int:
+        """Parses sizes like 500M or 10G"""
+        match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", size, re.IGNORECASE)
+        if not match:
+            raise ValueError(f"Invalid size: {size}")
+        return int(float(match.group(1)) * 1024 ** " KMGT".index(match.group(2).upper() or " "))
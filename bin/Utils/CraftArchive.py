@@ -0,0 +1,367 @@
+import concurrent.futures
+import multiprocessing
+import os
+import re
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zipfile
+
+from CraftCore import CraftCore
+from CraftOS.osutils import OsUtils
+from Utils import CraftTimer
+
+
+# the archives we can read with the python modules, everything else is left to 7za
+_tarRe = re.compile(r".*\.(tar|tar\.gz|tgz|tar\.bz2|tbz2|tar\.xz|txz)$", re.IGNORECASE)
+_zipRe = re.compile(r".*\.zip$", re.IGNORECASE)
+# zstd is not part of python, the stream is decompressed by the zstd tool
+_zstdRe = re.compile(r".*\.(tar\.zst|tzst)$", re.IGNORECASE)
+
+# the compression levels of the profiles, fast trades the size of the archive for the time to create it
+_compressionProfiles = {"fast":    {"7z": 1, "xz": 1, "zstd": 1},
+                        "default": {"7z": 5, "xz": 6, "zstd": 3},
+                        "best":    {"7z": 9, "xz": 9, "zstd": 19}}
+
+# the formats of the binary cache, the ones that unpack fastest first
+_formats = ["tar.zst", "tar", "tar.gz", "zip", "tar.bz2", "tar.xz", "tar.7z", "7z"]
+
+# the amount of unpacked data waiting for the writers
+_maxPendingBytes = 64 * 1024 ** 2
+# bigger files are written while they are read from the stream
+_maxBufferedFile = 8 * 1024 ** 2
+_bufferSize = 1024 ** 2
+# tarfile copies its whole buffer on every read of the stream, keep it small
+_streamBufferSize = 64 * 1024
+
+
+class ExtractionError(Exception):
+    pass
+
+
+def archiveFormat(fileName : str) -> str:
+    """ the format of the archive fileName, like tar.zst """
+    for format in _formats:
+        if fileName.lower().endswith(f".{format}"):
+            return format
+    return os.path.splitext(fileName)[1][1:]
+
+
+def supportedFormats() -> [str]:
+    """ the archive formats we can unpack, the fastest first """
+    out = []
+    for format in _formats:
+        if format == "tar.zst":
+            if not canExtract(f"archive.{format}"):
+                continue
+        elif format in {"tar.7z", "7z"}:
+            if not CraftCore.cache.findApplication("7za"):
+                continue
+        out.append(format)
+    return out
+
+
+def canExtract(fileName : str) -> bool:
+    """ whether the archive can be unpacked without 7za """
+    if _zstdRe.match(fileName):
+        if not CraftCore.cache.findApplication("zstd"):
+            return False
+        fileName = "archive.tar"
+    if _tarRe.match(fileName):
+        # we can't create symlinks, let 7za resolve them
+        return not OsUtils.isWin() or OsUtils.supportsSymlinks()
+    return bool(_zipRe.match(fileName))
+
+
+def _jobs() -> int:
+    # writing is mostly waiting for the disk
+    return min(32, multiprocessing.cpu_count() + 4)
+
+
+class _Writer(object):
+    """
+    Writes the members of an archive to destdir.
+    The decompressed files are written in a bounded thread pool, so the stream can be decompressed while the files are written.
+    """
+    def __init__(self, destdir : str):
+        self.destdir = os.path.abspath(destdir)
+        self.files = 0
+        self.bytes = 0
+        self._realDest = os.path.realpath(self.destdir)
+        # in an empty destdir only the files we wrote ourselves need to be replaced
+        self._fresh = not os.path.isdir(self.destdir) or not os.listdir(self.destdir)
+        self._written = set()
+        self._checkedDirs = set()
+        self._dirModes = []
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=_jobs())
+        self._futures = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def path(self, name : str) -> str:
+        """ the destination of the member name, members must not leave destdir """
+        path = os.path.normpath(os.path.join(self.destdir, name))
+        if os.path.isabs(name) or (path != self.destdir and not path.startswith(self.destdir + os.path.sep)):
+            raise ExtractionError(f"Refusing to unpack {name} outside of {self.destdir}")
+        return path
+
+    def _isInside(self, realPath : str) -> bool:
+        return realPath == self._realDest or realPath.startswith(self._realDest + os.path.sep)
+
+    def _directory(self, path : str) -> None:
+        """ creates path, the directories of the archive must not point outside of destdir """
+        if path in self._checkedDirs:
+            return
+        if path == self.destdir:
+            os.makedirs(path, exist_ok=True)
+        else:
+            self._directory(os.path.dirname(path))
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                # don't write through symlinks, like the ones the archive created earlier
+                if os.path.islink(path):
+                    if not self._isInside(os.path.realpath(path)):
+                        raise ExtractionError(f"Refusing to unpack {path} through a symlink outside of {self.destdir}")
+                if not os.path.isdir(path):
+                    raise
+        self._checkedDirs.add(path)
+
+    def _prepare(self, path : str) -> None:
+        self._directory(os.path.dirname(path))
+        # the old file might be a hardlink into the install root, never write into it
+        self.wait(path)
+        if not self._fresh or path in self._written:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._written.add(path)
+
+    @staticmethod
+    def _setAttributes(path : str, mode : int, mtime : float) -> None:
+        if mode:
+            os.chmod(path, mode)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def directory(self, path : str, mode : int=None) -> None:
+        self._directory(path)
+        if mode:
+            # a read-only directory must be filled first
+            self._dirModes.append((path, mode))
+
+    def symlink(self, path : str, target : str) -> None:
+        self._prepare(path)
+        os.symlink(target, path)
+        self.files += 1
+
+    def hardlink(self, path : str, target : str) -> None:
+        self.wait(target)
+        # the target is only checked lexically by path(), a symlink the archive created earlier could lead outside of destdir
+        if os.path.islink(target):
+            raise ExtractionError(f"Refusing to create the hardlink {path} to the symlink {target}")
+        if not self._isInside(os.path.realpath(target)):
+            raise ExtractionError(f"Refusing to create the hardlink {path} to {target} outside of {self.destdir}")
+        self._prepare(path)
+        os.link(target, path)
+        self.files += 1
+
+    def _write(self, path : str, data : bytes, mode : int, mtime : float) -> None:
+        try:
+            with open(path, "wb") as out:
+                out.write(data)
+            _Writer._setAttributes(path, mode, mtime)
+        finally:
+            with self._condition:
+                self._pending -= len(data)
+                self._condition.notify_all()
+
+    def write(self, path : str, data : bytes, mode : int=None, mtime : float=None) -> None:
+        """ writes data in the pool, blocks while too much data is waiting to be written """
+        self._prepare(path)
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0 or self._pending + len(data) <= _maxPendingBytes)
+            self._pending += len(data)
+        self._futures[path] = self._pool.submit(self._write, path, data, mode, mtime)
+        self.files += 1
+        self.bytes += len(data)
+
+    def copy(self, path : str, source, mode : int=None, mtime : float=None) -> None:
+        """ copies the file object source to path in the current thread """
+        self._prepare(path)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(source, out, _bufferSize)
+            self.bytes += out.tell()
+        _Writer._setAttributes(path, mode, mtime)
+        self.files += 1
+
+    def submit(self, path : str, size : int, function, *args) -> None:
+        """ runs function(*args) in the pool to create the file path of size bytes, a later member with the same path waits for it """
+        self._prepare(path)
+        self._futures[path] = self._pool.submit(function, *args)
+        self.files += 1
+        self.bytes += size
+
+    def wait(self, path : str) -> None:
+        future = self._futures.pop(path, None)
+        if future:
+            future.result()
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        try:
+            for future in self._futures.values():
+                future.result()
+        finally:
+            self._futures = {}
+        for path, mode in reversed(self._dirModes):
+            os.chmod(path, mode)
+        self._dirModes = []
+
+    def abort(self) -> None:
+        for future in self._futures.values():
+            future.cancel()
+        self._pool.shutdown(wait=True)
+
+
+def _extractTar(archive : str, writer : _Writer, fileObj=None) -> None:
+    # "r|*" reads the archive as a stream, the decompression doesn't need to seek
+    with tarfile.open(archive, "r|*", fileobj=fileObj, bufsize=_streamBufferSize) as tar:
+        for member in tar:
+            path = writer.path(member.name)
+            mode = stat.S_IMODE(member.mode)
+            if member.isdir():
+                writer.directory(path, mode)
+            elif member.issym():
+                writer.symlink(path, member.linkname)
+            elif member.islnk():
+                writer.hardlink(path, writer.path(member.linkname))
+            elif member.isfile():
+                source = tar.extractfile(member)
+                if member.size > _maxBufferedFile:
+                    writer.copy(path, source, mode, member.mtime)
+                else:
+                    writer.write(path, source.read(), mode, member.mtime)
+            else:
+                CraftCore.log.debug(f"Skipping the special file {member.name}")
+
+
+def _extractZstd(archive : str, writer : _Writer) -> None:
+    zstd = CraftCore.cache.findApplication("zstd")
+    with subprocess.Popen([zstd, "--decompress", "--stdout", "--quiet", archive], stdout=subprocess.PIPE) as process:
+        try:
+            _extractTar(None, writer, fileObj=process.stdout)
+        except:
+            process.kill()
+            raise
+    if process.returncode != 0:
+        raise ExtractionError(f"{zstd} failed to decompress {archive}: {process.returncode}")
+
+
+def _extractZip(archive : str, writer : _Writer) -> None:
+    def extract(zipFile, info, path, mode, mtime):
+        with zipFile.open(info) as source, open(path, "wb") as out:
+            shutil.copyfileobj(source, out, _bufferSize)
+        _Writer._setAttributes(path, mode, mtime)
+
+    # the members are decompressed in the pool, ZipFile serializes the reads of the archive
+    with zipfile.ZipFile(archive) as zipFile:
+        for info in zipFile.infolist():
+            path = writer.path(info.filename)
+            unixMode = info.external_attr >> 16
+            if info.is_dir():
+                writer.directory(path, stat.S_IMODE(unixMode))
+            elif stat.S_ISLNK(unixMode):
+                writer.symlink(path, zipFile.read(info).decode("utf-8"))
+            else:
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                writer.submit(path, info.file_size, extract, zipFile, info, path, stat.S_IMODE(unixMode), mtime)
+        # the pool must be done before the archive is closed
+        writer.close()
+
+
+def extract(archive : str, destdir : str) -> bool:
+    """ unpacks a tar or zip archive to destdir without an external tool, returns False if the archive can't be read """
+    name = os.path.basename(archive)
+    writer = _Writer(destdir)
+    start = time.perf_counter()
+    try:
+        with CraftTimer.Tracer.span(f"Unpack {name}", "unpack"):
+            os.makedirs(destdir, exist_ok=True)
+            if _zipRe.match(archive):
+                _extractZip(archive, writer)
+            elif _zstdRe.match(archive):
+                _extractZstd(archive, writer)
+            else:
+                _extractTar(archive, writer)
+            writer.close()
+    except (tarfile.TarError, zipfile.BadZipFile, NotImplementedError, EOFError) as e:
+        # an unsupported compression or a broken archive, let the caller try 7za
+        writer.abort()
+        CraftCore.log.debug(f"Failed to unpack {archive} in process: {e}")
+        return False
+    except Exception:
+        writer.abort()
+        raise
+    duration = max(time.perf_counter() - start, 1e-6)
+    size = writer.bytes / 1024 ** 2
+    CraftCore.log.info(f"Unpacked {name}: {writer.files} files, {size:.1f} MiB in {duration:.2f}s ({size / duration:.1f} MiB/s)")
+    return True
+
+
+def compressionLevel(tool : str, profile : str) -> int:
+    """ the compression level of tool, one of 7z, xz or zstd, for the profile fast, default or best """
+    if profile not in _compressionProfiles:
+        CraftCore.log.warning(f"Unknown compression profile {profile}, valid profiles are {', '.join(_compressionProfiles)}")
+        profile = "default"
+    return _compressionProfiles[profile][tool]
+
+
+def canCreate(fileName : str) -> bool:
+    """ whether create supports the format of fileName """
+    return bool(_zstdRe.match(fileName))
+
+
+def _resetOwner(info : tarfile.TarInfo) -> tarfile.TarInfo:
+    # the user of the build machine is of no use to anybody unpacking the archive
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def create(archive : str, source : str, profile : str="default", threads : int=0) -> bool:
+    """ creates the tar.zst archive of the file or the content of the directory source, zstd compresses with threads cores, all if 0 """
+    zstd = CraftCore.cache.findApplication("zstd")
+    if not zstd:
+        CraftCore.log.error(f"Failed to create {archive}, zstd was not found")
+        return False
+    start = time.perf_counter()
+    written = 0
+    with CraftTimer.Tracer.span(f"Compress {os.path.basename(archive)}", "compress"):
+        with subprocess.Popen([zstd, f"-{compressionLevel('zstd', profile)}", f"--threads={threads}", "--quiet", "--force", "-o", archive], stdin=subprocess.PIPE) as process:
+            try:
+                with tarfile.open(fileobj=process.stdin, mode="w|", format=tarfile.PAX_FORMAT, bufsize=_streamBufferSize) as tar:
+                    if os.path.isfile(source):
+                        tar.add(source, arcname=os.path.basename(source), filter=_resetOwner)
+                    else:
+                        for name in sorted(os.listdir(source)):
+                            tar.add(os.path.join(source, name), arcname=name, filter=_resetOwner)
+                    written = tar.offset
+            except BrokenPipeError:
+                # zstd failed, we report its exit code
+                pass
+            except:
+                process.kill()
+                raise
+    if process.returncode != 0:
+        CraftCore.log.error(f"Failed to create {archive}, {zstd} returned {process.returncode}")
+        return False
+    duration = max(time.perf_counter() - start, 1e-6)
+    size = written / 1024 ** 2
+    CraftCore.log.info(f"Created {os.path.basename(archive)}: {size:.1f} MiB compressed to {os.path.getsize(archive) / 1024 ** 2:.1f} MiB"
+                       f" in {duration:.2f}s ({size / duration:.1f} MiB/s)")
+    return True
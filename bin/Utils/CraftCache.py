@@ -1,164 +1,313 @@
-import atexit
+import concurrent.futures
 import json
 import os
 import pickle
 import re
 import shutil
+import sqlite3
 import subprocess
 import tempfile
+import threading
 import time
 import urllib.error
 import urllib.request
 import sys
-from pathlib import Path
 
-from CraftCore import CraftCore, AutoImport
+from CraftCore import CraftCore
 
 from Blueprints.CraftVersion import CraftVersion
 from CraftOS.unix.osutils import OsUtils
 from CraftStandardDirs import CraftStandardDirs
 from Utils import GetFiles
 
-class CraftCache(object):
-    RE_TYPE = re.Pattern if sys.version_info >= (3,7) else re._pattern_type
-    _version = 9
-    _cacheLifetime = (60 * 60 * 24) * 1  # days
+class CacheNamespace(object):
+    """
+    A dict like view on the entries of one namespace of the CacheStore.
+    Entries are read from the database when they are accessed for the first time and are written one by one.
+    """
+    _missing = object()
+
+    def __init__(self, store, name : str, ttl : float):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self._entries = {}
 
-    class NonPersistentCache(object):
-        def __init__(self):
-            self.applicationLocations = {}
+    def _lookup(self, key):
+        if key not in self._entries:
+            self._entries[key] = self.store.get(self.name, key, CacheNamespace._missing)
+        return self._entries[key]
 
-    def __init__(self):
-        self.version = CraftCache._version
-        self.cacheCreationTime = time.time()
+    def __contains__(self, key):
+        return self._lookup(key) is not CacheNamespace._missing
 
-        self._outputCache = {}
-        self._helpCache = {}
-        self._versionCache = {}
-        self._nightlyVersions = {}
-        self._jsonCache = {}
-        # defined in blueprintSearch
-        self.availablePackages = None
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is CacheNamespace._missing:
+            raise KeyError(key)
+        return value
 
-        # non persistent cache
-        self._nonPersistentCache = CraftCache.NonPersistentCache()
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is CacheNamespace._missing else value
 
-    def __getstate__(self):
-        state = dict(self.__dict__)
-        del state["_nonPersistentCache"]
-        return state
+    def set(self, key, value, ttl : float=None):
+        self._entries[key] = value
+        self.store.set(self.name, key, value, ttl or self.ttl)
 
-    def __setstate__(self, state):
-        self.__dict__ = state
-        self._nonPersistentCache = CraftCache.NonPersistentCache()
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def update(self, entries : dict, ttl : float=None):
+        """sets all entries in a single transaction"""
+        self._entries.update(entries)
+        self.store.setMany(self.name, entries, ttl or self.ttl)
+
+    def clear(self):
+        self._entries.clear()
+        self.store.clear(self.name)
+
+
+class CacheStore(object):
+    """
+    The persistent part of the CraftCache, a sqlite database in etc/cache.sqlite.
+    Every entry has its own expiry date, concurrent craft processes only ever replace single entries.
+    """
+    SCHEMA_VERSION = 2
+
+    def __init__(self, filename : str=None):
+        self._lock = threading.Lock()
+        self.connection = None
+        if filename:
+            try:
+                self.connection = self._connect(filename)
+            except Exception as e:
+                CraftCore.log.warning(f"Failed to open the cache {filename}: {e}")
+        if not self.connection:
+            self.connection = self._connect(":memory:")
 
     @staticmethod
-    def _loadInstance():
-        utilsCache = CraftCache()
-        if os.path.exists(CraftCache._cacheFile()):
-            with open(CraftCache._cacheFile(), "rb") as f:
+    def _connect(filename : str) -> sqlite3.Connection:
+        # autocommit, every statement is its own transaction
+        connection = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("""PRAGMA journal_mode=WAL;""")
+        connection.execute("""PRAGMA synchronous=NORMAL;""")
+        if connection.execute("""PRAGMA user_version;""").fetchone()[0] != CacheStore.SCHEMA_VERSION:
+            CraftCore.log.debug("Clear cache")
+            connection.execute("""DROP TABLE IF EXISTS cache;""")
+            connection.execute("""CREATE TABLE cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB,
+                                  expires REAL NOT NULL, PRIMARY KEY (namespace, key));""")
+            connection.execute("""CREATE INDEX cacheExpires ON cache (expires);""")
+            connection.execute(f"""PRAGMA user_version={CacheStore.SCHEMA_VERSION};""")
+        connection.execute("""DELETE FROM cache WHERE expires < ?;""", (time.time(),))
+        return connection
+
+    def get(self, namespace : str, key, default=None):
+        with self._lock:
+            row = self.connection.execute("""SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires >= ?;""",
+                                          (namespace, repr(key), time.time())).fetchone()
+        if not row:
+            return default
+        try:
+            return pickle.loads(row[0])
+        except Exception as e:
+            CraftCore.log.debug(f"Cache entry {namespace}:{key!r} corrupted: {e}")
+            return default
+
+    def set(self, namespace : str, key, value, ttl : float) -> None:
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                self.connection.execute("""INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?);""",
+                                        (namespace, repr(key), data, time.time() + ttl))
+        except Exception as e:
+            CraftCore.log.warning(f"Failed to cache {namespace}:{key!r}: {e}")
+
+    def setMany(self, namespace : str, entries : dict, ttl : float) -> None:
+        try:
+            expires = time.time() + ttl
+            rows = [(namespace, repr(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), expires) for key, value in entries.items()]
+            with self._lock:
+                self.connection.execute("""BEGIN;""")
                 try:
-                    data = pickle.load(f)
-                except Exception as e:
-                    CraftCore.log.warning(f"Cache corrupted: {e}")
-                    return utilsCache
-
-            if data.version != CraftCache._version or (
-                time.time() - data.cacheCreationTime) > CraftCache._cacheLifetime:
-                CraftCore.log.debug("Clear cache")
+                    self.connection.executemany("""INSERT OR REPLACE INTO cache (namespace, key, value, expires) VALUES (?, ?, ?, ?);""", rows)
+                    self.connection.execute("""COMMIT;""")
+                except:
+                    self.connection.execute("""ROLLBACK;""")
+                    raise
+        except Exception as e:
+            CraftCore.log.warning(f"Failed to cache {len(entries)} entries in {namespace}: {e}")
+
+    def clear(self, namespace : str=None) -> None:
+        with self._lock:
+            if namespace:
+                self.connection.execute("""DELETE FROM cache WHERE namespace = ?;""", (namespace,))
             else:
-                utilsCache = data
-        return utilsCache
+                self.connection.execute("""DELETE FROM cache;""")
+
+
+class CraftCache(object):
+    RE_TYPE = re.Pattern if sys.version_info >= (3,7) else re._pattern_type
+    _cacheLifetime = (60 * 60 * 24) * 1  # days
+    # failed lookups are retried earlier
+    _failureLifetime = 60 * 60
+    # the results that only depend on a tool, like its version, are invalidated by its fingerprint
+    _probeLifetime = float("inf")
+    # the digests are invalidated by the stat of the file, the lifetime only removes the entries of deleted files
+    _digestLifetime = (60 * 60 * 24) * 30
+
+    def __init__(self, store : CacheStore=None):
+        self.store = store or CacheStore()
+
+        self._outputCache = CacheNamespace(self.store, "output", CraftCache._cacheLifetime)
+        self._helpCache = CacheNamespace(self.store, "help", CraftCache._cacheLifetime)
+        self._versionCache = CacheNamespace(self.store, "version", CraftCache._cacheLifetime)
+        self._nightlyVersions = CacheNamespace(self.store, "nightly", CraftCache._cacheLifetime)
+        self._jsonCache = CacheNamespace(self.store, "json", CraftCache._cacheLifetime)
+        self._applicationCache = CacheNamespace(self.store, "application", CraftCache._probeLifetime)
+        self._digestCache = CacheNamespace(self.store, "digest", CraftCache._digestLifetime)
+        # the mtimes of the directories in PATH, not persisted
+        self._directoryMtimes = {}
 
     @staticmethod
-    def _cacheFile():
-        return os.path.join(CraftStandardDirs.etcDir(), "cache.pickle")
+    def _loadInstance():
+        cacheFile = CraftCache._cacheFile()
+        # the cache used to be pickled as a whole
+        oldCache = os.path.join(CraftStandardDirs.etcDir(), "cache.pickle")
+        if os.path.exists(oldCache):
+            os.remove(oldCache)
+        return CraftCache(CacheStore(cacheFile if os.path.isdir(os.path.dirname(cacheFile)) else None))
 
     @staticmethod
-    @atexit.register
-    def _save():
-        try:
-            if not os.path.isdir(os.path.dirname(CraftCache._cacheFile())):
-                return
-            if isinstance(CraftCore.cache, AutoImport):
-                return
-            with open(CraftCache._cacheFile(), "wb") as f:
-                pick = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
-                pick.dump(CraftCore.cache)
-        except Exception as e:
-            CraftCore.log.warning(f"Failed to save cache {e}", exc_info=e, stack_info=True)
-            os.remove(CraftCache._cacheFile())
+    def _cacheFile():
+        return os.path.join(CraftStandardDirs.etcDir(), "cache.sqlite")
 
     def clear(self):
         CraftCore.log.debug("Clear utils cache")
-        CraftCore.cache = CraftCache()
+        self.store.clear()
+        CraftCore.cache = CraftCache(self.store)
+
+    def _pathFingerprint(self, path : str=None) -> tuple:
+        """
+        The directories searched by shutil.which with their mtimes, adding or removing an executable changes them.
+        Only the directories in the craft root are expected to change during a run, the others are stat'ed once.
+        """
+        directories = (path or os.environ.get("PATH", os.defpath)).split(os.pathsep)
+        if OsUtils.isWin():
+            # which also searches the current directory and expands PATHEXT
+            directories.insert(0, os.getcwd())
+        craftRoot = CraftCore.standardDirs.craftRoot()
+        fingerprint = []
+        for directory in directories:
+            if directory not in self._directoryMtimes or directory.startswith(craftRoot):
+                try:
+                    self._directoryMtimes[directory] = os.stat(directory).st_mtime_ns
+                except OSError:
+                    self._directoryMtimes[directory] = None
+            fingerprint.append((directory, self._directoryMtimes[directory]))
+        if OsUtils.isWin():
+            fingerprint.append(os.environ.get("PATHEXT", ""))
+        return tuple(fingerprint)
 
     def findApplication(self, app, path=None) -> str:
-        if app in self._nonPersistentCache.applicationLocations:
-            appLocation = self._nonPersistentCache.applicationLocations[app]
-            if os.path.exists(appLocation):
-                return appLocation
-            else:
-                self._helpCache.clear()
+        if os.path.dirname(app):
+            # nothing to search
+            return shutil.which(app, path=path)
+        fingerprint = self._pathFingerprint(path)
+        cached = self._applicationCache.get((app, path))
+        if cached and cached[0] == fingerprint and (not cached[1] or os.path.isfile(cached[1])):
+            return cached[1]
 
         appLocation = shutil.which(app, path=path)
         if appLocation:
             if OsUtils.isWin():
                 # prettify command
-                path, ext = os.path.splitext(appLocation)
-                appLocation = path + ext.lower()
-            if Path(CraftCore.standardDirs.craftRoot()) in Path(appLocation).parents:
-                CraftCore.log.debug(f"Adding {app} to app cache {appLocation}")
-                self._nonPersistentCache.applicationLocations[app] = appLocation
+                appPath, ext = os.path.splitext(appLocation)
+                appLocation = appPath + ext.lower()
+            CraftCore.log.debug(f"Adding {app} to app cache {appLocation}")
         else:
             CraftCore.log.debug(f"Craft was unable to locate: {app}, in {path}")
-            return None
+        self._applicationCache.set((app, path), (fingerprint, appLocation), ttl=CraftCache._probeLifetime)
         return appLocation
 
-    def getCommandOutput(self, app:str, command:str, testName:str=None) -> (int, str):
+    @staticmethod
+    def _fingerprint(path : str) -> tuple:
+        """identifies the content of a file by its resolved path, size, mtime and inode"""
+        path = os.path.realpath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return (path, None)
+        return (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def getCommandOutput(self, app:str, command:str, testName:str=None, inputFiles:[str]=None, persistent:bool=False) -> (int, str):
+        """
+        The results are valid until app or one of the inputFiles changes, but at most for a day.
+        If the output only depends on app, like its version, persistent keeps it until app changes.
+        """
         if not testName:
             testName = f"\"{app}\" {command}"
         app = self.findApplication(app)
         if not app:
             return (-1, None)
-        if testName not in self._outputCache:
-            CraftCore.log.debug(f"\"{app}\" {command}")
-            # TODO: port away from shell=True
-            completeProcess = subprocess.run(f"\"{app}\" {command}",
-                                             shell=True,
-                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                             universal_newlines=True, errors="backslashreplace")
-            CraftCore.log.debug(f"{testName} Result: ExitedCode: {completeProcess.returncode} Output: {completeProcess.stdout}")
-            self._outputCache[testName] = (completeProcess.returncode, completeProcess.stdout)
-        return self._outputCache[testName]
+        fingerprint = tuple(CraftCache._fingerprint(f) for f in [app] + (inputFiles or []))
+        cached = self._outputCache.get(testName)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        CraftCore.log.debug(f"\"{app}\" {command}")
+        # TODO: port away from shell=True
+        completeProcess = subprocess.run(f"\"{app}\" {command}",
+                                         shell=True,
+                                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                         universal_newlines=True, errors="backslashreplace")
+        CraftCore.log.debug(f"{testName} Result: ExitedCode: {completeProcess.returncode} Output: {completeProcess.stdout}")
+        result = (completeProcess.returncode, completeProcess.stdout)
+        self._outputCache.set(testName, (fingerprint, result), ttl=CraftCache._probeLifetime if persistent else CraftCache._cacheLifetime)
+        return result
+
+    def getCommandOutputs(self, probes : [tuple]) -> [(int, str)]:
+        """
+        Calls getCommandOutput with each of the argument tuples in probes,
+        the probes that are not cached yet run concurrently.
+        """
+        if len(probes) < 2:
+            return [self.getCommandOutput(*probe) for probe in probes]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(probes), os.cpu_count() or 1)) as pool:
+            return list(pool.map(lambda probe: self.getCommandOutput(*probe), probes))
 
     # TODO: rename, cleanup
     def checkCommandOutputFor(self, app, command, helpCommand="-h") -> str:
-        if not (app, command) in self._helpCache:
-            _, output = self.getCommandOutput(app, helpCommand)
+        appLocation = self.findApplication(app)
+        fingerprint = CraftCache._fingerprint(appLocation) if appLocation else None
+        cached = self._helpCache.get((app, command))
+        if not cached or cached[0] != fingerprint:
+            _, output = self.getCommandOutput(app, helpCommand, persistent=True)
             if not output:
                 return False
             if type(command) == str:
                 supports = command in output
             else:
                 supports = command.match(output) is not None
-            self._helpCache[(app, command)] = supports
+            cached = (fingerprint, supports)
+            self._helpCache.set((app, command), cached, ttl=CraftCache._probeLifetime)
             CraftCore.log.debug("%s %s %s" % (app, "supports" if supports else "does not support", command))
-        return self._helpCache[(app, command)]
+        return cached[1]
 
     def getVersion(self, app, pattern=None, versionCommand=None) -> CraftVersion:
         app = self.findApplication(app)
         if not app:
             return None
-        if app in self._versionCache:
-            return self._versionCache[app]
+        fingerprint = CraftCache._fingerprint(app)
+        cached = self._versionCache.get(app)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
         if not pattern:
             pattern = re.compile(r"(\d+\.\d+(?:\.\d+)?)")
         if not versionCommand:
             versionCommand = "--version"
         if not isinstance(pattern, CraftCache.RE_TYPE):
             raise Exception("getVersion can only handle a compiled regular expression as pattern")
-        _, output = self.getCommandOutput(app, versionCommand)
+        _, output = self.getCommandOutput(app, versionCommand, persistent=True)
         if not output:
             return None
         match = pattern.search(output)
@@ -166,10 +315,17 @@ class CraftCache(object):
             CraftCore.log.warning(f"Could not detect pattern: {pattern.pattern} in {output}")
             return None
         appVersion = CraftVersion(match.group(1))
-        self._versionCache[app] = appVersion
+        self._versionCache.set(app, (fingerprint, appVersion), ttl=CraftCache._probeLifetime)
         CraftCore.log.debug(f"getVersion: {app}[{appVersion}]")
         return appVersion
 
+    def getDigest(self, key : tuple) -> str:
+        """returns a digest stored with cacheDigests, key identifies the file and the algorithm"""
+        return self._digestCache.get(key)
+
+    def cacheDigests(self, digests : {tuple : str}) -> None:
+        self._digestCache.update(digests)
+
     def cacheJsonFromUrl(self, url, timeout=10) -> object:
         CraftCore.log.debug(f"Fetch Json: {url}")
         if not url in self._jsonCache:
@@ -181,7 +337,7 @@ class CraftCache(object):
                 with tempfile.TemporaryDirectory() as tmp:
                     if not GetFiles.getFile(url, tmp, "manifest.json", quiet=True):
                         # TODO: provide the error code and only cache 404...
-                        self._jsonCache[url] = {}
+                        self._jsonCache.set(url, {}, ttl=CraftCache._failureLifetime)
                         return {}
                     with open(os.path.join(tmp, "manifest.json"), "rt", encoding="UTF-8") as jsonFile:
                         self._jsonCache[url] = json.loads(jsonFile.read())
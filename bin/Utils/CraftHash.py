@@ -1,9 +1,13 @@
+import concurrent.futures
 import hashlib
+import multiprocessing
 import os
 import re
+import time
 from enum import Enum
 
 from CraftCore import CraftCore
+from Utils import CraftTimer
 
 
 class HashAlgorithm(Enum):
@@ -43,19 +47,155 @@ def digestString(string : str, algorithm=HashAlgorithm.SHA256)-> str:
     hash.update(bytes(string, "UTF-8"))
     return hash.hexdigest()
 
+# hashlib releases the GIL for large updates, so the files can be hashed by threads
+_blockSize = 1024 * 1024
+
+
+def _parallelMap(function, items : list) -> list:
+    """ calls function for each of items in a thread pool, returns the results in the order of items """
+    items = list(items)
+    jobs = min(len(items), multiprocessing.cpu_count())
+    if jobs < 2:
+        return [function(item) for item in items]
+    # hand out the items in chunks, hashing small files takes less time than scheduling them
+    chunkSize = max(1, len(items) // (jobs * 4))
+    chunks = [items[i:i + chunkSize] for i in range(0, len(items), chunkSize)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return [result for chunk in pool.map(lambda chunk: [function(item) for item in chunk], chunks) for result in chunk]
+
+
+@CraftTimer.Tracer.traced("hash")
+def _readDigests(filepath, algorithms : [HashAlgorithm]) -> {HashAlgorithm : str}:
+    hashes = {algorithm: getattr(hashlib, algorithm.name.lower())() for algorithm in algorithms}
+    if os.path.islink(filepath):
+        target = os.readlink(filepath).encode("utf-8")
+        for hash in hashes.values():
+            hash.update(target)
+    else:
+        with open(filepath, "rb", buffering=0) as hashFile:
+            buffer = bytearray(min(_blockSize, os.fstat(hashFile.fileno()).st_size + 1))
+            view = memoryview(buffer)
+            while True:
+                size = hashFile.readinto(buffer)
+                if not size:
+                    break
+                for hash in hashes.values():
+                    hash.update(view[:size])
+    return {algorithm: hash.hexdigest() for algorithm, hash in hashes.items()}
+
+
+def _digestKey(filepath, stat : os.stat_result, algorithm : HashAlgorithm) -> tuple:
+    return (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns, stat.st_ino, algorithm.name)
+
+
+def _isCacheable(stat : os.stat_result) -> bool:
+    # a file that was modified right now could still change without changing its mtime
+    return time.time() - stat.st_mtime > 2
+
+
+def _digestFileAlgorithms(filepath, algorithms : [HashAlgorithm], getDigest, newDigests : dict) -> {HashAlgorithm : str}:
+    """ uses the digests cached for the stat of filepath, the new digests are added to newDigests """
+    if os.path.islink(filepath):
+        return _readDigests(filepath, algorithms)
+    stat = os.stat(filepath)
+    algorithms = list(algorithms)
+    keys = {algorithm: _digestKey(filepath, stat, algorithm) for algorithm in algorithms}
+    digests = {}
+    if getDigest:
+        for algorithm, key in keys.items():
+            digest = getDigest(key)
+            if digest:
+                digests[algorithm] = digest
+    missing = [algorithm for algorithm in algorithms if algorithm not in digests]
+    if missing:
+        digests.update(_readDigests(filepath, missing))
+        # don't cache the digest if the file was changed while we read it
+        if _isCacheable(stat) and _digestKey(filepath, os.stat(filepath), algorithms[0]) == keys[algorithms[0]]:
+            newDigests.update((keys[algorithm], digests[algorithm]) for algorithm in missing)
+    return digests
+
+
+def _cachedDigestLookup():
+    """ the lookup of cached digests, None if ForceDigestVerification is set """
+    if CraftCore.settings.getboolean("General", "ForceDigestVerification", False):
+        return None
+    return CraftCore.cache.getDigest
+
+
+def digestFileAlgorithms(filepath, algorithms : [HashAlgorithm]) -> {HashAlgorithm : str}:
+    """ digests a file with several algorithms while reading it only once, unchanged files are not read at all """
+    newDigests = {}
+    digests = _digestFileAlgorithms(filepath, algorithms, _cachedDigestLookup(), newDigests)
+    if newDigests:
+        CraftCore.cache.cacheDigests(newDigests)
+    return digests
+
+
 def digestFile(filepath, algorithm=HashAlgorithm.SHA256):
     """ digests a file """
-    blockSize = 65536
-    hash = getattr(hashlib, algorithm.name.lower())()
-    if os.path.islink(filepath):
-        hash.update(os.readlink(filepath).encode("utf-8"))
+    return digestFileAlgorithms(filepath, [algorithm])[algorithm]
+
+
+def digestFiles(filepaths : [str], algorithm=HashAlgorithm.SHA256) -> [str]:
+    """ digests the files concurrently, returns the digests in the order of filepaths """
+    getDigest = _cachedDigestLookup()
+    newDigests = {}
+    digests = _parallelMap(lambda filepath: _digestFileAlgorithms(filepath, [algorithm], getDigest, newDigests)[algorithm], filepaths)
+    if newDigests:
+        CraftCore.cache.cacheDigests(newDigests)
+    return digests
+
+
+def cacheDigests(digests : {str : str}, algorithm=HashAlgorithm.SHA256) -> None:
+    """ remembers digests that were computed elsewhere, e.g. while the files were copied """
+    newDigests = {}
+    for filepath, digest in digests.items():
+        if not os.path.islink(filepath):
+            stat = os.stat(filepath)
+            if _isCacheable(stat):
+                newDigests[_digestKey(filepath, stat, algorithm)] = digest
+    if newDigests:
+        CraftCore.cache.cacheDigests(newDigests)
+
+
+def _checkFileDigests(downloaddir, filename, digests, digestAlgorithm) -> bool:
+    CraftCore.log.debug("checking digest of: %s" % filename)
+    pathName = os.path.join(downloaddir, filename)
+    if digests == None:
+        digestFileNames = {}
+        for digestAlgorithm, digestFileEnding in HashAlgorithm.fileEndings().items():
+            digestFileName = pathName + digestFileEnding
+            if not os.path.exists(digestFileName):
+                digestFileName, _ = os.path.splitext(pathName)
+                digestFileName += digestFileEnding
+                if not os.path.exists(digestFileName):
+                    continue
+            digestFileNames[digestAlgorithm] = digestFileName
+        if not digestFileNames:
+            return True
+        # check all available digest files with a single read of the file
+        currentHashes = digestFileAlgorithms(pathName, digestFileNames.keys())
+        for digestAlgorithm, digestFileName in digestFileNames.items():
+            currentHash = currentHashes[digestAlgorithm]
+            try:
+                with open(digestFileName, "rt", encoding="UTF-8") as f:
+                    data = f.read()
+            except UnicodeDecodeError:
+                with open(digestFileName, "rb") as f:
+                    CraftCore.log.error(f"Failed to decode digests file {digestFileName}: {f.read()}")
+                return False
+            if not re.findall(currentHash, data):
+                CraftCore.log.error("%s hash for file %s (%s) does not match (%s)" % (
+                    digestAlgorithm.name, pathName, currentHash, data))
+                return False
     else:
-        with open(filepath, "rb") as hashFile:
-            buffer = hashFile.read(blockSize)
-            while len(buffer) > 0:
-                hash.update(buffer)
-                buffer = hashFile.read(blockSize)
-    return hash.hexdigest()
+        # digest provided in digests parameter
+        currentHash = digestFile(pathName, digestAlgorithm)
+        if len(digests) != len(currentHash) or digests.find(currentHash) == -1:
+            CraftCore.log.error("%s hash for file %s (%s) does not match (%s)" % (
+                digestAlgorithm.name, pathName, currentHash, digests))
+            return False
+    return True
 
 
 def checkFilesDigests(downloaddir, filenames, digests=None, digestAlgorithm=HashAlgorithm.SHA1):
@@ -65,53 +205,21 @@ def checkFilesDigests(downloaddir, filenames, digests=None, digestAlgorithm=Hash
     else:
         digestList = [digests]
 
-    for digests, filename in zip(digestList, filenames):
-        CraftCore.log.debug("checking digest of: %s" % filename)
-        pathName = os.path.join(downloaddir, filename)
-        if digests == None:
-            for digestAlgorithm, digestFileEnding in HashAlgorithm.fileEndings().items():
-                digestFileName = pathName + digestFileEnding
-                if not os.path.exists(digestFileName):
-                    digestFileName, _ = os.path.splitext(pathName)
-                    digestFileName += digestFileEnding
-                    if not os.path.exists(digestFileName):
-                        continue
-                currentHash = digestFile(pathName, digestAlgorithm)
-                try:
-                    with open(digestFileName, "rt", encoding="UTF-8") as f:
-                        data = f.read()
-                except UnicodeDecodeError:
-                    with open(digestFileName, "rb") as f:
-                        CraftCore.log.error(f"Failed to decode digests file {digestFileName}: {f.read()}")
-                    return False
-                if not re.findall(currentHash, data):
-                    CraftCore.log.error("%s hash for file %s (%s) does not match (%s)" % (
-                        digestAlgorithm.name, pathName, currentHash, data))
-                    return False
-                    # digest provided in digests parameter
-        else:
-            currentHash = digestFile(pathName, digestAlgorithm)
-            if len(digests) != len(currentHash) or digests.find(currentHash) == -1:
-                CraftCore.log.error("%s hash for file %s (%s) does not match (%s)" % (
-                    digestAlgorithm.name, pathName, currentHash, digests))
-                return False
-    return True
+    results = _parallelMap(lambda entry: _checkFileDigests(downloaddir, entry[1], entry[0], digestAlgorithm),
+                           zip(digestList, filenames))
+    return all(results)
 
 
 def createDigestFiles(path, algorithms=None):
     """creates a sha1 diget file"""
     if algorithms == None:
         algorithms = [HashAlgorithm.SHA256]
-    for algorithm in algorithms:
-        digets = digestFile(path, algorithm)
+    for algorithm, digets in digestFileAlgorithms(path, algorithms).items():
         with open(path + algorithm.fileEnding(), "wt", encoding="UTF-8") as f:
             f.write("%s\n" % digets)
 
 
 def printFilesDigests(downloaddir, filenames, buildTarget, algorithm=HashAlgorithm.SHA256):
-    digests = []
-    for filename in filenames:
-        if not filename == "":
-            digests.append(digestFile(os.path.join(downloaddir, filename), algorithm))
+    digests = digestFiles([os.path.join(downloaddir, filename) for filename in filenames if not filename == ""], algorithm)
     if digests:
         CraftCore.log.info(f"Digests for {buildTarget}: ({digests}, CraftHash.{algorithm})")
@@ -2,9 +2,14 @@ import collections
 import datetime
 import json
 import os
+import sqlite3
+import threading
+import time
 
 
 from CraftCore import CraftCore
+from CraftStandardDirs import CraftStandardDirs
+from Utils import CraftArchive, GetFiles
 import utils
 
 class CraftManifestEntryFile(object):
@@ -14,6 +19,7 @@ class CraftManifestEntryFile(object):
         self.date = datetime.datetime.utcnow()
         self.version = version
         self.buildPrefix = CraftCore.standardDirs.craftRoot()
+        self.format = CraftArchive.archiveFormat(fileName)
 
     @staticmethod
     def fromJson(data : dict):
@@ -21,6 +27,7 @@ class CraftManifestEntryFile(object):
         out.date = CraftManifest._parseTimeStamp(data["date"])
         out.version = data.get("version", "")
         out.buildPrefix = data.get("buildPrefix", None)
+        out.format = data.get("format", out.format)
         return out
 
     def toJson(self) -> dict:
@@ -28,7 +35,13 @@ class CraftManifestEntryFile(object):
                 "checksum"      : self.checksum,
                 "date"          : self.date.strftime(CraftManifest._TIME_FORMAT),
                 "version"       : self.version,
-                "buildPrefix"   : self.buildPrefix}
+                "buildPrefix"   : self.buildPrefix,
+                "format"        : self.format}
+
+    @property
+    def baseName(self) -> str:
+        """ the file name without the format, the same for all archives of a build """
+        return self.fileName[:-len(self.format) - 1] if self.format else self.fileName
 
 class CraftManifestEntry(object):
     def __init__(self, name : str) -> None:
@@ -53,6 +66,19 @@ class CraftManifestEntry(object):
     def latest(self) -> CraftManifestEntryFile:
         return self.files[0] if self.files else None
 
+    def latestFor(self, version : str, formats : [str]) -> CraftManifestEntryFile:
+        """
+        Returns the latest file of version in one of formats, None if there is none.
+        If the build was archived in several formats, the one that comes first in formats is used.
+        Older builds are only used if the latest one has none of formats.
+        """
+        for f in self.files:
+            if f.version != version or f.format not in formats:
+                continue
+            build = [b for b in self.files if b.baseName == f.baseName and b.format in formats]
+            return min(build, key=lambda b: formats.index(b.format))
+        return None
+
 class CraftManifest(object):
     _TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
@@ -137,10 +163,10 @@ class CraftManifest(object):
         if urls:
             old = CraftManifest()
             for url in urls:
-                new = CraftManifest.fromJson(CraftCore.cache.cacheJsonFromUrl(f"{url}/manifest.json"))
+                # the result is published, so we revalidate the remote manifest
+                new = CraftCore.manifestIndex.manifest(f"{url}/manifest.json", maxAge=0)
                 if new:
                     new.origin = url
-                    new.dump(manifestFileName, includeTime=True)
                     old.update(new)
 
         cache = None
@@ -148,9 +174,8 @@ class CraftManifest(object):
             try:
                 with open(manifestFileName, "rt+") as cacheFile:
                     cache = CraftManifest.fromJson(json.load(cacheFile))
-                cache.dump(manifestFileName, includeTime=True)
             except Exception as e:
-                CraftCore.log.warning(f"Failed to load {cacheFile}, {e}")
+                CraftCore.log.warning(f"Failed to load {manifestFileName}, {e}")
                 pass
         if old:
             if cache:
@@ -163,3 +188,197 @@ class CraftManifest(object):
     @staticmethod
     def _parseTimeStamp(time : str) -> datetime.datetime:
         return datetime.datetime.strptime(time, CraftManifest._TIME_FORMAT)
+
+
+class ManifestIndex(object):
+    """
+    The manifests of the binary caches, indexed by package in etc/manifests.sqlite.
+
+    A manifest is only parsed when it changed, local manifests are compared by their size and mtime,
+    remote manifests are revalidated with If-None-Match and If-Modified-Since.
+    Only the files that differ from the indexed state are written.
+    """
+    SCHEMA_VERSION = 1
+    # remote manifests are revalidated at most this often
+    _revalidateInterval = 10 * 60
+
+    def __init__(self, filename : str=None):
+        self._lock = threading.Lock()
+        self.connection = None
+        if filename:
+            try:
+                self.connection = self._connect(filename)
+            except Exception as e:
+                CraftCore.log.warning(f"Failed to open the manifest index {filename}: {e}")
+        if not self.connection:
+            self.connection = self._connect(":memory:")
+
+    @staticmethod
+    def _loadInstance():
+        indexFile = os.path.join(CraftStandardDirs.etcDir(), "manifests.sqlite")
+        return ManifestIndex(indexFile if os.path.isdir(os.path.dirname(indexFile)) else None)
+
+    @staticmethod
+    def _connect(filename : str) -> sqlite3.Connection:
+        # autocommit, like the CacheStore
+        connection = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        connection.execute("""PRAGMA journal_mode=WAL;""")
+        connection.execute("""PRAGMA synchronous=NORMAL;""")
+        if connection.execute("""PRAGMA user_version;""").fetchone()[0] != ManifestIndex.SCHEMA_VERSION:
+            connection.execute("""DROP TABLE IF EXISTS sources;""")
+            connection.execute("""DROP TABLE IF EXISTS files;""")
+            # stamp, etag and lastModified identify the indexed state of the manifest, checked is when it was validated
+            connection.execute("""CREATE TABLE sources (source TEXT PRIMARY KEY, available INTEGER NOT NULL, date TEXT, origin TEXT,
+                                  stamp TEXT, etag TEXT, lastModified TEXT, checked REAL NOT NULL);""")
+            connection.execute("""CREATE TABLE files (source TEXT NOT NULL, compiler TEXT NOT NULL, package TEXT NOT NULL, fileName TEXT NOT NULL,
+                                  checksum TEXT, date TEXT, version TEXT, buildPrefix TEXT, format TEXT,
+                                  PRIMARY KEY (source, compiler, package, fileName));""")
+            connection.execute("""CREATE INDEX filesDate ON files (source, compiler, package, date);""")
+            connection.execute(f"""PRAGMA user_version={ManifestIndex.SCHEMA_VERSION};""")
+        return connection
+
+    def _state(self, source : str) -> dict:
+        with self._lock:
+            row = self.connection.execute("""SELECT available, date, origin, stamp, etag, lastModified, checked FROM sources WHERE source = ?;""",
+                                          (source,)).fetchone()
+        if not row:
+            return None
+        return dict(zip(["available", "date", "origin", "stamp", "etag", "lastModified", "checked"], row))
+
+    def _setChecked(self, source : str, state : dict) -> None:
+        with self._lock:
+            if state:
+                self.connection.execute("""UPDATE sources SET checked = ? WHERE source = ?;""", (time.time(), source))
+            else:
+                # don't ask for a missing manifest for every package
+                self.connection.execute("""INSERT OR REPLACE INTO sources (source, available, checked) VALUES (?, 0, ?);""",
+                                        (source, time.time()))
+
+    def _remove(self, source : str) -> None:
+        """ forgets the files of a manifest that is gone """
+        with self._lock:
+            self.connection.execute("""BEGIN;""")
+            try:
+                self.connection.execute("""DELETE FROM files WHERE source = ?;""", (source,))
+                self.connection.execute("""INSERT OR REPLACE INTO sources (source, available, checked) VALUES (?, 0, ?);""", (source, time.time()))
+                self.connection.execute("""COMMIT;""")
+            except:
+                self.connection.execute("""ROLLBACK;""")
+                raise
+
+    @staticmethod
+    def _rows(data : dict) -> {(str, str, str) : tuple}:
+        if data.get("version", 0) != CraftManifest.version():
+            data = CraftManifest.fromJson(data).toJson()
+        rows = {}
+        for compiler, packages in data["packages"].items():
+            for package in packages:
+                for f in package["files"]:
+                    rows[(compiler, package["name"], f["fileName"])] = (f["checksum"], f["date"], f.get("version", ""), f.get("buildPrefix", None),
+                                                                        f.get("format", None) or CraftArchive.archiveFormat(f["fileName"]))
+        return rows
+
+    def _merge(self, source : str, data : dict, stamp : str=None, etag : str=None, lastModified : str=None) -> None:
+        rows = ManifestIndex._rows(data)
+        with self._lock:
+            old = {tuple(row[:3]): tuple(row[3:]) for row in
+                   self.connection.execute("""SELECT compiler, package, fileName, checksum, date, version, buildPrefix, format FROM files WHERE source = ?;""",
+                                           (source,))}
+            changed = [(source, *key, *value) for key, value in rows.items() if old.get(key, None) != value]
+            removed = [(source, *key) for key in old.keys() - rows.keys()]
+            self.connection.execute("""BEGIN;""")
+            try:
+                self.connection.executemany("""INSERT OR REPLACE INTO files (source, compiler, package, fileName, checksum, date, version, buildPrefix, format)
+                                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""", changed)
+                self.connection.executemany("""DELETE FROM files WHERE source = ? AND compiler = ? AND package = ? AND fileName = ?;""", removed)
+                self.connection.execute("""INSERT OR REPLACE INTO sources (source, available, date, origin, stamp, etag, lastModified, checked)
+                                           VALUES (?, 1, ?, ?, ?, ?, ?, ?);""",
+                                        (source, data.get("date", None), data.get("origin", None), stamp, etag, lastModified, time.time()))
+                self.connection.execute("""COMMIT;""")
+            except:
+                self.connection.execute("""ROLLBACK;""")
+                raise
+        CraftCore.log.debug(f"Indexed {source}: {len(changed)} files changed, {len(removed)} removed")
+
+    def refresh(self, source : str, maxAge : float=None) -> bool:
+        """
+        Updates the index of source, the path or url of a manifest.json.
+        Remote manifests are revalidated if they were checked more than maxAge seconds ago.
+        Returns whether the manifest is available.
+        """
+        state = self._state(source)
+        if "://" not in source:
+            if not os.path.isfile(source):
+                return False
+            stat = os.stat(source)
+            stamp = f"{stat.st_mtime_ns}:{stat.st_size}"
+            if state and state["stamp"] == stamp:
+                return True
+            try:
+                with open(source, "rt", encoding="UTF-8") as f:
+                    self._merge(source, json.load(f), stamp=stamp)
+            except Exception as e:
+                CraftCore.log.warning(f"Failed to load {source}, {e}")
+                return False
+            return True
+
+        if maxAge is None:
+            maxAge = ManifestIndex._revalidateInterval
+        if state and time.time() - state["checked"] < maxAge:
+            return bool(state["available"])
+        if CraftCore.settings.getboolean("General", "WorkOffline"):
+            return bool(state and state["available"])
+        try:
+            content, etag, lastModified = GetFiles.getIfModified(source, state and state["etag"], state and state["lastModified"])
+            if content is not None:
+                self._merge(source, json.loads(content.decode("UTF-8")), etag=etag, lastModified=lastModified)
+                return True
+        except GetFiles.DownloadError as e:
+            CraftCore.log.debug(f"Failed to fetch {source}: {e}")
+            if e.status is not None and 400 <= e.status < 500:
+                # the manifest was removed, don't serve the old one
+                self._remove(source)
+                return False
+        except Exception as e:
+            CraftCore.log.debug(f"Failed to fetch {source}: {e}")
+        # not modified, not reachable or a server error, we keep what we have
+        self._setChecked(source, state)
+        return bool(state and state["available"])
+
+    def entry(self, source : str, package : str, compiler : str=None) -> CraftManifestEntry:
+        """ Returns the entry of package in the manifest source, the latest file first. None if the manifest is not available. """
+        if not self.refresh(source):
+            return None
+        with self._lock:
+            rows = self.connection.execute("""SELECT fileName, checksum, date, version, buildPrefix, format FROM files
+                                              WHERE source = ? AND compiler = ? AND package = ? ORDER BY date DESC;""",
+                                           (source, compiler or str(CraftCore.compiler), package)).fetchall()
+        entry = CraftManifestEntry(package)
+        entry.files = [ManifestIndex._file(row) for row in rows]
+        return entry
+
+    def manifest(self, source : str, maxAge : float=None) -> CraftManifest:
+        """ Returns the whole manifest source, None if it is not available """
+        if not self.refresh(source, maxAge=maxAge):
+            return None
+        state = self._state(source)
+        manifest = CraftManifest()
+        if state["date"]:
+            try:
+                manifest.date = CraftManifest._parseTimeStamp(state["date"])
+            except ValueError:
+                pass
+        manifest.origin = state["origin"]
+        with self._lock:
+            rows = self.connection.execute("""SELECT compiler, package, fileName, checksum, date, version, buildPrefix, format FROM files
+                                              WHERE source = ? ORDER BY compiler, package, date DESC;""", (source,)).fetchall()
+        for row in rows:
+            packages = manifest.packages.setdefault(row[0], {})
+            if row[1] not in packages:
+                packages[row[1]] = CraftManifestEntry(row[1])
+            packages[row[1]].files.append(ManifestIndex._file(row[2:]))
+        return manifest
+
+    @staticmethod
+    def _file(row : tuple) -> CraftManifestEntryFile:
+        return CraftManifestEntryFile.fromJson(dict(zip(["fileName", "checksum", "date", "version", "buildPrefix", "format"], row)))
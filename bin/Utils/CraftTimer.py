@@ -1,9 +1,110 @@
+import atexit
+import contextlib
 import datetime
+import functools
+import json
+import os
+import threading
+import time
 
 import CraftConfig
 from CraftCore import CraftCore
 
 
+class Tracer(object):
+    """
+    Records nested spans of a craft run in the Chrome trace event format.
+    The trace is written to [CraftDebug]TraceFile and can be opened with chrome://tracing or https://ui.perfetto.dev
+    """
+    _configured = False
+    # the shortest span that is recorded in seconds, None if the trace is disabled
+    _minDuration = None
+    _lock = threading.Lock()
+    _events = []
+
+    @staticmethod
+    def traceFile() -> str:
+        return CraftCore.settings.get("CraftDebug", "TraceFile", "")
+
+    @staticmethod
+    def configure() -> None:
+        """Reads the settings of the trace, craft.py calls it again once the --options are applied"""
+        with Tracer._lock:
+            wasEnabled = Tracer._minDuration is not None
+            if Tracer.traceFile():
+                Tracer._minDuration = float(CraftCore.settings.get("CraftDebug", "TraceMinDuration", "1")) / 1000
+            else:
+                Tracer._minDuration = None
+            Tracer._configured = True
+            if Tracer._minDuration is not None and not wasEnabled:
+                atexit.register(Tracer.dump)
+            elif Tracer._minDuration is None and wasEnabled:
+                atexit.unregister(Tracer.dump)
+
+    @staticmethod
+    def enabled() -> bool:
+        if not Tracer._configured:
+            Tracer.configure()
+        return Tracer._minDuration is not None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name : str, category : str="craft", **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            # enabled is checked at the end, so the span of the whole run is recorded when the options enable the trace
+            # skip tiny spans like the digest of small files, to keep the trace readable
+            if Tracer.enabled() and duration >= Tracer._minDuration:
+                event = {"name": name, "cat": category, "ph": "X", "ts": int(start * 1000000), "dur": int(duration * 1000000),
+                         "pid": os.getpid(), "tid": threading.get_ident()}
+                if args:
+                    event["args"] = {key: str(value) for key, value in args.items()}
+                with Tracer._lock:
+                    Tracer._events.append(event)
+
+    @staticmethod
+    def traced(category : str, name : str=None):
+        """Decorator recording a span for every call of the function"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with Tracer.span(name or func.__qualname__, category):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def merge(traceFile : str) -> None:
+        """Adds the events of the trace of a child process"""
+        if not os.path.isfile(traceFile):
+            return
+        with open(traceFile, "rt", encoding="UTF-8") as f:
+            events = json.load(f)["traceEvents"]
+        with Tracer._lock:
+            Tracer._events.extend(events)
+        os.remove(traceFile)
+
+    @staticmethod
+    def dump() -> None:
+        traceFile = Tracer.traceFile()
+        with Tracer._lock:
+            events = list(Tracer._events)
+        with open(traceFile, "wt", encoding="UTF-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        count = int(CraftCore.settings.get("CraftDebug", "TraceSummary", "20"))
+        if count <= 0 or not events:
+            return
+        width = 80
+        CraftCore.debug.printOut(f"Slowest {count} spans, trace written to {traceFile}")
+        CraftCore.debug.printOut(f"{'Span':{width}} {'Category':12} {'Duration':>10}")
+        for event in sorted(events, key=lambda x: x["dur"], reverse=True)[:count]:
+            name = event["name"] if len(event["name"]) <= width else event["name"][:width - 3] + "..."
+            CraftCore.debug.printOut(f"{name:{width}} {event['cat']:12} {event['dur'] / 1000000:9.3f}s")
+
+
 class Timer(object):
     def __init__(self, name, verbosity=0):
         self.name = name
@@ -15,9 +116,12 @@ class Timer(object):
 
     def __enter__(self):
         self.__startTime = datetime.datetime.now()
+        self.__span = Tracer.span(self.name, "timer")
+        self.__span.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__span.__exit__(exc_type, exc_val, exc_tb)
         self.stop()
         if CraftConfig.CraftCore.settings.getboolean("CraftDebug", "MeasureTime", False):
             CraftCore.debug.step(f"Task: {self.name} stopped after: {self}")
@@ -27,15 +27,315 @@
 
 from CraftCore import CraftCore
 from CraftDebug import deprecated
+from Utils import CraftHash, CraftTimer
 import utils
 
+import concurrent.futures
+import gzip
+import hashlib
+import http.client
 import os
+import ssl
+import tempfile
+import threading
+import time
 import urllib
+import urllib.parse
+import urllib.request
 import subprocess
 import sys
 
-def getFile(url, destdir, filename='', quiet=CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False)) -> bool:
-    """download file from 'url' into 'destdir'"""
+
+class Download(object):
+    """A file that is fetched by getFiles, digest is optional"""
+    def __init__(self, url, destdir, filename="", digest=None, digestAlgorithm=CraftHash.HashAlgorithm.SHA256):
+        self.url = url
+        self.destdir = destdir
+        self.filename = filename or os.path.basename(urllib.parse.urlparse(url).path)
+        self.digest = digest
+        self.digestAlgorithm = digestAlgorithm
+
+    def __str__(self):
+        return self.url
+
+
+class DownloadError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        # the http status the server answered with, None if there was no answer
+        self.status = status
+
+
+class _ConnectionPool(object):
+    """Keeps idle http connections to reuse them for requests to the same host"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._sslContext = None
+
+    def _context(self):
+        if not self._sslContext:
+            cert = os.path.join(CraftCore.standardDirs.etcDir(), "cacert.pem")
+            self._sslContext = ssl.create_default_context(cafile=cert if os.path.exists(cert) else None)
+        return self._sslContext
+
+    def get(self, scheme, netloc):
+        with self._lock:
+            connections = self._idle.get((scheme, netloc), None)
+            if connections:
+                return connections.pop()
+        timeout = int(CraftCore.settings.get("General", "DownloadTimeout", "60"))
+        proxy = urllib.request.getproxies().get(scheme, None)
+        host = urllib.parse.urlsplit(f"{scheme}://{netloc}").hostname
+        if proxy and not urllib.request.proxy_bypass(host):
+            proxy = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+            if scheme == "https":
+                connection = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80, timeout=timeout, context=self._context())
+                connection.set_tunnel(netloc)
+            else:
+                connection = http.client.HTTPConnection(proxy.hostname, proxy.port or 80, timeout=timeout)
+                # plain http requests are sent to the proxy with the full url
+                connection.usesProxy = True
+            return connection
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout, context=self._context())
+        return http.client.HTTPConnection(netloc, timeout=timeout)
+
+    def put(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+
+_connectionPool = _ConnectionPool()
+_downloadSlots = None
+_downloadSlotsLock = threading.Lock()
+
+
+def _downloadSemaphore():
+    global _downloadSlots
+    with _downloadSlotsLock:
+        if not _downloadSlots:
+            _downloadSlots = threading.BoundedSemaphore(maxConcurrentDownloads())
+        return _downloadSlots
+
+
+def _isHttp(url) -> bool:
+    return urllib.parse.urlparse(url).scheme in {"http", "https"}
+
+
+def verifiesDigest(url) -> bool:
+    """Whether getFile checks the digest of url while it is downloaded"""
+    # the builtin http client hashes the download
+    return _isHttp(url)
+
+
+def maxConcurrentDownloads() -> int:
+    return max(1, int(CraftCore.settings.get("General", "ConcurrentDownloads", "4")))
+
+
+def _digestMatches(digest, currentHash) -> bool:
+    # same comparison as CraftHash.checkFilesDigests
+    return len(digest) == len(currentHash) and digest.find(currentHash) != -1
+
+
+def _request(url, offset, extraHeaders=None):
+    """Sends a GET request for url starting at offset, redirects are followed. Returns (url, connection, response)"""
+    for _ in range(50):
+        pUrl = urllib.parse.urlsplit(url)
+        connection = _connectionPool.get(pUrl.scheme, pUrl.netloc)
+        path = url if getattr(connection, "usesProxy", False) else urllib.parse.urlunsplit(("", "", pUrl.path or "/", pUrl.query, ""))
+        headers = {"User-Agent": "Craft", "Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        if extraHeaders:
+            headers.update(extraHeaders)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+        if response.status in {301, 302, 303, 307, 308}:
+            location = response.getheader("Location")
+            response.read()
+            _releaseConnection(url, connection, response)
+            if not location:
+                raise DownloadError(f"{url} redirected without a location")
+            CraftCore.log.debug(f"{url} redirected to {location}")
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return url, connection, response
+    raise DownloadError(f"Too many redirects for {url}")
+
+
+def _releaseConnection(url, connection, response):
+    if response.will_close:
+        connection.close()
+    else:
+        pUrl = urllib.parse.urlsplit(url)
+        _connectionPool.put(pUrl.scheme, pUrl.netloc, connection)
+
+
+def _downloadOnce(download, partFile, showProgress) -> bool:
+    """Downloads download into partFile, continuing a previous attempt. Returns False if the download needs to be restarted"""
+    offset = os.path.getsize(partFile) if os.path.isfile(partFile) else 0
+    hash = None
+    if download.digest:
+        hash = getattr(hashlib, download.digestAlgorithm.name.lower())()
+        if offset:
+            with open(partFile, "rb") as f:
+                for buffer in iter(lambda: f.read(1024 * 1024), b""):
+                    hash.update(buffer)
+
+    url, connection, response = _request(download.url, offset)
+    if response.status == 416 and offset:
+        try:
+            response.read()
+        except Exception:
+            connection.close()
+            raise
+        _releaseConnection(url, connection, response)
+        # the part file might already be complete
+        if response.getheader("Content-Range", "") == f"bytes */{offset}":
+            return _checkDigest(download, partFile, hash)
+        CraftCore.log.debug(f"Failed to resume {url}, restarting")
+        utils.deleteFile(partFile)
+        return False
+    try:
+        if response.status not in {200, 206}:
+            response.read()
+            raise DownloadError(f"Failed to download {url}: {response.status} {response.reason}", status=response.status)
+        if response.status == 206:
+            contentRange = response.getheader("Content-Range", "")
+            if not contentRange.startswith(f"bytes {offset}-"):
+                response.read()
+                _releaseConnection(url, connection, response)
+                utils.deleteFile(partFile)
+                return False
+            CraftCore.log.debug(f"Resuming {url} at {offset} bytes")
+        elif offset:
+            # the server does not support ranges
+            offset = 0
+            if hash:
+                hash = getattr(hashlib, download.digestAlgorithm.name.lower())()
+        length = response.getheader("Content-Length", None)
+        total = offset + int(length) if length is not None else None
+        done = offset
+        lastPercent = -1
+        with open(partFile, "ab" if offset else "wb") as out:
+            for buffer in iter(lambda: response.read(256 * 1024), b""):
+                out.write(buffer)
+                if hash:
+                    hash.update(buffer)
+                done += len(buffer)
+                if showProgress and total:
+                    percent = int(done * 100 / total)
+                    if percent != lastPercent:
+                        lastPercent = percent
+                        utils.printProgress(percent)
+        if showProgress and total:
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        if total is not None and done != total:
+            raise http.client.IncompleteRead(b"", total - done)
+    except Exception:
+        connection.close()
+        raise
+    _releaseConnection(url, connection, response)
+    return _checkDigest(download, partFile, hash)
+
+
+def _checkDigest(download, partFile, hash) -> bool:
+    """Compares the hash of the complete partFile with the digest of download, a mismatching file is deleted"""
+    if hash and not _digestMatches(download.digest, hash.hexdigest()):
+        utils.deleteFile(partFile)
+        raise DownloadError(f"{download.digestAlgorithm.name} hash for file {download.filename} ({hash.hexdigest()}) does not match ({download.digest})")
+    return True
+
+
+def downloadFile(download : Download, showProgress=True) -> bool:
+    """Downloads download with the builtin http client, a partial download in download.filename.part is resumed"""
+    destination = os.path.join(download.destdir, download.filename)
+    partFile = f"{destination}.part"
+    if os.path.isfile(destination):
+        # like wget -c, don't fetch complete files again
+        if not download.digest or _digestMatches(download.digest, CraftHash.digestFile(destination, download.digestAlgorithm)):
+            CraftCore.log.debug(f"{destination} was already downloaded")
+            return True
+        utils.deleteFile(destination)
+    utils.createDir(download.destdir)
+    with _downloadSemaphore(), CraftTimer.Tracer.span(download.filename, "download", url=download.url):
+        CraftCore.log.info(f"Downloading {download.url}")
+        start = time.time()
+        retries = 10
+        for attempt in range(retries):
+            try:
+                if _downloadOnce(download, partFile, showProgress):
+                    break
+            except DownloadError as e:
+                CraftCore.log.warning(e)
+                return False
+            except (OSError, http.client.HTTPException) as e:
+                CraftCore.log.debug(f"Download of {download.url} was interrupted: {e!r}")
+                if attempt == retries - 1:
+                    CraftCore.log.warning(f"Failed to download {download.url}: {e}")
+                    return False
+                time.sleep(min(2 ** attempt, 30))
+        else:
+            CraftCore.log.warning(f"Failed to download {download.url}")
+            return False
+        os.replace(partFile, destination)
+        CraftCore.log.debug(f"Downloaded {download.url}, {os.path.getsize(destination)} bytes in {time.time() - start:.2f}s")
+    return True
+
+
+def getIfModified(url, etag=None, lastModified=None) -> (bytes, str, str):
+    """
+    Fetches the content of url unless it still matches etag or lastModified, the values of a previous response.
+    Returns (content, etag, lastModified), content is None if url was not modified.
+    """
+    if not _isHttp(url):
+        # no conditional requests without http
+        with tempfile.TemporaryDirectory() as tmp:
+            if not getFile(url, tmp, "content", quiet=True):
+                raise DownloadError(f"Failed to download {url}")
+            with open(os.path.join(tmp, "content"), "rb") as f:
+                return f.read(), None, None
+    headers = {"Accept-Encoding": "gzip"}
+    if etag:
+        headers["If-None-Match"] = etag
+    if lastModified:
+        headers["If-Modified-Since"] = lastModified
+    with _downloadSemaphore(), CraftTimer.Tracer.span(os.path.basename(urllib.parse.urlparse(url).path), "download", url=url):
+        url, connection, response = _request(url, 0, headers)
+        try:
+            content = response.read()
+        except Exception:
+            connection.close()
+            raise
+        _releaseConnection(url, connection, response)
+    if response.status == 304:
+        CraftCore.log.debug(f"{url} was not modified")
+        return None, etag, lastModified
+    if response.status != 200:
+        raise DownloadError(f"Failed to download {url}: {response.status} {response.reason}", status=response.status)
+    if response.getheader("Content-Encoding", "") == "gzip":
+        content = gzip.decompress(content)
+    return content, response.getheader("ETag", None), response.getheader("Last-Modified", None)
+
+
+def getFiles(downloads : [Download], quiet=CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False)) -> bool:
+    """Downloads multiple files at the same time, limited by [General]ConcurrentDownloads"""
+    downloads = list(downloads)
+    if len(downloads) < 2:
+        return all(getFile(d.url, d.destdir, d.filename, quiet=quiet, digest=d.digest, digestAlgorithm=d.digestAlgorithm) for d in downloads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrentDownloads()) as pool:
+        results = pool.map(lambda d: getFile(d.url, d.destdir, d.filename, quiet=True, digest=d.digest, digestAlgorithm=d.digestAlgorithm), downloads)
+        return all(list(results))
+
+def getFile(url, destdir, filename='', quiet=CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False),
+            digest=None, digestAlgorithm=CraftHash.HashAlgorithm.SHA256) -> bool:
+    """download file from 'url' into 'destdir', if digest is given the file is verified while it is downloaded"""
     CraftCore.log.debug("getFile called. url: %s" % url)
     if url == "":
         CraftCore.log.error("fetch: no url given")
@@ -50,6 +350,10 @@ def getFile(url, destdir, filename='', quiet=CraftCore.settings.getboolean("Cont
     if pUrl.scheme == "s3":
       return s3File(url, destdir, filename)
 
+    if _isHttp(url):
+        return downloadFile(Download(url, destdir, filename, digest, digestAlgorithm),
+                            showProgress=not quiet and CraftCore.debug.verbose() >= 0)
+
     # curl and wget basically only work when we have a cert store on windows
     if not CraftCore.compiler.isWindows or os.path.exists(os.path.join(CraftCore.standardDirs.etcDir(), "cacert.pem")):
         if CraftCore.cache.findApplication("wget"):
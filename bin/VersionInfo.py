@@ -54,20 +54,33 @@ class VersionInfo(object):
         self._data = None
         self.__include = None
 
+    @property
+    def fileName(self) -> str:
+        """The version.ini of the package, the next one in its directory or the ones above it"""
+        if not self._fileName:
+            filePath = OsUtils.toUnixPath(self.package.filePath)
+            while True:
+                if filePath in CraftPackageObject.rootDirectories():
+                    break
+                ini = OsUtils.toUnixPath(os.path.join(filePath, "version.ini"))
+                if os.path.exists(ini):
+                    self._fileName = ini
+                    break
+                filePath = os.path.dirname(filePath)
+        return self._fileName
+
+    def files(self) -> [str]:
+        """All version.ini files the version info is read from, including the included ones"""
+        if not self.fileName:
+            return []
+        if self._include:
+            return [self.fileName] + self._include.files()
+        return [self.fileName]
+
     @property
     def data(self):
         if not self._data:
-            if not self._fileName:
-                filePath = OsUtils.toUnixPath(self.package.filePath)
-                while True:
-                    if filePath in CraftPackageObject.rootDirectories():
-                        break
-                    ini = OsUtils.toUnixPath(os.path.join(filePath, "version.ini"))
-                    if os.path.exists(ini):
-                        self._fileName = ini
-                        break
-                    filePath = os.path.dirname(filePath)
-            if not self._fileName:
+            if not self.fileName:
                 self._data = VersionInfo.VersionInfoData()
             else:
                 if self._fileName in VersionInfo._VERSION_INFOS:
@@ -1,16 +1,20 @@
+import pickle
+
 import InstallDB
 import utils
 from Blueprints.CraftPackageObject import *
 from Blueprints.CraftDependencyPackage import *
 from Blueprints.CraftVersion import CraftVersion
 from Blueprints.MetaInfo import MetaInfo
-from Utils import CraftTimer
+from Utils import CraftHash, CraftTimer
+from VersionInfo import VersionInfo
 
 
 class SeachPackage(object):
     def __init__(self, package):
         self.path = package.path
         self.name = package.name
+        self.blueprintPath = package.source or package.filePath
 
         info = MetaInfo(package)
         self.displayName = info.displayName
@@ -21,6 +25,7 @@ class SeachPackage(object):
         versions = info.versions
         versions.sort(key=lambda x: CraftVersion(x))
         self.availableVersions = ", ".join(versions)
+        self.latestVersion = package.version
 
 
     @property
@@ -29,7 +34,7 @@ class SeachPackage(object):
         out = CraftPackageObject.get(self.path)
         if not out:
             CraftCore.log.error("Cache corrupted")
-            CraftCore.cache.clear()
+            SearchIndex.clear()
             exit(1)
         return out
 
@@ -43,15 +48,14 @@ class SeachPackage(object):
                 raise Exception("Multiple installs are not supported")
             version = installed[0].getVersion() or None
             revision = installed[0].getRevision() or None
-        latestVersion = self.package.version
         return f"""\
 {self.package}
     Name: {self.displayName}
-    BlueprintPath: {self.package.source or self.package.filePath}
+    BlueprintPath: {self.blueprintPath}
     Homepage: {self.webpage}
     Description: {self.description}
     Tags: {self.tags}
-    Latest version: {latestVersion}
+    Latest version: {self.latestVersion}
     Installed versions: {version}
     Installed revision: {revision}
 
@@ -59,20 +63,194 @@ class SeachPackage(object):
 """
 
 
+class BKTree(object):
+    """A Burkhard-Keller tree to find all strings within an edit distance of a query"""
+    def __init__(self, words):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if not self.root:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            dist = utils.levenshtein(word, node[0])
+            if dist == 0:
+                return
+            if dist not in node[1]:
+                node[1][dist] = (word, {})
+                return
+            node = node[1][dist]
+
+    def find(self, word, maxDist) -> {str: int}:
+        out = {}
+        nodes = [self.root] if self.root else []
+        while nodes:
+            current, children = nodes.pop()
+            dist = utils.levenshtein(word, current)
+            if dist <= maxDist:
+                out[current] = dist
+            for childDist, child in children.items():
+                if dist - maxDist <= childDist <= dist + maxDist:
+                    nodes.append(child)
+        return out
+
+
+class SearchIndex(object):
+    """
+    The search data of all blueprints, stored in etc/blueprints/searchIndex.pickle.
+    An entry is only recreated, and thus its blueprint imported, when one of its files changed.
+    """
+    _VERSION = 1
+    _instance = None
+    _regexChars = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, key, entries):
+        self.key = key
+        # path -> (file stats, SeachPackage)
+        self.entries = entries
+        self.packages = [package for _, package in entries.values()]
+        self._tokens = {}
+        self._trigrams = {}
+        for package in self.packages:
+            for token in self._split(" ".join([package.path, package.description or "", package.tags or ""])):
+                self._tokens.setdefault(token, set()).add(package.path)
+            for text in [package.path, package.description or "", package.tags or ""]:
+                for trigram in self._trigramsOf(text.lower()):
+                    self._trigrams.setdefault(trigram, set()).add(package.path)
+        self._names = BKTree(package.name.lower() for package in self.packages)
+        self._paths = BKTree(package.path.lower() for package in self.packages)
+        self._byString = {}
+        for package in self.packages:
+            self._byString.setdefault(package.name.lower(), []).append(package)
+            self._byString.setdefault(package.path.lower(), []).append(package)
+
+    @staticmethod
+    def _split(text):
+        return set(re.split(r"[^a-z0-9]+", text.lower())) - {""}
+
+    @staticmethod
+    def _trigramsOf(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _indexFile():
+        return os.path.join(CraftStandardDirs.etcBlueprintDir(), "searchIndex.pickle")
+
+    @staticmethod
+    def _globalKey():
+        """The key of everything beside the blueprints that affects the index"""
+        settings = CraftCore.settings.get("Blueprints", "Settings", os.path.join(CraftCore.standardDirs.etcDir(), "BlueprintSettings.ini"))
+        # the settings are written on every run, so we use their content
+        settingsDigest = CraftHash.digestFile(settings) if os.path.isfile(settings) else None
+        return (SearchIndex._VERSION, str(CraftCore.compiler), settingsDigest,
+                CraftCore.settings.get("General", "Options", ""))
+
+    @staticmethod
+    def _fileKey(path):
+        try:
+            stat = os.stat(path)
+            return (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return (path, None)
+
+    @staticmethod
+    def _packageKey(package):
+        files = []
+        if package.source:
+            files.append(package.source)
+            # the versions usually come from a version.ini in a directory above the blueprint
+            files += VersionInfo(package=package).files()
+        else:
+            files += [os.path.join(package.filePath, "version.ini"), os.path.join(package.filePath, "info.ini")]
+        if package.categoryInfo:
+            files.append(os.path.join(package.categoryInfo.localPath, "info.ini"))
+        return tuple(SearchIndex._fileKey(f) for f in files)
+
+    @staticmethod
+    def clear():
+        SearchIndex._instance = None
+        utils.deleteFile(SearchIndex._indexFile())
+
+    @staticmethod
+    def instance():
+        if not SearchIndex._instance:
+            key = SearchIndex._globalKey()
+            cached = {}
+            indexFile = SearchIndex._indexFile()
+            if os.path.isfile(indexFile):
+                try:
+                    with open(indexFile, "rb") as f:
+                        index = pickle.load(f)
+                    if index.key == key:
+                        cached = index.entries
+                except Exception as e:
+                    CraftCore.log.debug(f"Failed to load the search index: {e}")
+
+            entries = {}
+            changed = []
+            for p in CraftPackageObject.root().allChildren():
+                packageKey = SearchIndex._packageKey(p)
+                entry = cached.get(p.path, None)
+                if entry and entry[0] == packageKey:
+                    entries[p.path] = entry
+                else:
+                    changed.append((p, packageKey))
+            if changed:
+                CraftCore.log.info("Updating search cache:")
+                for i, (p, packageKey) in enumerate(changed):
+                    entries[p.path] = (packageKey, SeachPackage(p))
+                    utils.printProgress(int((i + 1) / len(changed) * 100))
+                CraftCore.log.info("")
+            SearchIndex._instance = SearchIndex(key, entries)
+            if changed or len(entries) != len(cached):
+                try:
+                    tmpFile = f"{indexFile}.{os.getpid()}.tmp"
+                    with open(tmpFile, "wb") as f:
+                        pickle.dump(SearchIndex._instance, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmpFile, indexFile)
+                except Exception as e:
+                    CraftCore.log.warning(f"Failed to save the search index {indexFile}: {e}")
+        return SearchIndex._instance
+
+    def _substringCandidates(self, text):
+        """Returns the paths of the packages whose path, description or tags might contain text"""
+        text = text.lower()
+        if SearchIndex._regexChars & set(text):
+            return None
+        if len(text) < 3:
+            if not re.fullmatch(r"[a-z0-9]+", text):
+                return None
+            # a short alphanumeric text can only be contained in a token
+            candidates = set()
+            for token, paths in self._tokens.items():
+                if text in token:
+                    candidates.update(paths)
+            return candidates
+        candidates = None
+        for trigram in self._trigramsOf(text):
+            paths = self._trigrams.get(trigram, set())
+            candidates = paths if candidates is None else candidates & paths
+            if not candidates:
+                break
+        return candidates or set()
+
+    def candidates(self, search, maxDist, isPath):
+        """Returns all packages that might match search, in the order of the blueprint tree"""
+        search = search.lower()
+        paths = {p.path for p in self._byString.get(search, [])}
+        paths.update(p.path for word in (self._paths if isPath else self._names).find(search, maxDist) for p in self._byString[word])
+        substring = self._substringCandidates(search)
+        if substring is None:
+            return self.packages
+        paths.update(substring)
+        return [p for p in self.packages if p.path in paths]
+
+
 def packages():
-    if not CraftCore.cache.availablePackages:
-        CraftCore.cache.availablePackages = []
-        CraftCore.log.info("Updating search cache:")
-        packages = CraftPackageObject.root().allChildren()
-        total = len(packages)
-        for p in packages:
-            package = SeachPackage(p)
-            CraftCore.cache.availablePackages.append(package)
-            percent = int(len(CraftCore.cache.availablePackages) / total * 100)
-            utils.printProgress(percent)
-        utils.printProgress(100)
-        CraftCore.log.info("")
-    return CraftCore.cache.availablePackages
+    return SearchIndex.instance().packages
 
 
 def printSearch(search_package, maxDist=2):
@@ -82,7 +260,7 @@ def printSearch(search_package, maxDist=2):
         similar = []
         match = None
         package_re = re.compile(f".*{search_package}.*", re.IGNORECASE)
-        for searchPackage in packages():
+        for searchPackage in SearchIndex.instance().candidates(search_package, maxDist, isPath):
             packageString =  searchPackage.path if isPath else searchPackage.name
             levDist = abs(len(searchPackageLower) - len(packageString))
             if levDist <= maxDist:
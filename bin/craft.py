@@ -121,6 +121,8 @@ def main():
     parser.add_argument("-i", "--ignoreInstalled", action="store_true",
                         help="ignore install: using this option will install a package over an existing install. This can be useful if you want to check some new code and your last build isn't that old.")
     parser.add_argument("--resolve-deps", action="store", help="Similar to -i, all dependencies will be resolved and the action is applied on them")
+    parser.add_argument("--ignore-dependencies", action="store_true", dest="ignoreDependencies",
+                        help="Only handle the given packages, their dependencies are neither resolved nor built.")
     parser.add_argument("--target", action="store",
                         help="This will override the build of the default target.")
     parser.add_argument("--search", action="store_true",
@@ -133,6 +135,9 @@ def main():
                         dest="ciMode", help="Enables the ci mode")
 
     parser.add_argument("--add-blueprint-repository", action="store", help="Installs a blueprint repository", metavar="URL")
+    parser.add_argument("--concurrent-packages", action="store", type=int, dest="concurrentPackages",
+                        default=int(CraftCore.settings.get("General", "ConcurrentPackages", "1")),
+                        help="The number of packages that are built at the same time, the output of each package is written to a log file in its build directory.")
 
     actionHandler = ActionHandler(parser)
     for x in sorted(["fetch", "fetch-binary", "unpack", "configure", ("compile",{"help":"Same as --configure --make"}), "make",
@@ -152,6 +157,8 @@ def main():
     actionHandler.addActionWithArg("set", help="Permanently set a config value of a Blueprint")
     actionHandler.addActionWithArg("run", nargs="+", help="Run an application in the Craft environment")
     actionHandler.addAction("clean-unused", help="Clean unused files of all packages")
+    actionHandler.addActionWithArg("evict-archive-store", metavar="SIZE",
+                                   help="Remove the least recently used downloaded binary cache archives until the archive store is smaller than SIZE, e.g. 10G")
 
     # other actions
 
@@ -172,6 +179,7 @@ def main():
     CraftCore.settings.set("Packager", "UseCache", not args.noCache and args.useCache)
     CraftCore.settings.set("ContinuousIntegration", "SourceDir", args.srcDir)
     CraftCore.settings.set("ContinuousIntegration", "Enabled", args.ciMode)
+    CraftCore.settings.set("General", "ConcurrentPackages", max(1, args.concurrentPackages))
 
 
     helper = CraftSetupHelper.SetupHelper()
@@ -194,6 +202,8 @@ def main():
         CraftCore.settings.set("Packager", "PackageType", "SevenZipPackager")
 
     UserOptions.setOptions(args.options)
+    # the options might enable the trace
+    CraftTimer.Tracer.configure()
     if args.search:
         for package in args.packageNames:
             blueprintSearch.printSearch(package)
@@ -231,6 +241,8 @@ def main():
             CraftCommands.cleanBuildFiles(cleanArchives=True, cleanImages=True, cleanInstalledImages=False, cleanBuildDir=True, packages=blueprintSearch.packages())
         elif action == "update":
             return CraftCommands.updateInstalled(tempArgs)
+        elif action == "evict-archive-store":
+            return CraftCommands.evictArchiveStore(tempArgs.evict_archive_store)
         else:
             if not packageNames:
                 return True
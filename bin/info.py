@@ -6,8 +6,10 @@
 # by methods to be able to separate the access from
 # the definition
 
+import datetime
+
 import VersionInfo
-from Utils import CraftHash, CraftManifest
+from Utils import CraftHash
 from options import *
 from CraftDebug import deprecated
 
@@ -99,6 +101,20 @@ class infoclass(object):
     def defaultTarget(self, value):
         self._defaultTarget = value
 
+    @property
+    def packageVersion(self) -> str:
+        """the version of the package, including the patch level
+        not called version, blueprints use that name for their own attributes"""
+        ver = self.buildTarget
+        if CraftCore.settings.getboolean("BlueprintVersions", "EnableDailyUpdates", True)\
+                and self.options.dailyUpdate and self.hasSvnTarget():
+            ver += "-" + str(datetime.date.today()).replace("-", ".")
+        elif self.options.dynamic.patchLevel:
+            ver += f"-{self.options.dynamic.patchLevel}"
+        elif self.buildTarget in self.patchLevel:
+            ver += f"-{self.patchLevel[self.buildTarget]}"
+        return ver
+
     def registerOptions(self):
         """calls to self.options.dynamic.registerOption
         #self.options.dynamic.registerOption("fullKDevelop", False)
@@ -251,13 +267,12 @@ class infoclass(object):
         for key, url in self.targets.items():
             if url.endswith("/"):
                 url = url[:-1]
-            json = CraftCore.cache.cacheJsonFromUrl(f"{url}/manifest.json")
-            if not json:
+            entry = CraftCore.manifestIndex.entry(f"{url}/manifest.json", packageName, compiler=f"windows-mingw_{CraftCore.compiler.bits}-gcc")
+            if not entry:
                 raise BlueprintException("Failed to load manifest", package)
-            manifest = CraftManifest.CraftManifest.fromJson(json)
-            if not packageName in manifest.packages[f"windows-mingw_{CraftCore.compiler.bits}-gcc"]:
+            if not entry.files:
                 CraftCore.log.warning(f"Failed to find {packageName} on {url}")
                 return
-            data = manifest.packages[f"windows-mingw_{CraftCore.compiler.bits}-gcc"][packageName].latest
+            data = entry.latest
             self.targets[key] = f"{url}/{data.fileName}"
             self.targetDigests[key] = (data.checksum, CraftHash.HashAlgorithm.SHA256)
@@ -111,6 +111,7 @@ class UserOptions(object):
         _register("buildTests", bool,   permanent=False)
         _register("buildStatic",bool,   permanent=False)
         _register("args",       "",     permanent=False)
+        _register("compressionProfile", str, permanent=False)
 
         settings = UserOptions.instance().settings
         if settings.has_section(package.path):
@@ -402,6 +403,10 @@ class OptionsPackage(OptionsBase):
         ##disable the binary cache for this package
         self.disableBinaryCache = False
 
+        ## the compression profile of the archives, fast, default or best
+        # overridden by the compressionProfile in BlueprintSettings.ini, defaults to [Packager]CompressionProfile
+        self.compressionProfile = None
+
         ## whether to move the plugins to bin
         self.movePluginsToBin = utils.OsUtils.isWin()
 
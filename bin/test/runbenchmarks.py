@@ -0,0 +1,564 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the hot paths of craft.
+
+All fixtures are generated in a temporary CraftRoot, nothing is downloaded.
+The results are printed as json, use --output to store them and --compare
+to compare them with the results of a different commit:
+
+    python3 runbenchmarks.py --output before.json
+    git checkout other-branch
+    python3 runbenchmarks.py --compare before.json
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(thisdir, os.pardir))
+
+from CraftCore import CraftCore
+import CraftStandardDirs
+import InstallDB
+import utils
+from options import UserOptions
+from Blueprints.CraftDependencyPackage import CraftDependencyPackage, DependencyGraph, DependencyType
+from Blueprints.CraftPackageObject import CraftPackageObject
+from Utils import CraftHash
+from Utils.CraftCache import CraftCache
+from Utils.CraftManifest import CraftManifest, ManifestIndex
+
+
+class BenchmarkBase(object):
+    """
+    prepare() creates the fixture once, setUp() and tearDown() are called around each
+    timed call of run().
+    """
+    name = None
+
+    def __init__(self, root : str, scale : float):
+        self.root = os.path.join(root, self.name)
+        self.scale = scale
+        os.makedirs(self.root)
+
+    @staticmethod
+    def available() -> bool:
+        """whether the tools the benchmark depends on are installed"""
+        return True
+
+    def scaled(self, count : int) -> int:
+        return max(1, int(count * self.scale))
+
+    def params(self) -> dict:
+        return {}
+
+    def prepare(self):
+        pass
+
+    def setUp(self):
+        pass
+
+    def run(self):
+        utils.abstract()
+
+    def tearDown(self):
+        pass
+
+    def metrics(self, seconds : float) -> dict:
+        """additional results like the throughput, computed from the median"""
+        return {}
+
+
+def _writeTree(root : str, files : int, seed : int=0) -> int:
+    """creates a directory tree with small files and a few larger ones, returns the size of the tree"""
+    rand = random.Random(seed)
+    size = 0
+    for i in range(files):
+        directory = os.path.join(root, f"dir{i % 10}", f"sub{i % 7}")
+        os.makedirs(directory, exist_ok=True)
+        length = 1024 * 1024 if i % 500 == 0 else rand.randint(100, 8000)
+        data = bytes(rand.getrandbits(8) for _ in range(min(length, 256))) * (length // 256 + 1)
+        with open(os.path.join(directory, f"file{i}.dat"), "wb") as f:
+            f.write(data[:length])
+        size += length
+    return size
+
+
+def _resetBlueprints():
+    CraftPackageObject._CraftPackageObject__rootPackage = None
+    CraftPackageObject._CraftPackageObject__rootDirectories = []
+    CraftPackageObject._allLeaves = {}
+    CraftPackageObject._recipes = {}
+    CraftDependencyPackage.clearCache()
+
+
+class BlueprintsBenchmark(BenchmarkBase):
+    """
+    A synthetic blueprint repository, every package depends on a few of the packages
+    created before it which results in a deep dependency graph.
+    """
+    categories = 20
+
+    def params(self):
+        return {"packages": self.scaled(2000), "categories": self.categories}
+
+    def prepare(self):
+        rand = random.Random(42)
+        count = self.params()["packages"]
+        repository = os.path.join(self.root, "blueprints", "benchmark")
+        self.packages = []
+        for i in range(count):
+            category = f"bench{i % self.categories}"
+            name = f"bench-package{i}"
+            self.packages.append(f"{category}/{name}")
+            runtimeDependencies = {self.packages[rand.randint(max(0, i - 50), i - 1)] for _ in range(min(i, rand.randint(0, 4)))}
+            buildDependencies = {self.packages[rand.randint(0, i - 1)] for _ in range(min(i, rand.randint(0, 2)))}
+            blueprintDir = os.path.join(repository, category, name)
+            os.makedirs(blueprintDir)
+            with open(os.path.join(blueprintDir, f"{name}.py"), "wt") as f:
+                f.write("import info\n\n\n"
+                        "class subinfo(info.infoclass):\n"
+                        "    def setTargets(self):\n"
+                        "        self.targets['1.0'] = ''\n"
+                        "        self.description = 'A synthetic package'\n"
+                        "        self.defaultTarget = '1.0'\n\n"
+                        "    def setDependencies(self):\n"
+                        "        pass\n")
+                for dep in sorted(runtimeDependencies):
+                    f.write(f"        self.runtimeDependencies['{dep}'] = None\n")
+                for dep in sorted(buildDependencies):
+                    f.write(f"        self.buildDependencies['{dep}'] = None\n")
+                f.write("\n\nfrom Package.VirtualPackageBase import *\n\n\n"
+                        "class Package(VirtualPackageBase):\n"
+                        "    def __init__(self):\n"
+                        "        VirtualPackageBase.__init__(self)\n")
+        CraftCore.settings.set("Blueprints", "BlueprintRoot", os.path.join(self.root, "blueprints"))
+        _resetBlueprints()
+
+
+class BlueprintsRootCold(BlueprintsBenchmark):
+    name = "blueprints.root.cold"
+
+    def setUp(self):
+        _resetBlueprints()
+        utils.deleteFile(CraftPackageObject._indexFile())
+
+    def run(self):
+        CraftPackageObject.root()
+
+
+class BlueprintsRootWarm(BlueprintsBenchmark):
+    name = "blueprints.root.warm"
+
+    def prepare(self):
+        super().prepare()
+        CraftPackageObject.root()
+
+    def setUp(self):
+        _resetBlueprints()
+
+    def run(self):
+        CraftPackageObject.root()
+
+
+class Dependencies(BlueprintsBenchmark):
+    name = "dependencies.getDependencies"
+
+    def prepare(self):
+        super().prepare()
+        # import all blueprints up front, we only want to measure the graph traversal
+        for path in self.packages:
+            CraftPackageObject.get(path).instance
+
+    def setUp(self):
+        CraftDependencyPackage.clearCache()
+        utils.deleteFile(DependencyGraph._graphFile())
+
+    def run(self):
+        for path in self.packages[-10:]:
+            CraftDependencyPackage(CraftPackageObject.get(path)).getDependencies(DependencyType.All)
+
+
+class DependenciesPersisted(Dependencies):
+    name = "dependencies.getDependencies.persisted"
+
+    def prepare(self):
+        super().prepare()
+        self.run()
+
+    def setUp(self):
+        CraftDependencyPackage.clearCache()
+
+
+class _InstalledPackage(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+
+class InstallDBBenchmark(BenchmarkBase):
+    def params(self):
+        return {"packages": self.scaled(100), "filesPerPackage": 1000}
+
+    def fill(self, db : InstallDB.InstallDB):
+        params = self.params()
+        for i in range(params["packages"]):
+            package = db.addInstalled(_InstalledPackage(f"bench/package{i}"), "1.0")
+            package.addFiles({f"lib/package{i}/plugin{j}.so": f"{i:032x}{j:032x}" for j in range(params["filesPerPackage"])})
+            package.install()
+
+
+class InstallDBInsert(InstallDBBenchmark):
+    name = "installdb.insert"
+
+    def setUp(self):
+        self.db = InstallDB.InstallDB(os.path.join(self.root, "install.db"))
+
+    def run(self):
+        self.fill(self.db)
+
+    def tearDown(self):
+        self.db.connection.close()
+        for suffix in ["", "-wal", "-shm"]:
+            utils.deleteFile(os.path.join(self.root, "install.db" + suffix))
+
+    def metrics(self, seconds):
+        params = self.params()
+        return {"filesPerSecond": params["packages"] * params["filesPerPackage"] / seconds}
+
+
+class InstallDBQuery(InstallDBBenchmark):
+    name = "installdb.query"
+
+    def prepare(self):
+        self.db = InstallDB.InstallDB(os.path.join(self.root, "install.db"))
+        self.fill(self.db)
+
+    def run(self):
+        for i in range(self.params()["packages"]):
+            package = _InstalledPackage(f"bench/package{i}")
+            self.db.isInstalled(package.path)
+            for installed in self.db.getInstalledPackages(package):
+                installed.getFilesWithHashes()
+        for i in range(20):
+            self.db.getPackagesForFileSearch(f"plugin{i * 37}.so")
+
+
+class DigestFile(BenchmarkBase):
+    name = "crafthash.digestFile"
+
+    def params(self):
+        return {"size": self.scaled(256) * 1024 * 1024}
+
+    def prepare(self):
+        self.file = os.path.join(self.root, "data")
+        with open(self.file, "wb") as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(self.params()["size"] // len(chunk)):
+                f.write(chunk)
+
+    def run(self):
+        CraftHash.digestFile(self.file, CraftHash.HashAlgorithm.SHA256)
+
+    def metrics(self, seconds):
+        return {"MiBPerSecond": self.params()["size"] / 1024 ** 2 / seconds}
+
+
+class CopyDir(BenchmarkBase):
+    name = "utils.copyDir"
+
+    def params(self):
+        return {"files": self.scaled(5000)}
+
+    def prepare(self):
+        self.src = os.path.join(self.root, "src")
+        self.size = _writeTree(self.src, self.params()["files"])
+        self.dest = os.path.join(self.root, "dest")
+
+    def run(self):
+        utils.copyDir(self.src, self.dest, linkOnly=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+
+    def metrics(self, seconds):
+        return {"filesPerSecond": self.params()["files"] / seconds}
+
+
+class MergeTree(CopyDir):
+    name = "utils.mergeTree"
+
+    def setUp(self):
+        self.tmp = os.path.join(self.root, "tmp")
+        shutil.copytree(self.src, self.tmp)
+        # create the directories up front, otherwise mergeTree just renames the top level directories
+        for root, dirs, _ in os.walk(self.src):
+            os.makedirs(os.path.join(self.dest, os.path.relpath(root, self.src)), exist_ok=True)
+
+    def run(self):
+        utils.mergeTree(self.tmp, self.dest)
+
+    def tearDown(self):
+        shutil.rmtree(self.dest)
+        if os.path.exists(self.tmp):
+            shutil.rmtree(self.tmp)
+
+
+class DigestFiles(CopyDir):
+    name = "crafthash.digestFiles"
+
+    def prepare(self):
+        super().prepare()
+        self.files = [os.path.join(root, f) for root, _, files in os.walk(self.src) for f in files]
+
+    def run(self):
+        CraftHash.digestFiles(self.files, CraftHash.HashAlgorithm.SHA256)
+
+    def tearDown(self):
+        pass
+
+    def metrics(self, seconds):
+        return {"filesPerSecond": self.params()["files"] / seconds, "MiBPerSecond": self.size / 1024 ** 2 / seconds}
+
+
+class UnpackBenchmark(CopyDir):
+    archiveName = None
+
+    def prepare(self):
+        super().prepare()
+        self.archive = os.path.join(self.root, self.archiveName)
+        self.createArchive()
+
+    def run(self):
+        utils.unpackFile(self.root, self.archiveName, self.dest)
+
+
+class UnpackTar(UnpackBenchmark):
+    name = "utils.unpackFile.tar.xz"
+    archiveName = "archive.tar.xz"
+
+    def createArchive(self):
+        with tarfile.open(self.archive, "w:xz", preset=1) as tar:
+            tar.add(self.src, arcname="src")
+
+
+class UnpackZip(UnpackBenchmark):
+    name = "utils.unpackFile.zip"
+    archiveName = "archive.zip"
+
+    def createArchive(self):
+        with zipfile.ZipFile(self.archive, "w", zipfile.ZIP_DEFLATED) as archive:
+            for root, _, files in os.walk(self.src):
+                for f in files:
+                    path = os.path.join(root, f)
+                    archive.write(path, os.path.relpath(path, self.root))
+
+
+class UnpackTarZstd(UnpackBenchmark):
+    name = "utils.unpackFile.tar.zst"
+    archiveName = "archive.tar.zst"
+
+    @staticmethod
+    def available() -> bool:
+        return bool(CraftCore.cache.findApplication("zstd"))
+
+    def createArchive(self):
+        utils.compress(self.archive, self.src)
+
+
+class CompressTarZstd(CopyDir):
+    name = "utils.compress.tar.zst"
+
+    @staticmethod
+    def available() -> bool:
+        return bool(CraftCore.cache.findApplication("zstd"))
+
+    def setUp(self):
+        self.archive = os.path.join(self.root, "archive.tar.zst")
+
+    def run(self):
+        utils.compress(self.archive, self.src)
+
+    def tearDown(self):
+        os.remove(self.archive)
+
+    def metrics(self, seconds):
+        return {"MiBPerSecond": self.size / 1024 ** 2 / seconds}
+
+
+class CacheBenchmark(BenchmarkBase):
+    def params(self):
+        return {"entries": self.scaled(10000)}
+
+    def fill(self, cache : CraftCache):
+        for i in range(self.params()["entries"]):
+            cache._outputCache[f"\"app{i}\" --version"] = (0, f"app{i} version 1.{i}\n" * 5)
+            cache._helpCache[(f"app{i}", "-h")] = f"usage: app{i} [options]\n" * 20
+        for i in range(self.params()["entries"] // 100):
+            cache._jsonCache[f"https://example.com/{i}.json"] = {"versions": [f"1.{j}" for j in range(50)]}
+
+
+class CacheWrite(CacheBenchmark):
+    name = "craftcache.write"
+
+    def setUp(self):
+        self.cache = CraftCache._loadInstance()
+        self.cache.store.clear()
+
+    def run(self):
+        self.fill(self.cache)
+
+    def tearDown(self):
+        self.cache.store.connection.close()
+
+
+class CacheLoad(CacheBenchmark):
+    """start-up and the lookups of a typical run, independent of the size of the cache"""
+    name = "craftcache.load"
+
+    def prepare(self):
+        cache = CraftCache._loadInstance()
+        cache.store.clear()
+        self.fill(cache)
+        cache.store.connection.close()
+
+    def run(self):
+        self.cache = CraftCache._loadInstance()
+        for i in range(0, self.params()["entries"], max(1, self.params()["entries"] // 100)):
+            self.cache._outputCache[f"\"app{i}\" --version"]
+            self.cache._helpCache[(f"app{i}", "-h")]
+
+    def tearDown(self):
+        self.cache.store.connection.close()
+
+
+class ManifestLookup(BenchmarkBase):
+    """the lookups of fetchBinary in the manifest of a big binary cache"""
+    name = "craftmanifest.entry"
+
+    def params(self):
+        return {"packages": self.scaled(5000), "lookups": self.scaled(200)}
+
+    def prepare(self):
+        manifest = CraftManifest()
+        for i in range(self.params()["packages"]):
+            entry = manifest.get(f"libs/package{i}")
+            for j in range(5):
+                entry.addFile(f"libs/package{i}/package{i}-1.{j}-{CraftCore.compiler}.tar.7z", f"{i:064x}", version=f"1.{j}")
+        self.manifestFile = os.path.join(self.root, "manifest.json")
+        manifest.dump(self.manifestFile)
+        self.index = ManifestIndex(os.path.join(self.root, "manifests.sqlite"))
+        # the manifest is indexed once, like on the first run
+        self.index.refresh(self.manifestFile)
+
+    def run(self):
+        step = max(1, self.params()["packages"] // self.params()["lookups"])
+        for i in range(0, self.params()["packages"], step):
+            self.index.entry(self.manifestFile, f"libs/package{i}").latestFor("1.4", ["tar.7z"])
+
+
+BENCHMARKS = [BlueprintsRootCold, BlueprintsRootWarm, Dependencies, DependenciesPersisted, InstallDBInsert, InstallDBQuery, DigestFile,
+              CopyDir, MergeTree, DigestFiles, UnpackTar, UnpackZip, UnpackTarZstd, CompressTarZstd, CacheWrite, CacheLoad,
+              ManifestLookup]
+
+
+def runBenchmark(benchmark : BenchmarkBase, repeat : int) -> dict:
+    benchmark.prepare()
+    times = []
+    for _ in range(repeat):
+        benchmark.setUp()
+        start = time.perf_counter()
+        benchmark.run()
+        times.append(time.perf_counter() - start)
+        benchmark.tearDown()
+    median = statistics.median(times)
+    result = {"min": min(times), "median": median, "max": max(times), "repeat": repeat, "params": benchmark.params()}
+    result.update(benchmark.metrics(median))
+    return result
+
+
+def gitRevision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=thisdir, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline : dict, results : dict):
+    print(f"{'benchmark':40} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if not old:
+            print(f"{name:40} {'-':>10} {result['median']:10.4f}")
+            continue
+        print(f"{name:40} {old['median']:10.4f} {result['median']:10.4f} {result['median'] / old['median'] - 1:+8.1%}")
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.set_defaults(verbosity=0)
+    parser.add_option("-v", "--verbose", action="store_const", const=3, dest="verbosity")
+    parser.add_option("-f", "--filter", action="store", dest="filter", default=None,
+                      help="only run the benchmarks matching the regular expression")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat", default=5)
+    parser.add_option("-s", "--scale", action="store", type="float", dest="scale", default=1.0,
+                      help="scale the size of the fixtures")
+    parser.add_option("-o", "--output", action="store", dest="output", default=None,
+                      help="write the json results to a file")
+    parser.add_option("-c", "--compare", action="store", dest="compare", default=None,
+                      help="compare the results with the json results of a previous run")
+    opts, rest = parser.parse_args()
+
+    CraftCore.debug.setVerbose(opts.verbosity)
+
+    results = {"revision": gitRevision(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "scale": opts.scale,
+               "benchmarks": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        craftRoot = os.path.join(tmp, "craftroot")
+        CraftCore.standardDirs = CraftStandardDirs.CraftStandardDirs(craftRoot)
+        os.makedirs(CraftCore.standardDirs.etcBlueprintDir())
+        CraftCore.settings.set("Blueprints", "Settings", os.path.join(craftRoot, "BlueprintSettings.ini"))
+        CraftCore.settings.set("CraftDebug", "TraceFile", "")
+        for benchmarkClass in BENCHMARKS:
+            if opts.filter and not re.search(opts.filter, benchmarkClass.name):
+                continue
+            if not benchmarkClass.available():
+                print(f"Skipping {benchmarkClass.name}", file=sys.stderr)
+                continue
+            print(f"Running {benchmarkClass.name}", file=sys.stderr)
+            results["benchmarks"][benchmarkClass.name] = runBenchmark(benchmarkClass(tmp, opts.scale), opts.repeat)
+        # don't write the BlueprintSettings.ini of the temporary root at exit
+        UserOptions.UserOptionsSingleton._instance = None
+
+    if opts.output:
+        with open(opts.output, "wt") as f:
+            json.dump(results, f, indent=2)
+    if opts.compare:
+        with open(opts.compare, "rt") as f:
+            compare(json.load(f), results)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
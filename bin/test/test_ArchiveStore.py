@@ -0,0 +1,99 @@
+import hashlib
+import os
+import tempfile
+
+import CraftTestBase
+from Utils.ArchiveStore import ArchiveStore
+
+
+class ArchiveStoreTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.downloadCacheDir = os.path.join(self.tmpDir.name, "download", "cache")
+        self.store = ArchiveStore(os.path.join(self.tmpDir.name, "store"), downloadCacheDir=self.downloadCacheDir)
+
+    def tearDown(self):
+        self.store.connection.close()
+        del self.tmpDir
+        super().tearDown()
+
+    def createFile(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return hashlib.sha256(data).hexdigest()
+
+
+class TestAPI(ArchiveStoreTest):
+    def test_deduplicate(self):
+        first = os.path.join(self.downloadCacheDir, "a", "archive.tar.7z")
+        second = os.path.join(self.tmpDir.name, "packages", "archive.tar.7z")
+        digest = self.createFile(first, b"archive")
+        self.createFile(second, b"archive")
+        self.assertTrue(self.store.add(first, digest))
+        self.assertTrue(self.store.add(second, digest))
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertTrue(os.path.samefile(first, self.store.objectPath(digest)))
+        self.assertEqual(self.store.size(), len(b"archive"))
+
+        restored = os.path.join(self.downloadCacheDir, "b", "archive.tar.7z")
+        self.assertTrue(self.store.link(digest, restored))
+        self.assertTrue(os.path.samefile(restored, first))
+        self.assertFalse(self.store.link("0" * 64, os.path.join(self.tmpDir.name, "missing")))
+
+    def test_corruptedObject(self):
+        path = os.path.join(self.downloadCacheDir, "archive.tar.7z")
+        digest = self.createFile(path, b"archive")
+        self.assertTrue(self.store.add(path, digest))
+        os.unlink(path)
+        # corrupt the object, the link must not restore it
+        with open(self.store.objectPath(digest), "wb") as f:
+            f.write(b"corrupt")
+        self.assertFalse(self.store.link(digest, path))
+        self.assertFalse(self.store.contains(digest))
+        self.assertFalse(os.path.exists(path))
+
+        # a verified file replaces a corrupted object
+        self.createFile(self.store.objectPath(digest), b"corrupt")
+        self.createFile(path, b"archive")
+        self.assertTrue(self.store.add(path, digest))
+        with open(self.store.objectPath(digest), "rb") as f:
+            self.assertEqual(f.read(), b"archive")
+
+    def test_evict(self):
+        paths = {}
+        for name in ["unused", "old", "new"]:
+            path = os.path.join(self.downloadCacheDir, f"{name}.tar.7z")
+            paths[name] = (path, self.createFile(path, name.encode() * 100))
+            self.assertTrue(self.store.add(path, paths[name][1]))
+        published = os.path.join(self.tmpDir.name, "cache", "published.tar.7z")
+        publishedDigest = self.createFile(published, b"published" * 100)
+        self.assertTrue(self.store.add(published, publishedDigest))
+        os.unlink(paths["unused"][0])
+        # new was used last
+        self.assertTrue(self.store.link(paths["new"][1], paths["new"][0]))
+
+        self.assertTrue(self.store.evict(self.store.size() - 1))
+        self.assertFalse(self.store.contains(paths["unused"][1]))
+        self.assertTrue(self.store.contains(paths["old"][1]))
+
+        self.assertTrue(self.store.evict(self.store.size() - 1))
+        self.assertFalse(self.store.contains(paths["old"][1]))
+        self.assertFalse(os.path.exists(paths["old"][0]))
+        self.assertTrue(self.store.contains(paths["new"][1]))
+
+        # the archives of the packager are never deleted
+        self.assertTrue(self.store.evict(0))
+        self.assertFalse(os.path.exists(paths["new"][0]))
+        self.assertTrue(os.path.isfile(published))
+        self.assertTrue(self.store.contains(publishedDigest))
+
+    def test_parseSize(self):
+        self.assertEqual(ArchiveStore.parseSize("100"), 100)
+        self.assertEqual(ArchiveStore.parseSize("1K"), 1024)
+        self.assertEqual(ArchiveStore.parseSize("500M"), 500 * 1024 ** 2)
+        self.assertEqual(ArchiveStore.parseSize("1.5GiB"), int(1.5 * 1024 ** 3))
+        self.assertEqual(ArchiveStore.parseSize(" 2tb "), 2 * 1024 ** 4)
+        with self.assertRaises(ValueError):
+            ArchiveStore.parseSize("10X")
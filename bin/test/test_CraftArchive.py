@@ -0,0 +1,124 @@
+import io
+import os
+import stat
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import CraftTestBase
+from CraftCore import CraftCore
+from Utils import CraftArchive
+
+
+class CraftArchiveTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpDir.name, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        self.file = os.path.join(self.src, "sub", "file.txt")
+        with open(self.file, "wt") as out:
+            out.write("craft")
+        os.chmod(self.file, 0o751)
+        os.symlink(os.path.join("sub", "file.txt"), os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        del self.tmpDir
+        super().tearDown()
+
+    def checkTree(self, dest):
+        file = os.path.join(dest, "src", "sub", "file.txt")
+        with open(file, "rt") as f:
+            self.assertEqual(f.read(), "craft")
+        self.assertEqual(stat.S_IMODE(os.stat(file).st_mode), 0o751)
+        self.assertEqual(os.readlink(os.path.join(dest, "src", "link")), os.path.join("sub", "file.txt"))
+
+
+class TestAPI(CraftArchiveTest):
+    def test_tar(self):
+        for mode, ext in [("w:gz", ".tar.gz"), ("w:bz2", ".tar.bz2"), ("w:xz", ".tar.xz")]:
+            archive = os.path.join(self.tmpDir.name, f"archive{ext}")
+            with tarfile.open(archive, mode) as tar:
+                tar.add(self.src, arcname="src")
+            self.assertTrue(CraftArchive.canExtract(archive))
+            dest = os.path.join(self.tmpDir.name, ext)
+            self.assertTrue(CraftArchive.extract(archive, dest))
+            self.checkTree(dest)
+
+    def test_zip(self):
+        archive = os.path.join(self.tmpDir.name, "archive.zip")
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zipFile:
+            zipFile.write(self.file, "src/sub/file.txt")
+            info = zipfile.ZipInfo("src/link")
+            info.external_attr = (stat.S_IFLNK | 0o777) << 16
+            zipFile.writestr(info, os.path.join("sub", "file.txt"))
+        dest = os.path.join(self.tmpDir.name, "zip")
+        self.assertTrue(CraftArchive.extract(archive, dest))
+        self.checkTree(dest)
+
+    @unittest.skipUnless(CraftCore.cache.findApplication("zstd"), "zstd is not installed")
+    def test_zstd(self):
+        archive = os.path.join(self.tmpDir.name, "archive.tar.zst")
+        self.assertTrue(CraftArchive.canCreate(archive))
+        self.assertTrue(CraftArchive.create(archive, self.src))
+        dest = os.path.join(self.tmpDir.name, "zstd")
+        self.assertTrue(CraftArchive.extract(archive, os.path.join(dest, "src")))
+        self.checkTree(dest)
+
+    def test_replaceHardlink(self):
+        archive = os.path.join(self.tmpDir.name, "archive.tar")
+        with tarfile.open(archive, "w") as tar:
+            tar.add(self.src, arcname="src")
+        dest = os.path.join(self.tmpDir.name, "dest")
+        os.makedirs(os.path.join(dest, "src", "sub"))
+        other = os.path.join(self.tmpDir.name, "other.txt")
+        with open(other, "wt") as out:
+            out.write("other")
+        os.link(other, os.path.join(dest, "src", "sub", "file.txt"))
+        self.assertTrue(CraftArchive.extract(archive, dest))
+        self.checkTree(dest)
+        with open(other, "rt") as f:
+            self.assertEqual(f.read(), "other")
+
+    def test_outsideOfDest(self):
+        archive = os.path.join(self.tmpDir.name, "archive.tar")
+        with tarfile.open(archive, "w") as tar:
+            info = tarfile.TarInfo("../evil.txt")
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b"x"))
+        with self.assertRaises(CraftArchive.ExtractionError):
+            CraftArchive.extract(archive, os.path.join(self.tmpDir.name, "dest"))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir.name, "evil.txt")))
+
+    def test_hardlinkThroughSymlink(self):
+        outside = os.path.join(self.tmpDir.name, "outside")
+        os.makedirs(outside)
+        with open(os.path.join(outside, "secret"), "wt") as out:
+            out.write("secret")
+        for linkname in ["ldir/secret", "lfile"]:
+            archive = os.path.join(self.tmpDir.name, "archive.tar")
+            with tarfile.open(archive, "w") as tar:
+                info = tarfile.TarInfo("ldir")
+                info.type = tarfile.SYMTYPE
+                info.linkname = outside
+                tar.addfile(info)
+                info = tarfile.TarInfo("lfile")
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.path.join(outside, "secret")
+                tar.addfile(info)
+                info = tarfile.TarInfo("h")
+                info.type = tarfile.LNKTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+            dest = os.path.join(self.tmpDir.name, "dest")
+            with self.assertRaises(CraftArchive.ExtractionError):
+                CraftArchive.extract(archive, dest)
+            self.assertFalse(os.path.exists(os.path.join(dest, "h")))
+
+    def test_unsupported(self):
+        archive = os.path.join(self.tmpDir.name, "archive.tar.gz")
+        with open(archive, "wb") as out:
+            out.write(b"no archive")
+        self.assertFalse(CraftArchive.extract(archive, os.path.join(self.tmpDir.name, "dest")))
+
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+
+import CraftTestBase
+from Utils.CraftCache import CacheNamespace, CacheStore
+
+
+class CraftCacheTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self.cacheFile = os.path.join(self.kdeRoot.name, "cache.sqlite")
+        self.store = CacheStore(self.cacheFile)
+
+    def tearDown(self):
+        self.store.connection.close()
+        super().tearDown()
+
+    def reopen(self):
+        self.store.connection.close()
+        self.store = CacheStore(self.cacheFile)
+
+    def rowCount(self):
+        return self.store.connection.execute("SELECT COUNT(*) FROM cache;").fetchone()[0]
+
+
+class TestAPI(CraftCacheTest):
+    def test_persistent(self):
+        self.store.set("test", ("key", 1), {"value": [1, 2]}, 60)
+        self.reopen()
+        self.assertEqual(self.store.get("test", ("key", 1)), {"value": [1, 2]})
+        self.assertEqual(self.store.get("other", ("key", 1), "default"), "default")
+
+    def test_expiry(self):
+        self.store.set("test", "expired", 1, -1)
+        self.store.set("test", "valid", 2, 60)
+        self.store.set("test", "forever", 3, float("inf"))
+        self.assertEqual(self.store.get("test", "expired", "default"), "default")
+        self.assertEqual(self.store.get("test", "valid"), 2)
+        self.assertEqual(self.store.get("test", "forever"), 3)
+        # the expired entries are purged when the cache is opened
+        self.assertEqual(self.rowCount(), 3)
+        self.reopen()
+        self.assertEqual(self.rowCount(), 2)
+        self.assertEqual(self.store.get("test", "forever"), 3)
+
+    def test_namespaceTtl(self):
+        namespace = CacheNamespace(self.store, "test", 60)
+        namespace["default"] = 1
+        namespace.set("expired", 2, ttl=-1)
+        namespace.update({"a": 3, "b": 4}, ttl=-1)
+        # the entries of the namespace itself are cached in memory
+        self.assertEqual(namespace["expired"], 2)
+        namespace = CacheNamespace(self.store, "test", 60)
+        self.assertEqual(namespace["default"], 1)
+        self.assertNotIn("expired", namespace)
+        self.assertNotIn("a", namespace)
+        self.assertEqual(namespace.get("b", "default"), "default")
+        with self.assertRaises(KeyError):
+            namespace["b"]
+        namespace.clear()
+        self.assertEqual(self.rowCount(), 0)
+
+    def test_schemaReset(self):
+        self.store.set("test", "key", 1, 60)
+        self.store.connection.execute(f"PRAGMA user_version={CacheStore.SCHEMA_VERSION - 1};")
+        self.reopen()
+        self.assertEqual(self.store.connection.execute("PRAGMA user_version;").fetchone()[0], CacheStore.SCHEMA_VERSION)
+        self.assertEqual(self.rowCount(), 0)
+        self.store.set("test", "key", 2, 60)
+        self.assertEqual(self.store.get("test", "key"), 2)
+
+    def test_memoryFallback(self):
+        store = CacheStore(os.path.join(self.kdeRoot.name, "missing", "cache.sqlite"))
+        try:
+            self.assertEqual(store.connection.execute("PRAGMA database_list;").fetchone()[2], "")
+            store.set("test", "key", 1, 60)
+            self.assertEqual(store.get("test", "key"), 1)
+        finally:
+            store.connection.close()
+        self.assertFalse(os.path.exists(os.path.join(self.kdeRoot.name, "missing")))
+
+    def test_setManyRollback(self):
+        self.store.set("test", "a", 1, 60)
+        self.store.connection.execute("""CREATE TRIGGER failingInsert BEFORE INSERT ON cache WHEN new.key = "'bad'"
+                                         BEGIN SELECT RAISE(ABORT, 'failed'); END;""")
+        self.store.setMany("test", {"a": 2, "b": 3, "bad": 4}, 60)
+        self.assertFalse(self.store.connection.in_transaction)
+        self.assertEqual(self.store.get("test", "a"), 1)
+        self.assertEqual(self.store.get("test", "b", "default"), "default")
+        self.store.setMany("test", {"a": 2, "b": 3}, 60)
+        self.assertEqual(self.store.get("test", "a"), 2)
+        self.assertEqual(self.store.get("test", "b"), 3)
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import CraftTestBase
+import CraftCommands
+
+
+class FakePackage(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+
+class CraftCommandsTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self._directDependencies = CraftCommands._directDependencies
+        self._handlePackageInSubprocess = CraftCommands._handlePackageInSubprocess
+        self.graph = {}
+        self.packages = {}
+        CraftCommands._directDependencies = lambda package: [self.package(dep) for dep in self.graph.get(package.path, [])]
+
+    def tearDown(self):
+        CraftCommands._directDependencies = self._directDependencies
+        CraftCommands._handlePackageInSubprocess = self._handlePackageInSubprocess
+        super().tearDown()
+
+    def package(self, path):
+        if path not in self.packages:
+            self.packages[path] = FakePackage(path)
+        return self.packages[path]
+
+    def buildList(self, paths):
+        return [self.package(path) for path in paths]
+
+
+class TestAPI(CraftCommandsTest):
+    def test_diamond(self):
+        self.graph = {"top": ["left", "right"], "left": ["base"], "right": ["base"], "base": ["external"]}
+        requirements = CraftCommands._buildRequirements(self.buildList(["base", "left", "right", "top"]))
+        self.assertEqual(requirements, {"base": set(), "left": {"base"}, "right": {"base"}, "top": {"base", "left", "right"}})
+
+    def test_cycle(self):
+        # c is reached through the cycle a -> b -> a first, its closure must not be cut at a
+        self.graph = {"d": ["a"], "a": ["b"], "b": ["a", "c"], "c": ["b", "e"], "e": []}
+        requirements = CraftCommands._buildRequirements(self.buildList(["e", "c", "b", "a", "d"]))
+        self.assertEqual(requirements, {"e": set(), "c": {"e"}, "b": {"e", "c"}, "a": {"e", "c", "b"}, "d": {"e", "c", "b", "a"}})
+        requirements = CraftCommands._buildRequirements(self.buildList(["d", "a", "b", "c", "e"]))
+        self.assertEqual(requirements, {"d": set(), "a": set(), "b": {"a"}, "c": {"a", "b"}, "e": set()})
+
+    def test_largeCycle(self):
+        # every package of the cycle reaches the others, the closure is computed once per component
+        paths = [f"p{i}" for i in range(200)]
+        self.graph = {path: paths[:i] + paths[i + 1:] for i, path in enumerate(paths)}
+        calls = []
+        directDependencies = CraftCommands._directDependencies
+        CraftCommands._directDependencies = lambda package: calls.append(package.path) or directDependencies(package)
+        requirements = CraftCommands._buildRequirements(self.buildList(paths))
+        self.assertEqual(len(calls), len(paths))
+        for i, path in enumerate(paths):
+            self.assertEqual(requirements[path], set(paths[:i]))
+
+    def test_runParallel(self):
+        self.graph = {"top": ["left", "right"], "left": ["base"], "right": ["base"]}
+        finished = []
+        lock = threading.Lock()
+
+        def handle(package, buildAction, args, directTargets):
+            with lock:
+                for dep in self.graph.get(package.path, []):
+                    self.assertIn(dep, finished)
+            time.sleep(0.01)
+            with lock:
+                finished.append(package.path)
+            return True
+
+        CraftCommands._handlePackageInSubprocess = handle
+        self.assertTrue(CraftCommands._runParallel(self.buildList(["base", "left", "right", "top"]), "all", None, [], 2))
+        self.assertEqual(finished[0], "base")
+        self.assertEqual(finished[-1], "top")
+
+    def test_runParallelFailure(self):
+        self.graph = {"top": ["base"]}
+        started = []
+
+        def handle(package, buildAction, args, directTargets):
+            started.append(package.path)
+            return package.path != "base"
+
+        CraftCommands._handlePackageInSubprocess = handle
+        self.assertFalse(CraftCommands._runParallel(self.buildList(["base", "top"]), "all", None, [], 2))
+        self.assertEqual(started, ["base"])
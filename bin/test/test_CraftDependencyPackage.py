@@ -0,0 +1,149 @@
+import os
+from collections import OrderedDict
+
+import CraftTestBase
+from Blueprints.CraftDependencyPackage import CraftDependencyPackage, DependencyGraph, DependencyType
+from Blueprints.CraftPackageObject import CraftPackageObject
+from CraftCore import CraftCore
+from options import UserOptions
+
+
+class CraftDependencyPackageTest(CraftTestBase.CraftTestBase):
+    # name -> (runtime dependencies, build dependencies)
+    blueprints = {
+        # a diamond
+        "top": (["left", "right", "ignored"], ["tool"]),
+        "left": (["base"], []),
+        "right": (["base"], ["tool"]),
+        "base": (["cycle-a"], []),
+        # a cycle
+        "cycle-a": (["cycle-b"], []),
+        "cycle-b": (["cycle-a", "leaf"], []),
+        "leaf": ([], []),
+        "tool": ([], ["leaf"]),
+        "ignored": (["ignored-dep"], []),
+        "ignored-dep": ([], []),
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.blueprintRoot = os.path.join(self.kdeRoot.name, "blueprints")
+        for name, (runtimeDependencies, buildDependencies) in self.blueprints.items():
+            blueprintDir = os.path.join(self.blueprintRoot, "fixture", "fixture", name)
+            os.makedirs(blueprintDir)
+            with open(os.path.join(blueprintDir, f"{name}.py"), "wt") as f:
+                f.write("import info\n\n\n"
+                        "class subinfo(info.infoclass):\n"
+                        "    def setTargets(self):\n"
+                        "        self.targets['1.0'] = ''\n"
+                        "        self.defaultTarget = '1.0'\n\n"
+                        "    def setDependencies(self):\n"
+                        "        pass\n")
+                for dep in runtimeDependencies:
+                    f.write(f"        self.runtimeDependencies['fixture/{dep}'] = None\n")
+                for dep in buildDependencies:
+                    f.write(f"        self.buildDependencies['fixture/{dep}'] = None\n")
+                f.write("\n\nfrom Package.VirtualPackageBase import *\n\n\n"
+                        "class Package(VirtualPackageBase):\n"
+                        "    def __init__(self):\n"
+                        "        VirtualPackageBase.__init__(self)\n")
+        with open(CraftCore.settings.get("Blueprints", "Settings"), "wt") as f:
+            f.write("[fixture/ignored]\nignored = True\n")
+        self.blueprintRootSetting = CraftCore.settings.get("Blueprints", "BlueprintRoot")
+        CraftCore.settings.set("Blueprints", "BlueprintRoot", self.blueprintRoot)
+        self.resetBlueprints()
+
+    def tearDown(self):
+        CraftCore.settings.set("Blueprints", "BlueprintRoot", self.blueprintRootSetting)
+        self.resetBlueprints()
+        super().tearDown()
+
+    @staticmethod
+    def resetBlueprints():
+        CraftPackageObject._CraftPackageObject__rootPackage = None
+        CraftPackageObject._CraftPackageObject__rootDirectories = []
+        CraftPackageObject._allLeaves = {}
+        CraftPackageObject._recipes = {}
+        UserOptions.UserOptionsSingleton._instance = None
+        CraftDependencyPackage.clearCache()
+
+    def getDependencies(self, name, depType, ignoredPackages=None):
+        package = CraftDependencyPackage(CraftPackageObject.get(f"fixture/{name}"))
+        return [p.path for p in package.getDependencies(depType, ignoredPackages)]
+
+    def recursiveWalk(self, name, depType, ignoredPackages=None):
+        """The recursive resolver that was used before the memoized one, without the packaging dependencies"""
+        ignoredPackages = ignoredPackages or []
+        states = {}
+
+        def dependencies(package):
+            subinfo = package.subinfo
+            deps = []
+            if depType & DependencyType.Runtime:
+                deps.extend(subinfo.runtimeDependencies.keys())
+            if depType & DependencyType.Buildtime:
+                deps.extend(subinfo.buildDependencies.keys())
+            return [CraftPackageObject.get(dep) for dep in deps]
+
+        def walk(package):
+            if package.isIgnored():
+                return []
+            depList = []
+            states[package.path] = "visiting"
+            for p in dependencies(package):
+                if p.path in states:
+                    continue
+                if not p.isIgnored() and p.path not in ignoredPackages:
+                    depList.extend(walk(p))
+            if states[package.path] != "visited":
+                states[package.path] = "visited"
+                depList.append(package.path)
+            return list(OrderedDict.fromkeys(depList))
+        return walk(CraftPackageObject.get(f"fixture/{name}"))
+
+
+class TestAPI(CraftDependencyPackageTest):
+    def test_diamond(self):
+        dependencies = self.getDependencies("top", DependencyType.Both)
+        self.assertEqual(dependencies, ["fixture/leaf", "fixture/cycle-b", "fixture/cycle-a", "fixture/base", "fixture/left",
+                                        "fixture/tool", "fixture/right", "fixture/top"])
+        self.assertEqual(dependencies, self.recursiveWalk("top", DependencyType.Both))
+        self.assertEqual(self.getDependencies("top", DependencyType.Runtime), self.recursiveWalk("top", DependencyType.Runtime))
+
+    def test_recursiveWalk(self):
+        for name in self.blueprints:
+            for depType in [DependencyType.Runtime, DependencyType.Buildtime, DependencyType.Both]:
+                self.assertEqual(self.getDependencies(name, depType), self.recursiveWalk(name, depType), (name, depType))
+                self.assertEqual(self.getDependencies(name, depType, ["fixture/base"]),
+                                 self.recursiveWalk(name, depType, ["fixture/base"]), (name, depType))
+
+    def test_cycle(self):
+        self.assertEqual(self.getDependencies("cycle-a", DependencyType.Runtime), ["fixture/leaf", "fixture/cycle-b", "fixture/cycle-a"])
+        self.assertEqual(self.getDependencies("cycle-b", DependencyType.Runtime), ["fixture/cycle-a", "fixture/leaf", "fixture/cycle-b"])
+        # the results of a search cut short by the cycle depend on where it started and are not memoized
+        self.assertNotIn(("fixture/cycle-a", DependencyType.Runtime, frozenset()), CraftDependencyPackage._closureCache)
+        self.assertEqual(self.getDependencies("leaf", DependencyType.Runtime), ["fixture/leaf"])
+        self.assertIn(("fixture/leaf", DependencyType.Runtime, frozenset()), CraftDependencyPackage._closureCache)
+        self.assertEqual(self.getDependencies("base", DependencyType.Runtime),
+                         ["fixture/leaf", "fixture/cycle-b", "fixture/cycle-a", "fixture/base"])
+
+    def test_ignored(self):
+        self.assertEqual(self.getDependencies("ignored", DependencyType.All), [])
+        self.assertNotIn("fixture/ignored", self.getDependencies("top", DependencyType.All))
+        self.assertNotIn("fixture/ignored-dep", self.getDependencies("top", DependencyType.All))
+        dependencies = self.getDependencies("top", DependencyType.Both, ["fixture/left", "fixture/tool"])
+        self.assertEqual(dependencies, ["fixture/leaf", "fixture/cycle-b", "fixture/cycle-a", "fixture/base", "fixture/right", "fixture/top"])
+
+    def test_clearCache(self):
+        expected = self.getDependencies("top", DependencyType.Both)
+        # memoized
+        self.assertEqual(self.getDependencies("top", DependencyType.Both), expected)
+        # loaded from the persisted graph
+        CraftDependencyPackage.clearCache()
+        self.assertTrue(os.path.isfile(DependencyGraph._graphFile()))
+        self.assertEqual(CraftDependencyPackage._closureCache, {})
+        self.assertEqual(self.getDependencies("top", DependencyType.Both), expected)
+        # resolved again from the blueprints
+        CraftDependencyPackage.clearCache()
+        os.remove(DependencyGraph._graphFile())
+        self.assertEqual(self.getDependencies("top", DependencyType.Both), expected)
@@ -1,11 +1,16 @@
+import hashlib
 import io
+import multiprocessing
 import os
 import random
 import tempfile
+import threading
+import time
 
 import CraftTestBase
 from CraftCore import CraftCore
 from Utils import CraftHash
+from Utils.CraftCache import CacheStore, CraftCache
 
 
 class CraftHashTest(CraftTestBase.CraftTestBase):
@@ -21,11 +26,32 @@ class CraftHashTest(CraftTestBase.CraftTestBase):
         self.tmpFile = os.path.join(self.tmpDir.name, "tmpFile")
         with open(self.tmpFile, "wt+") as tmpFIle:
             tmpFIle.write(data)
+        self.cache = CraftCore.cache
+        CraftCore.cache = CraftCache(CacheStore())
 
     def tearDown(self):
+        CraftCore.cache.store.connection.close()
+        CraftCore.cache = self.cache
         del self.tmpDir
         super().tearDown()
 
+    def cachedDigest(self, path):
+        return CraftCore.cache.getDigest(CraftHash._digestKey(path, os.stat(path), CraftHash.HashAlgorithm.SHA256))
+
+    def age(self, path):
+        # files modified within the last 2 seconds are not cached
+        past = time.time() - 10
+        os.utime(path, (past, past))
+
+    def createFiles(self, count):
+        files = []
+        for i in range(count):
+            path = os.path.join(self.tmpDir.name, f"file{i}")
+            with open(path, "wb") as f:
+                f.write(str(i).encode() * (i + 1))
+            files.append(path)
+        return files
+
     def hashTest(self, hash, algorithm):
         path, name = os.path.split(self.tmpFile)
         self.assertEquals(CraftHash.checkFilesDigests(path, [name], hash, algorithm), True)
@@ -67,3 +93,70 @@ class TestAPI(CraftHashTest):
         for algorithm in algorithms:
             self.assertEquals(os.path.exists(self.tmpFile + algorithm.fileEnding()), True)
 
+
+    def test_digestFileAlgorithms(self):
+        with open(self.tmpFile, "rb") as f:
+            data = f.read()
+        algorithms = list(CraftHash.HashAlgorithm.__members__.values())
+        digests = CraftHash.digestFileAlgorithms(self.tmpFile, algorithms)
+        self.assertEqual(digests, {algorithm: getattr(hashlib, algorithm.name.lower())(data).hexdigest() for algorithm in algorithms})
+
+    def test_digestFiles(self):
+        files = self.createFiles(50)
+        expected = [hashlib.sha256(str(i).encode() * (i + 1)).hexdigest() for i in range(50)]
+        cpuCount = multiprocessing.cpu_count
+        # use the thread pool even on a single core
+        multiprocessing.cpu_count = lambda: 4
+        try:
+            self.assertEqual(CraftHash.digestFiles(files), expected)
+        finally:
+            multiprocessing.cpu_count = cpuCount
+
+    def test_parallelMap(self):
+        threads = set()
+
+        def function(item):
+            threads.add(threading.get_ident())
+            # the later items finish first
+            time.sleep((20 - item) / 1000)
+            return item * 2
+
+        cpuCount = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 4
+        try:
+            self.assertEqual(CraftHash._parallelMap(function, range(20)), [item * 2 for item in range(20)])
+        finally:
+            multiprocessing.cpu_count = cpuCount
+        self.assertGreater(len(threads), 1)
+
+    def test_digestCache(self):
+        expected = "4fc1e96dc5ecf625efe228fce1b0964b6302cfa4d4fb2bb8d16c665d23f6ff30"
+        self.assertEqual(CraftHash.digestFile(self.tmpFile), expected)
+        self.assertIsNone(self.cachedDigest(self.tmpFile))
+        self.age(self.tmpFile)
+        self.assertEqual(CraftHash.digestFile(self.tmpFile), expected)
+        self.assertEqual(self.cachedDigest(self.tmpFile), expected)
+
+        # the cached digest is used instead of reading the file
+        key = CraftHash._digestKey(self.tmpFile, os.stat(self.tmpFile), CraftHash.HashAlgorithm.SHA256)
+        CraftCore.cache.cacheDigests({key: "cached"})
+        self.assertEqual(CraftHash.digestFile(self.tmpFile), "cached")
+        self.assertEqual(CraftHash.digestFiles([self.tmpFile]), ["cached"])
+        CraftCore.settings.set("General", "ForceDigestVerification", "True")
+        self.assertEqual(CraftHash.digestFile(self.tmpFile), expected)
+        self.assertEqual(CraftHash.digestFiles([self.tmpFile]), [expected])
+
+        # a modification changes the key
+        CraftCore.settings.set("General", "ForceDigestVerification", "False")
+        with open(self.tmpFile, "at") as f:
+            f.write("changed")
+        self.age(self.tmpFile)
+        with open(self.tmpFile, "rb") as f:
+            self.assertEqual(CraftHash.digestFile(self.tmpFile), hashlib.sha256(f.read()).hexdigest())
+
+    def test_cacheDigests(self):
+        files = self.createFiles(2)
+        self.age(files[0])
+        CraftHash.cacheDigests({files[0]: "first", files[1]: "second"})
+        self.assertEqual(self.cachedDigest(files[0]), "first")
+        self.assertIsNone(self.cachedDigest(files[1]))
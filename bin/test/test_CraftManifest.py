@@ -0,0 +1,134 @@
+import http.server
+import json
+import os
+import socketserver
+import tempfile
+import threading
+
+import CraftTestBase
+from CraftCore import CraftCore
+from Utils.CraftManifest import CraftManifest, ManifestIndex
+
+
+class ManifestRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = b""
+    etag = None
+    requests = []
+
+    def do_GET(self):
+        ManifestRequestHandler.requests.append(self.headers.get("If-None-Match", None))
+        if self.path != "/manifest.json" or ManifestRequestHandler.data is None:
+            self.send_error(404)
+            return
+        if self.headers.get("If-None-Match", None) == ManifestRequestHandler.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ManifestRequestHandler.etag)
+        self.send_header("Content-Length", str(len(ManifestRequestHandler.data)))
+        self.end_headers()
+        self.wfile.write(ManifestRequestHandler.data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class CraftManifestTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ManifestRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/manifest.json"
+        ManifestRequestHandler.requests = []
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.index = ManifestIndex(os.path.join(self.tmpDir.name, "manifests.sqlite"))
+        self.manifest = CraftManifest()
+
+    def tearDown(self):
+        self.index.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+        del self.tmpDir
+        super().tearDown()
+
+    def publish(self, etag):
+        ManifestRequestHandler.data = json.dumps(self.manifest, default=lambda x: x.toJson()).encode("UTF-8")
+        ManifestRequestHandler.etag = etag
+
+
+class TestAPI(CraftManifestTest):
+    def test_entry(self):
+        self.manifest.get("libs/foo").addFile("foo-1.0.tar.7z", "a", version="1.0")
+        self.manifest.get("libs/bar").addFile("bar-1.0.tar.7z", "b", version="1.0")
+        self.publish("1")
+        entry = self.index.entry(self.url, "libs/foo")
+        self.assertEqual([f.fileName for f in entry.files], ["foo-1.0.tar.7z"])
+        self.assertEqual(entry.latest.format, "tar.7z")
+        self.assertEqual(self.index.entry(self.url, "libs/missing").files, [])
+        # the second lookup doesn't ask the server
+        self.index.entry(self.url, "libs/bar")
+        self.assertEqual(ManifestRequestHandler.requests, [None])
+
+    def test_revalidate(self):
+        self.manifest.get("libs/foo").addFile("foo-1.0.tar.7z", "a", version="1.0")
+        self.publish("1")
+        self.assertTrue(self.index.refresh(self.url, maxAge=0))
+        self.assertTrue(self.index.refresh(self.url, maxAge=0))
+        self.assertEqual(ManifestRequestHandler.requests, [None, "1"])
+
+        self.manifest.get("libs/foo").addFile("foo-2.0.tar.zst", "b", version="2.0")
+        self.publish("2")
+        self.assertTrue(self.index.refresh(self.url, maxAge=0))
+        entry = self.index.entry(self.url, "libs/foo")
+        self.assertEqual([f.fileName for f in entry.files], ["foo-2.0.tar.zst", "foo-1.0.tar.7z"])
+        self.assertIsNone(entry.latestFor("1.0", ["tar.zst"]))
+        self.assertEqual(entry.latestFor("1.0", ["tar.zst", "tar.7z"]).fileName, "foo-1.0.tar.7z")
+        self.assertIsNone(entry.latestFor("2.0", ["tar.7z"]))
+
+        manifest = self.index.manifest(self.url)
+        self.assertEqual(len(manifest.get("libs/foo").files), 2)
+
+    def test_latestFor(self):
+        entry = self.manifest.get("libs/foo")
+        entry.addFile("foo-1.0-1.tar.7z", "a", version="1.0")
+        entry.addFile("foo-1.0-2.tar.xz", "b", version="1.0")
+        entry.addFile("foo-1.0-2.tar.zst", "c", version="1.0")
+        self.assertEqual(entry.latestFor("1.0", ["tar.zst", "tar.xz", "tar.7z"]).fileName, "foo-1.0-2.tar.zst")
+        self.assertEqual(entry.latestFor("1.0", ["tar.xz", "tar.7z"]).fileName, "foo-1.0-2.tar.xz")
+        # the newest build can't be unpacked, fall back to the older one
+        self.assertEqual(entry.latestFor("1.0", ["tar.7z"]).fileName, "foo-1.0-1.tar.7z")
+        self.assertIsNone(entry.latestFor("1.0", ["zip"]))
+
+    def test_unavailable(self):
+        url = self.url.replace("manifest.json", "missing/manifest.json")
+        self.assertIsNone(self.index.entry(url, "libs/foo"))
+        self.assertIsNone(self.index.entry(url, "libs/bar"))
+        # the failure is remembered
+        self.assertEqual(len(ManifestRequestHandler.requests), 1)
+        self.assertIsNone(self.index.entry(os.path.join(self.tmpDir.name, "manifest.json"), "libs/foo"))
+
+    def test_removed(self):
+        self.manifest.get("libs/foo").addFile("foo-1.0.tar.7z", "a", version="1.0")
+        self.publish("1")
+        self.assertIsNotNone(self.index.entry(self.url, "libs/foo"))
+        ManifestRequestHandler.data = None
+        self.assertFalse(self.index.refresh(self.url, maxAge=0))
+        self.assertIsNone(self.index.entry(self.url, "libs/foo"))
+        self.assertIsNone(self.index.manifest(self.url))
+
+    def test_localFile(self):
+        path = os.path.join(self.tmpDir.name, "manifest.json")
+        self.manifest.get("libs/foo").addFile("foo-1.0.tar.7z", "a", version="1.0")
+        self.manifest.dump(path)
+        self.assertEqual(self.index.entry(path, "libs/foo").latest.checksum, "a")
+        self.manifest.get("libs/foo").addFile("foo-1.1.tar.7z", "b", version="1.1")
+        self.manifest.dump(path)
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(self.index.entry(path, "libs/foo").latest.checksum, "b")
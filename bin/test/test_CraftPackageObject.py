@@ -0,0 +1,114 @@
+import os
+import tempfile
+import time
+
+import CraftTestBase
+from Blueprints.CraftPackageObject import CraftPackageObject
+
+
+class CraftPackageObjectTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpDir.name, "blueprints")
+        self.listed = []
+        self._listdir = os.listdir
+
+        def listdir(path):
+            self.listed.append(os.path.relpath(path, self.root))
+            return self._listdir(path)
+        # records the directories that are listed by _scanDirectory
+        os.listdir = listdir
+
+    def tearDown(self):
+        os.listdir = self._listdir
+        del self.tmpDir
+        super().tearDown()
+
+    def createFile(self, path, content=""):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wt", encoding="UTF-8") as f:
+            f.write(content)
+
+    def touch(self, path):
+        # make sure the mtime changes on file systems with a coarse resolution
+        future = time.time() + 10
+        os.utime(os.path.join(self.root, path), (future, future))
+
+    def writeHead(self, content, files={}):
+        gitDir = os.path.join(self.root, ".git")
+        for name, data in files.items():
+            os.makedirs(os.path.dirname(os.path.join(gitDir, name)), exist_ok=True)
+            with open(os.path.join(gitDir, name), "wt", encoding="UTF-8") as f:
+                f.write(data)
+        os.makedirs(gitDir, exist_ok=True)
+        with open(os.path.join(gitDir, "HEAD"), "wt", encoding="UTF-8") as f:
+            f.write(content)
+
+
+class TestAPI(CraftPackageObjectTest):
+    def test_gitHead(self):
+        os.makedirs(self.root)
+        self.assertIsNone(CraftPackageObject._gitHead(self.root))
+        # an unborn branch
+        self.writeHead("ref: refs/heads/master\n")
+        self.assertIsNone(CraftPackageObject._gitHead(self.root))
+        self.writeHead("ref: refs/heads/master\n", {"packed-refs": "# pack-refs with: peeled\n1111 refs/heads/master\n"})
+        self.assertEqual(CraftPackageObject._gitHead(self.root), "1111")
+        self.writeHead("ref: refs/heads/master\n", {"refs/heads/master": "2222\n"})
+        self.assertEqual(CraftPackageObject._gitHead(self.root), "2222")
+        # a detached HEAD
+        self.writeHead("3333\n")
+        self.assertEqual(CraftPackageObject._gitHead(self.root), "3333")
+
+    def test_scanDirectory(self):
+        self.createFile("info.ini", "[General]\nplatforms = Linux\n")
+        self.createFile("libs/zlib/zlib.py")
+        self.createFile("libs/png/png.py")
+        node = CraftPackageObject._scanDirectory(self.root)
+        self.assertEqual(node["info"], {"platforms": "Linux"})
+        self.assertEqual(set(node["dirs"]["libs"]["dirs"]), {"zlib", "png"})
+        self.assertEqual(node["dirs"]["libs"]["dirs"]["zlib"]["pyFiles"], ["zlib.py"])
+
+        # nothing changed, nothing is listed
+        self.listed = []
+        self.assertEqual(CraftPackageObject._scanDirectory(self.root, node), node)
+        self.assertEqual(self.listed, [])
+
+        # only the changed directories are listed again
+        self.createFile("libs/jpeg/jpeg.py")
+        self.touch("libs")
+        self.listed = []
+        changed = CraftPackageObject._scanDirectory(self.root, node)
+        self.assertEqual(sorted(self.listed), ["libs", "libs/jpeg"])
+        self.assertEqual(set(changed["dirs"]["libs"]["dirs"]), {"zlib", "png", "jpeg"})
+
+        # a changed info.ini doesn't change the mtime of its directory
+        self.createFile("info.ini", "[General]\nplatforms = Windows\n")
+        self.touch("info.ini")
+        self.assertEqual(CraftPackageObject._scanDirectory(self.root, changed)["info"], {"platforms": "Windows"})
+
+        # a removed directory is dropped
+        os.remove(os.path.join(self.root, "libs", "png", "png.py"))
+        os.rmdir(os.path.join(self.root, "libs", "png"))
+        self.assertEqual(set(CraftPackageObject._scanDirectory(self.root, changed)["dirs"]["libs"]["dirs"]), {"zlib", "jpeg"})
+
+    def test_index(self):
+        self.createFile("libs/zlib/zlib.py")
+        roots = {self.root: {"head": "1111", "node": CraftPackageObject._scanDirectory(self.root)}}
+        CraftPackageObject._saveIndex(roots)
+        self.assertEqual(CraftPackageObject._loadIndex(), roots)
+
+        # an index of another version is ignored
+        index = CraftPackageObject._INDEX_VERSION
+        CraftPackageObject._INDEX_VERSION = index + 1
+        try:
+            self.assertEqual(CraftPackageObject._loadIndex(), {})
+        finally:
+            CraftPackageObject._INDEX_VERSION = index
+
+        # a corrupted index is ignored
+        with open(CraftPackageObject._indexFile(), "wb") as f:
+            f.write(b"corrupted")
+        self.assertEqual(CraftPackageObject._loadIndex(), {})
@@ -0,0 +1,110 @@
+import hashlib
+import http.server
+import os
+import random
+import re
+import socketserver
+import tempfile
+import threading
+
+import CraftTestBase
+from Utils import GetFiles
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = b""
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path != "/file":
+            self.send_error(404)
+            return
+        data = RangeRequestHandler.data
+        requestedRange = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if requestedRange:
+            start = int(requestedRange.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class GetFilesTest(CraftTestBase.CraftTestBase):
+    def setUp(self):
+        super().setUp()
+        random.seed(42)
+        RangeRequestHandler.data = bytes(random.getrandbits(8) for _ in range(1024 * 1024))
+        self.digest = hashlib.sha256(RangeRequestHandler.data).hexdigest()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.tmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        del self.tmpDir
+        super().tearDown()
+
+    def readFile(self, name):
+        with open(os.path.join(self.tmpDir.name, name), "rb") as f:
+            return f.read()
+
+
+class TestAPI(GetFilesTest):
+    def test_download(self):
+        self.assertTrue(GetFiles.getFile(f"{self.url}/redirect", self.tmpDir.name, "file", quiet=True))
+        self.assertEqual(self.readFile("file"), RangeRequestHandler.data)
+
+    def test_resume(self):
+        with open(os.path.join(self.tmpDir.name, "file.part"), "wb") as f:
+            f.write(RangeRequestHandler.data[:1000])
+        self.assertTrue(GetFiles.getFile(f"{self.url}/file", self.tmpDir.name, quiet=True, digest=self.digest))
+        self.assertEqual(self.readFile("file"), RangeRequestHandler.data)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir.name, "file.part")))
+
+    def test_completePartFile(self):
+        with open(os.path.join(self.tmpDir.name, "file.part"), "wb") as f:
+            f.write(RangeRequestHandler.data)
+        self.assertTrue(GetFiles.getFile(f"{self.url}/file", self.tmpDir.name, quiet=True, digest=self.digest))
+        self.assertEqual(self.readFile("file"), RangeRequestHandler.data)
+        # a corrupt part file of the full length must not be taken for the download
+        partFile = os.path.join(self.tmpDir.name, "other.part")
+        with open(partFile, "wb") as f:
+            f.write(b"x" * len(RangeRequestHandler.data))
+        self.assertFalse(GetFiles.getFile(f"{self.url}/file", self.tmpDir.name, "other", quiet=True, digest=self.digest))
+        self.assertFalse(os.path.exists(partFile))
+
+    def test_digestMismatch(self):
+        self.assertFalse(GetFiles.getFile(f"{self.url}/file", self.tmpDir.name, quiet=True, digest="0" * 64))
+        self.assertFalse(os.path.exists(os.path.join(self.tmpDir.name, "file")))
+
+    def test_getFiles(self):
+        downloads = [GetFiles.Download(f"{self.url}/file", self.tmpDir.name, f"file{i}", self.digest) for i in range(4)]
+        self.assertTrue(GetFiles.getFiles(downloads))
+        for i in range(4):
+            self.assertEqual(self.readFile(f"file{i}"), RangeRequestHandler.data)
+        self.assertFalse(GetFiles.getFiles([GetFiles.Download(f"{self.url}/missing", self.tmpDir.name)]))
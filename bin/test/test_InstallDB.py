@@ -33,6 +33,9 @@
 
 """ Functional tests for InstallDB """
 
+import os
+import sqlite3
+
 import CraftTestBase
 
 import InstallDB
@@ -48,3 +51,51 @@ class TestAPI(CraftTestBase.CraftTestBase):
         package.addFiles(dict().fromkeys(['test', 'test1', 'test2'], 'empty hash'))
         package.install()
         self.assertEquals(CraftCore.installdb.isInstalled(packageInstance, '1.4.0'), True)
+
+    def test_migrateDatabase(self):
+        dbFile = os.path.join(self.kdeRoot.name, "old.db")
+        connection = sqlite3.connect(dbFile)
+        connection.execute('''CREATE TABLE packageList (packageId INTEGER PRIMARY KEY AUTOINCREMENT,
+                           prefix TEXT, packagePath TEXT, version TEXT, revision TEXT)''')
+        connection.execute('''CREATE TABLE fileList (fileId INTEGER PRIMARY KEY AUTOINCREMENT,
+                           packageId INTEGER, filename TEXT, fileHash TEXT)''')
+        connection.commit()
+        connection.close()
+
+        db = InstallDB.InstallDB(dbFile)
+        self.assertEqual(db.connection.execute("PRAGMA user_version;").fetchone()[0], InstallDB.InstallDB.SCHEMA_VERSION)
+        self.assertEqual(db.connection.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+        indices = {row[0] for row in db.connection.execute("SELECT name FROM sqlite_master WHERE type='index';")}
+        self.assertTrue({"packageListPackagePath", "fileListPackageId", "fileListFilename"}.issubset(indices))
+        self.assertTrue(db.hasFileSearchIndex)
+        db.connection.close()
+
+    def test_fileSearchIndexUnavailable(self):
+        dbFile = os.path.join(self.kdeRoot.name, "fts.db")
+        InstallDB.InstallDB(dbFile).connection.close()
+        # pretend the database was created by a sqlite that provides a module this one doesn't know
+        connection = sqlite3.connect(dbFile)
+        connection.execute("PRAGMA writable_schema=ON;")
+        connection.execute("UPDATE sqlite_master SET sql=replace(sql, 'USING fts5', 'USING missingModule') WHERE name='fileSearch';")
+        connection.commit()
+        connection.close()
+
+        db = InstallDB.InstallDB(dbFile)
+        self.assertFalse(db.hasFileSearchIndex)
+        triggers = db.connection.execute("SELECT name FROM sqlite_master WHERE type='trigger';").fetchall()
+        self.assertEqual(triggers, [])
+        package = db.addInstalled(CraftPackageObject.get('craft/craft-core'), '1.4.0')
+        package.addFiles({"lib/libtest.so": "empty hash"})
+        package.install()
+        self.assertEqual(db.getPackagesForFileSearch("libtest"), [('craft/craft-core', '1.4.0', 'lib/libtest.so')])
+        db.connection.close()
+
+    def test_getPackagesForFileSearch(self):
+        packageInstance = CraftPackageObject.get('craft/craft-core')
+        package = CraftCore.installdb.addInstalled(packageInstance, '1.4.0')
+        package.addFiles(dict().fromkeys(['bin/test.dll', 'lib/libtest.so', 'include/test.h'], 'empty hash'))
+        package.install()
+        self.assertEqual(CraftCore.installdb.getPackagesForFileSearch("libtest"),
+                         [('craft/craft-core', '1.4.0', 'lib/libtest.so')])
+        CraftCore.installdb.getInstalledPackages(packageInstance)[0].uninstall()
+        self.assertEqual(CraftCore.installdb.getPackagesForFileSearch("libtest"), [])
@@ -0,0 +1,29 @@
+import subprocess
+
+import CraftTestBase
+import utils
+
+
+class TestAPI(CraftTestBase.CraftTestBase):
+    def test_commandLineBatches(self):
+        command = ["signtool", "sign", "/a"]
+        arguments = [f"C:/package/bin/library{i}.dll" for i in range(100)]
+        maxLength = 200
+        batches = utils.commandLineBatches(command, arguments, maxLength)
+        self.assertGreater(len(batches), 1)
+        # nothing is lost or reordered
+        self.assertEqual([argument for batch in batches for argument in batch], arguments)
+        for i, batch in enumerate(batches):
+            self.assertLessEqual(len(subprocess.list2cmdline(command + batch)), maxLength)
+            if i + 1 < len(batches):
+                # as few batches as possible, the first argument of the next batch didn't fit
+                self.assertGreater(len(subprocess.list2cmdline(command + batch + batches[i + 1][:1])), maxLength)
+
+    def test_commandLineBatchesLongArgument(self):
+        # an argument that is too long on its own still gets a batch
+        command = ["signtool"]
+        batches = utils.commandLineBatches(command, ["short", "x" * 100, "short"], 50)
+        self.assertEqual(batches, [["short"], ["x" * 100], ["short"]])
+
+    def test_commandLineBatchesEmpty(self):
+        self.assertEqual(utils.commandLineBatches(["signtool"], []), [])
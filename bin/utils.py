@@ -29,6 +29,7 @@
 import configparser
 import contextlib
 import glob
+import hashlib
 import inspect
 import io
 import os
@@ -47,6 +48,7 @@ from CraftDebug import deprecated
 from CraftOS.osutils import OsUtils
 from CraftSetupHelper import SetupHelper
 from CraftStandardDirs import CraftStandardDirs
+from Utils import CraftArchive, CraftHash, CraftTimer
 
 
 def abstract():
@@ -76,6 +78,14 @@ def unpackFile(downloaddir, filename, workdir):
         CraftCore.log.warning(f"unpackFile called on invalid file extension {filename}")
         return True
 
+    if CraftArchive.canExtract(filename):
+        try:
+            if CraftArchive.extract(os.path.join(downloaddir, filename), workdir):
+                return True
+        except Exception as e:
+            CraftCore.log.error(f"Failed to unpack {filename}", exc_info=e)
+            return False
+
     sevenZVersion = CraftCore.cache.getVersion("7za", versionCommand="-version")
     if sevenZVersion and sevenZVersion >= "16" and (
             not OsUtils.isWin() or OsUtils.supportsSymlinks() or
@@ -128,7 +138,11 @@ def un7zip(fileName, destdir, flag=None):
     # While 7zip supports symlinks cmake 3.8.0 does not support symlinks
     return system(command, displayProgress=True, **kw) and not resolveSymlinks or replaceSymlinksWithCopys(destdir)
 
-def compress(archive : str, source : str) -> bool:
+def compress(archive : str, source : str, profile : str="default", threads : int=0) -> bool:
+    """
+    Creates archive from source, the compressors use threads cores, all cores if threads is 0.
+    The profile fast, default or best trades the time to create the archive for its size.
+    """
     def __7z(archive, source):
         app = CraftCore.cache.findApplication("7za")
         kw = {}
@@ -142,6 +156,7 @@ def compress(archive : str, source : str) -> bool:
             command = [app, "a", "-si",  archive] + progressFlags
         else:
           command = [app, "a", "-r",  archive] + progressFlags
+        command += [f"-mmt={threads or 'on'}", f"-mx={CraftArchive.compressionLevel('7z', profile)}"]
 
         if isinstance(source, list):
             command += source
@@ -157,12 +172,17 @@ def compress(archive : str, source : str) -> bool:
             command += [source]
         else:
             command += [source, "."]
-        return system(command)
+        # tar passes XZ_OPT to xz
+        env = dict(os.environ)
+        env["XZ_OPT"] = f"--threads={threads} -{CraftArchive.compressionLevel('xz', profile)}"
+        return system(command, env=env)
 
     createDir(os.path.dirname(archive))
     if os.path.isfile(archive):
         deleteFile(archive)
-    if CraftCore.compiler.isUnix and archive.endswith(".tar.xz"):
+    if CraftArchive.canCreate(archive):
+        return CraftArchive.create(archive, source, profile, threads=threads)
+    elif CraftCore.compiler.isUnix and archive.endswith(".tar.xz"):
         return __xz(archive, source)
     else:
         return __7z(archive, source)
@@ -226,38 +246,39 @@ def systemWithoutShell(cmd, displayProgress=False, logCommand=True, pipeProcess=
     if CraftCore.compiler.isMacOS and CraftCore.compiler.macUseSDK:
         environment["MACOSX_DEPLOYMENT_TARGET"] = CraftCore.compiler.macOSDeploymentTarget
     CraftCore.debug.logEnv(environment)
-    if pipeProcess:
-        kw["stdin"] = pipeProcess.stdout
-    if not displayProgress or CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False):
-        stdout = kw.get('stdout', sys.stdout)
-        kw['stderr'] = subprocess.STDOUT
-        kw['stdout'] = subprocess.PIPE
-        proc = subprocess.Popen(cmd, **kw)
+    with CraftTimer.Tracer.span(os.path.basename(app or arg0), "system", command=cmd, cwd=cwd):
         if pipeProcess:
-            pipeProcess.stdout.close()
-        for line in proc.stdout:
-            if isinstance(stdout, io.TextIOWrapper):
-                if CraftCore.debug.verbose() < 3:  # don't print if we write the debug log to stdout anyhow
-                    stdout.buffer.write(line)
-                    stdout.flush()
-            elif stdout == subprocess.DEVNULL:
-                pass
-            elif isinstance(stdout, io.StringIO):
-                stdout.write(line.decode("UTF-8"))
-            else:
-                stdout.write(line)
+            kw["stdin"] = pipeProcess.stdout
+        if not displayProgress or CraftCore.settings.getboolean("ContinuousIntegration", "Enabled", False):
+            stdout = kw.get('stdout', sys.stdout)
+            kw['stderr'] = subprocess.STDOUT
+            kw['stdout'] = subprocess.PIPE
+            proc = subprocess.Popen(cmd, **kw)
+            if pipeProcess:
+                pipeProcess.stdout.close()
+            for line in proc.stdout:
+                if isinstance(stdout, io.TextIOWrapper):
+                    if CraftCore.debug.verbose() < 3:  # don't print if we write the debug log to stdout anyhow
+                        stdout.buffer.write(line)
+                        stdout.flush()
+                elif stdout == subprocess.DEVNULL:
+                    pass
+                elif isinstance(stdout, io.StringIO):
+                    stdout.write(line.decode("UTF-8"))
+                else:
+                    stdout.write(line)
 
-            CraftCore.log.debug("{app}: {out}".format(app=app, out=line.rstrip()))
-    else:
-        proc = subprocess.Popen(cmd, **kw)
-        if pipeProcess:
-            pipeProcess.stdout.close()
-        if proc.stderr:
-            for line in proc.stderr:
                 CraftCore.log.debug("{app}: {out}".format(app=app, out=line.rstrip()))
+        else:
+            proc = subprocess.Popen(cmd, **kw)
+            if pipeProcess:
+                pipeProcess.stdout.close()
+            if proc.stderr:
+                for line in proc.stderr:
+                    CraftCore.log.debug("{app}: {out}".format(app=app, out=line.rstrip()))
 
-    proc.communicate()
-    proc.wait()
+        proc.communicate()
+        proc.wait()
 
     if acceptableExitCodes is None:
         ok = proc.returncode == 0
@@ -440,16 +461,57 @@ def createDir(path):
     """Recursive directory creation function. Makes all intermediate-level directories needed to contain the leaf directory"""
     if not os.path.lexists(path):
         CraftCore.log.debug(f"creating directory {path}")
-        os.makedirs(path)
+        # another thread might create it at the same time
+        os.makedirs(path, exist_ok=True)
     return True
 
 
-def copyFile(src, dest, linkOnly=CraftCore.settings.getboolean("General", "UseHardlinks", False)):
-    """ copy file from src to dest"""
+# pairs of devices that don't support reflinks
+_reflinkUnsupported = set()
+
+def _reflink(src, dest) -> bool:
+    """ create a copy on write clone of src, only supported on Linux file systems like btrfs or xfs """
+    if not OsUtils.isLinux():
+        return False
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dest)).st_dev)
+    if devices in _reflinkUnsupported:
+        return False
+    import fcntl
+    FICLONE = 0x40049409
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        _reflinkUnsupported.add(devices)
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def _copyAndDigest(src, dest, algorithm):
+    """ copy src to dest and return the digest of the data, so the file is only read once """
+    hash = getattr(hashlib, algorithm.name.lower())()
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        for buffer in iter(lambda: s.read(1024 * 1024), b""):
+            d.write(buffer)
+            hash.update(buffer)
+    shutil.copystat(src, dest)
+    return hash.hexdigest()
+
+
+def copyFile(src, dest, linkOnly=CraftCore.settings.getboolean("General", "UseHardlinks", False), moveFile=False,
+             digests=None, digestAlgorithm=CraftHash.HashAlgorithm.SHA256):
+    """ copy file from src to dest
+
+        If moveFile is set src is moved if possible. If linkOnly is set a hard link is created if possible.
+        Otherwise a reflink is tried before the file is copied.
+        If digests is a dict, the digest of a copied file or link is stored in it,
+        moved and linked files are not read and need to be digested by the caller.
+    """
     CraftCore.log.debug("copy file from %s to %s" % (src, dest))
-    destDir = os.path.dirname(dest)
-    if not os.path.exists(destDir):
-        os.makedirs(destDir)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
     if os.path.lexists(dest):
         CraftCore.log.warning(f"Overriding {dest}")
         if src == dest:
@@ -457,18 +519,38 @@ def copyFile(src, dest, linkOnly=CraftCore.settings.getboolean("General", "UseHa
             return False
         OsUtils.rm(dest, True)
     # don't link to links
-    if linkOnly and not os.path.islink(src):
+    if os.path.islink(src):
+        if digests is not None:
+            # the digest of a link is the digest of its target as in CraftHash.digestFile
+            digests[dest] = CraftHash.digestString(os.readlink(src), digestAlgorithm)
+        shutil.copy2(src, dest, follow_symlinks=False)
+        return True
+    transferred = False
+    if moveFile:
+        try:
+            os.replace(src, dest)
+            transferred = True
+        except OSError as e:
+            CraftCore.log.debug(f"Failed to move {src} to {dest}: {e}")
+    if not transferred and linkOnly:
         try:
             os.link(src, dest)
-            return True
+            transferred = True
         except:
             CraftCore.log.warning("Failed to create hardlink %s for %s" % (dest, src))
-    shutil.copy2(src, dest, follow_symlinks=False)
+    if not transferred and _reflink(src, dest):
+        transferred = True
+    if not transferred:
+        if digests is not None:
+            digests[dest] = _copyAndDigest(src, dest, digestAlgorithm)
+        else:
+            shutil.copy2(src, dest, follow_symlinks=False)
     return True
 
 
-def copyDir(srcdir, destdir, linkOnly=CraftCore.settings.getboolean("General", "UseHardlinks", False), copiedFiles=None):
-    """ copy directory from srcdir to destdir """
+def copyDir(srcdir, destdir, linkOnly=CraftCore.settings.getboolean("General", "UseHardlinks", False), copiedFiles=None,
+            moveFiles=False, digests=None, digestAlgorithm=CraftHash.HashAlgorithm.SHA256):
+    """ copy directory from srcdir to destdir, see copyFile for moveFiles and digests """
     CraftCore.log.debug("copyDir called. srcdir: %s, destdir: %s" % (srcdir, destdir))
 
     if (not srcdir.endswith(os.path.sep)):
@@ -482,7 +564,8 @@ def copyDir(srcdir, destdir, linkOnly=CraftCore.settings.getboolean("General", "
             for dirName in dirNames:
                 if os.path.islink(os.path.join(root, dirName)):
                     # copy the symlinks without resolving them
-                    if not copyFile(os.path.join(root, dirName), os.path.join(tmpdir, dirName), linkOnly=False):
+                    if not copyFile(os.path.join(root, dirName), os.path.join(tmpdir, dirName), linkOnly=False,
+                                    digests=digests, digestAlgorithm=digestAlgorithm):
                         return False
                     if copiedFiles is not None:
                         copiedFiles.append(os.path.join(tmpdir, dirName))
@@ -492,7 +575,8 @@ def copyDir(srcdir, destdir, linkOnly=CraftCore.settings.getboolean("General", "
 
             for fileName in files:
                 # symlinks to files are included in `files`
-                if not copyFile(os.path.join(root, fileName), os.path.join(tmpdir, fileName),linkOnly=linkOnly):
+                if not copyFile(os.path.join(root, fileName), os.path.join(tmpdir, fileName), linkOnly=linkOnly, moveFile=moveFiles,
+                                digests=digests, digestAlgorithm=digestAlgorithm):
                     return False
                 if copiedFiles is not None:
                     copiedFiles.append(os.path.join(tmpdir, fileName))
@@ -808,11 +892,32 @@ def sign(fileNames : [str]) -> bool:
         command += ["/v"]
     else:
         command += ["/q"]
-    for fileName in fileNames:
-        if not system(command + [fileName], logCommand=False):
+    for batch in commandLineBatches(command, fileNames):
+        if not system(command + batch, logCommand=False):
             return False
     return True
 
+
+def commandLineBatches(command : [str], arguments : [str], maxLength : int=30000) -> [[str]]:
+    """ split arguments into as few batches as possible so that command + batch stays below maxLength characters
+
+        The default is a bit below the 32767 characters CreateProcess accepts on Windows.
+    """
+    batches = []
+    batch = []
+    length = len(subprocess.list2cmdline(command))
+    for argument in arguments:
+        argumentLength = len(subprocess.list2cmdline([argument])) + 1
+        if batch and length + argumentLength > maxLength:
+            batches.append(batch)
+            batch = []
+            length = len(subprocess.list2cmdline(command))
+        batch.append(argument)
+        length += argumentLength
+    if batch:
+        batches.append(batch)
+    return batches
+
 def isBinary(fileName : str) -> bool:
     # https://en.wikipedia.org/wiki/List_of_file_signatures
     MACH_O_64 = b"\xCF\xFA\xED\xFE"